@@ -0,0 +1,401 @@
+import array
+import bisect
+import heapq
+import itertools
+import operator
+
+from .TagExpression import *
+
+# Intersections and differences search the longer list for each id of the shorter one once it is this many times longer, rather than scanning it.
+GALLOP_RATIO = 32
+
+# Returns the index of the first id in the passed sorted array, at or after lo, which is not less than tag_id.
+# Probes lo, lo + 1, lo + 3, lo + 7 and so on before bisecting, so finding an id close to lo only takes a few comparisons.
+def gallop(ids, tag_id, lo=0):
+	hi = lo
+	step = 1
+	while hi < len(ids) and ids[hi] < tag_id:
+		lo = hi + 1
+		hi += step
+		step *= 2
+	
+	return bisect.bisect_left(ids, tag_id, lo, min(hi, len(ids)))
+
+# Returns the values in both of the passed sorted arrays, as a sorted array.
+def intersect_arrays(a, b):
+	if len(a) > len(b):
+		a, b = b, a
+	
+	if len(a) * GALLOP_RATIO >= len(b):
+		return array.array("H", filter(set(a).__contains__, b))
+	
+	result = array.array("H")
+	i = 0
+	for value in a:
+		i = gallop(b, value, i)
+		if i == len(b):
+			break
+		
+		if b[i] == value:
+			result.append(value)
+	
+	return result
+
+# Returns the values in the first of the passed sorted arrays which are not in the second, as a sorted array.
+def subtract_arrays(a, b):
+	if len(a) * GALLOP_RATIO >= len(b):
+		return array.array("H", itertools.filterfalse(set(b).__contains__, a))
+	
+	result = array.array("H")
+	i = 0
+	for value in a:
+		i = gallop(b, value, i)
+		if i == len(b) or b[i] != value:
+			result.append(value)
+	
+	return result
+
+# Postings are split into chunks of the ids which share their high 16 bits. Each chunk stores the low 16 bits of its ids in a container:
+# a sorted array("H") while it holds at most ARRAY_MAX ids, and otherwise a bitmap of CHUNK_SIZE bits, which is never larger than 8 KiB.
+# Once a bitmap falls to ARRAY_MAX // 2 ids, it becomes an array again, so removing and re-adding an id can't convert a chunk back and forth.
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_MAX = 4096
+
+# Translates a string of binary digits into bytes of 0 and 1, for itertools.compress().
+BIT_FLAGS = bytes.maketrans(b"01", b"\x00\x01")
+
+# Returns a bitmap with the bits of the passed values set.
+def to_bitmap(values):
+	bitmap = bytearray(CHUNK_SIZE // 8)
+	for value in values:
+		bitmap[value >> 3] |= 1 << (value & 7)
+	
+	return bitmap
+
+# Returns the bits of the passed bitmap or array container as an int, in which bit i is set if i is in the container.
+def to_bits(container):
+	return int.from_bytes(container if type(container) is bytearray else to_bitmap(container), "little")
+
+# Returns an iterator over the positions of the set bits of the passed int, which is less than 1 << CHUNK_SIZE, in increasing order, each added to base.
+def set_bits(bits, base=0):
+	return itertools.compress(range(base, base + CHUNK_SIZE), format(bits, f"0{CHUNK_SIZE}b")[::-1].encode().translate(BIT_FLAGS))
+
+# Returns the container holding the set bits of the passed int, along with the number of them.
+def from_bits(bits):
+	count = bin(bits).count("1")
+	if count <= ARRAY_MAX:
+		return array.array("H", set_bits(bits)), count
+	
+	return bytearray(bits.to_bytes(CHUNK_SIZE // 8, "little")), count
+
+# Returns an iterator over the values in the passed container, in increasing order, each added to base.
+def container_values(container, base=0):
+	if type(container) is not array.array:
+		return set_bits(to_bits(container), base)
+	
+	return iter(container) if base == 0 else map(base.__add__, container)
+
+# Returns the values in both of the passed containers, as a container along with the number of them.
+def intersect_containers(a, b):
+	if type(a) is not array.array:
+		a, b = b, a
+	
+	if type(a) is not array.array:
+		return from_bits(to_bits(a) & to_bits(b))
+	
+	if type(b) is array.array:
+		result = intersect_arrays(a, b)
+	
+	else:
+		result = array.array("H", (value for value in a if b[value >> 3] >> (value & 7) & 1))
+	
+	return result, len(result)
+
+# Returns the values in the first of the passed containers which are not in the second, as a container along with the number of them.
+def subtract_containers(a, b):
+	if type(a) is not array.array:
+		return from_bits(to_bits(a) & ~to_bits(b))
+	
+	if type(b) is array.array:
+		result = subtract_arrays(a, b)
+	
+	else:
+		result = array.array("H", (value for value in a if not b[value >> 3] >> (value & 7) & 1))
+	
+	return result, len(result)
+
+# Returns the values in any of the passed containers, as a container along with the number of them.
+# Arrays are merged in a single pass, skipping the duplicates which end up next to each other, and anything involving a bitmap is combined bitwise.
+def merge_containers(containers):
+	if any(type(container) is not array.array for container in containers):
+		bits = 0
+		for container in containers:
+			bits |= to_bits(container)
+		
+		return from_bits(bits)
+	
+	result = array.array("H", map(operator.itemgetter(0), itertools.groupby(heapq.merge(*containers))))
+	if len(result) > ARRAY_MAX:
+		return to_bitmap(result), len(result)
+	
+	return result, len(result)
+
+# A compressed, sorted set of unsigned 32-bit item ids, stored as chunks of containers.
+# Postings returned by intersect_postings(), subtract_postings() and merge_postings() may share containers with the postings passed to them, so must not be modified.
+class Posting:
+	def __init__(self):
+		self.keys = [] # Sorted high 16 bits of the ids in each chunk.
+		self.chunks = {} # High 16 bits -> container of the low 16 bits of the ids in that chunk.
+		self.counts = {} # High 16 bits -> number of ids in the chunk, for chunks stored as bitmaps.
+		self.length = 0
+	
+	def __len__(self):
+		return self.length
+	
+	def __iter__(self):
+		for key in self.keys:
+			yield from container_values(self.chunks[key], key << CHUNK_BITS)
+	
+	# Returns the number of ids in the chunk with the passed key.
+	def count(self, key):
+		container = self.chunks[key]
+		return len(container) if type(container) is array.array else self.counts[key]
+	
+	# Adds the passed container of the passed number of ids as the chunk with the passed key, which must be greater than that of every other chunk.
+	# Empty containers are skipped.
+	def append_chunk(self, key, container, count):
+		if count == 0:
+			return
+		
+		self.keys.append(key)
+		self.chunks[key] = container
+		if type(container) is not array.array:
+			self.counts[key] = count
+		
+		self.length += count
+	
+	# Adds the passed id, which must not already be present. Ids are usually added in increasing order, which only appends.
+	def add(self, item_id):
+		key, value = item_id >> CHUNK_BITS, item_id & (CHUNK_SIZE - 1)
+		container = self.chunks.get(key)
+		if container is None:
+			if len(self.keys) == 0 or self.keys[-1] < key:
+				self.keys.append(key)
+			
+			else:
+				bisect.insort(self.keys, key)
+			
+			self.chunks[key] = array.array("H", (value,))
+		
+		elif type(container) is array.array and len(container) < ARRAY_MAX:
+			if container[-1] < value:
+				container.append(value)
+			
+			else:
+				bisect.insort(container, value)
+		
+		else:
+			if type(container) is array.array:
+				container = to_bitmap(container)
+				self.chunks[key] = container
+				self.counts[key] = ARRAY_MAX
+			
+			container[value >> 3] |= 1 << (value & 7)
+			self.counts[key] += 1
+		
+		self.length += 1
+	
+	# Removes the passed id, which must be present.
+	def remove(self, item_id):
+		key, value = item_id >> CHUNK_BITS, item_id & (CHUNK_SIZE - 1)
+		container = self.chunks[key]
+		if type(container) is array.array:
+			del container[bisect.bisect_left(container, value)]
+			if len(container) == 0:
+				del self.chunks[key]
+				del self.keys[bisect.bisect_left(self.keys, key)]
+		
+		else:
+			container[value >> 3] &= ~(1 << (value & 7))
+			self.counts[key] -= 1
+			if self.counts[key] <= ARRAY_MAX // 2:
+				self.chunks[key] = array.array("H", container_values(container))
+				del self.counts[key]
+		
+		self.length -= 1
+	
+	# Returns the ids as a sorted array("I").
+	def to_array(self):
+		result = array.array("I")
+		for key in self.keys:
+			result.extend(container_values(self.chunks[key], key << CHUNK_BITS))
+		
+		return result
+
+# Returns the ids in both of the passed postings, as a posting.
+def intersect_postings(a, b):
+	if len(a.keys) > len(b.keys):
+		a, b = b, a
+	
+	result = Posting()
+	for key in a.keys:
+		if key in b.chunks:
+			result.append_chunk(key, *intersect_containers(a.chunks[key], b.chunks[key]))
+	
+	return result
+
+# Returns the ids in the first of the passed postings which are not in the second, as a posting.
+def subtract_postings(a, b):
+	result = Posting()
+	for key in a.keys:
+		if key in b.chunks:
+			result.append_chunk(key, *subtract_containers(a.chunks[key], b.chunks[key]))
+		
+		else:
+			result.append_chunk(key, a.chunks[key], a.count(key))
+	
+	return result
+
+# Returns the ids in any of the passed postings, as a posting. Chunks which only one posting has are shared rather than copied.
+def merge_postings(postings):
+	if len(postings) == 1:
+		return postings[0]
+	
+	chunks = {} # High 16 bits -> postings with a chunk for them.
+	for posting in postings:
+		for key in posting.keys:
+			chunks.setdefault(key, []).append(posting)
+	
+	result = Posting()
+	for key in sorted(chunks):
+		if len(chunks[key]) == 1:
+			posting, = chunks[key]
+			result.append_chunk(key, posting.chunks[key], posting.count(key))
+		
+		else:
+			result.append_chunk(key, *merge_containers([posting.chunks[key] for posting in chunks[key]]))
+	
+	return result
+
+# An inverted index from tags to the items which carry them, which answers tagified TagExpressions.
+# Items are identified by unsigned 32-bit integers, such as row ids. Each is posted under the canonical ids of its tags at the time it is added,
+# in compressed postings of item ids, one per tag (see Posting). A tag's items are those posted under any tag in its alias group, so aliasing or canonizing tags
+# after items have been added doesn't change the results.
+class ItemIndex:
+	def __init__(self, library):
+		self.library = library
+		self.postings = {} # Canonical tag id -> posting of the ids of the items posted under it.
+		self.items = {} # Item id -> tuple of the tag ids it is posted under.
+		self.live = Posting() # Ids of every item, which negations are taken against.
+	
+	def __len__(self):
+		return len(self.items)
+	
+	def __contains__(self, item_id):
+		return item_id in self.items
+	
+	# Adds the item with the passed id and tags, which may be tags or their names, replacing the item's tags if it already exists.
+	# Throws ValueError if the id is not an unsigned 32-bit integer, and TagIdentificationError if a name is not a real tag.
+	def add(self, item_id, tags):
+		if not 0 <= item_id <= 0xFFFFFFFF:
+			raise ValueError(f"Item id {item_id} is not an unsigned 32-bit integer.")
+		
+		tag_ids = tuple(dict.fromkeys((self.library.get(tag) if type(tag) is str else tag).get_canon().tag_id for tag in tags))
+		if item_id in self.items:
+			self.remove(item_id)
+		
+		self.live.add(item_id)
+		for tag_id in tag_ids:
+			posting = self.postings.get(tag_id)
+			if posting is None:
+				posting = Posting()
+				self.postings[tag_id] = posting
+			
+			posting.add(item_id)
+		
+		self.items[item_id] = tag_ids
+	
+	# Removes the item with the passed id. Throws KeyError if it does not exist.
+	def remove(self, item_id):
+		for tag_id in self.items.pop(item_id):
+			posting = self.postings[tag_id]
+			if len(posting) == 1:
+				del self.postings[tag_id]
+			
+			else:
+				posting.remove(item_id)
+		
+		self.live.remove(item_id)
+	
+	# Returns the posting of the ids of the items with the passed tag or any of its aliases. The posting must not be modified.
+	# If a TagExpansion is passed, the items with any tag it matches are returned.
+	def posting(self, tag):
+		canons = tag.tags() if type(tag) is TagExpansion else (tag.get_canon(),)
+		postings = [self.postings[alias.tag_id] for canon in canons for alias in itertools.chain((canon,), canon.antecedents) if alias.tag_id in self.postings]
+		if len(postings) == 0:
+			return Posting()
+		
+		return merge_postings(postings)
+	
+	# Returns a sorted array of the ids of the items matching the passed TagExpression, or expression string, which is parsed and tagified first.
+	# If expand is true, each tag also matches the items with any tag which implies it (see TagLibrary.tagify()).
+	# Conjunctions intersect the postings of their operands, starting with the shortest, and subtract those of any negated operands.
+	# Disjunctions merge them, and any other negation is taken against every item in the index.
+	# Throws TagExpressionValidationError if the expression contains operators other than AND, OR and NOT.
+	def search(self, tag_expr, expand=False):
+		if type(tag_expr) is str:
+			tag_expr = TagExpression(tag_expr)
+		
+		self.library.tagify(tag_expr, expand=expand)
+		
+		# The items matching each conjunction and disjunction, found bottom-up without recursing.
+		results = {}
+		
+		# Returns the items matching the passed operand, which has been through TagExpression.negated().
+		def matching(operand, negate):
+			ids = results[operand] if isinstance(operand, TagOperator) else self.posting(operand)
+			return subtract_postings(self.live, ids) if negate else ids
+		
+		ancestors = set() # Operators whose operands are still being searched.
+		root, root_negate = TagExpression.negated(tag_expr.root)
+		stack = [root] if isinstance(root, TagOperator) else []
+		while len(stack) > 0:
+			oper = stack[-1]
+			if oper in results:
+				stack.pop()
+				continue
+			
+			if type(oper) not in (TagConjunction, TagDisjunction):
+				raise TagExpressionValidationError(f"Cannot search for {type(oper).__name__}. Reduce the expression first.", oper)
+			
+			operands = [TagExpression.negated(operand) for operand in TagExpression.flattened(oper)]
+			pending = [operand for operand, negate in operands if isinstance(operand, TagOperator) and operand not in results]
+			if len(pending) > 0:
+				if any(operand in ancestors for operand in pending):
+					raise RuntimeError(f"TagOperator {oper} is its own descendant.")
+				
+				ancestors.add(oper)
+				stack.extend(pending)
+				continue
+			
+			stack.pop()
+			ancestors.discard(oper)
+			
+			if type(oper) is TagDisjunction:
+				results[oper] = merge_postings([matching(operand, negate) for operand, negate in operands])
+				continue
+			
+			included = sorted((matching(operand, False) for operand, negate in operands if not negate), key=len)
+			excluded = [matching(operand, False) for operand, negate in operands if negate]
+			
+			ids = self.live if len(included) == 0 else included[0]
+			for posting in included[1:]:
+				ids = intersect_postings(ids, posting)
+			
+			for posting in excluded:
+				ids = subtract_postings(ids, posting)
+			
+			results[oper] = ids
+		
+		return matching(root, root_negate).to_array()
\ No newline at end of file
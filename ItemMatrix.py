@@ -0,0 +1,153 @@
+from .TagExpression import *
+
+# Returns the numpy module, which is only needed by ItemMatrix and so is only imported once one is made.
+def load_numpy():
+	try:
+		import numpy
+	
+	except ImportError:
+		raise ImportError("ItemMatrix requires NumPy. Install it, or use TagExpression.compile() or ItemIndex instead.") from None
+	
+	return numpy
+
+# The tags of a batch of items, for evaluating tagified TagExpressions against every item at once with NumPy, which must be installed.
+# Items are numbered from 0, and their tags are given by canonical tag id, either as a packed bit matrix or in compressed sparse row form:
+# - bits is a 2D array of uint8 with a row per item, in which bit (tag_id % 8) of byte (tag_id // 8) is set for each of the item's tags,
+#   as built by tag_id_bitmap() or numpy.packbits(..., axis=1, bitorder="little"). Rows may be shorter than the largest id.
+# - indptr and indices are integer arrays, where the tags of item i are indices[indptr[i] : indptr[i + 1]].
+# Expressions are evaluated a column at a time: each tag becomes a boolean column with an entry per item, and operators combine whole columns.
+class ItemMatrix:
+	def __init__(self, bits=None, indptr=None, indices=None):
+		numpy = load_numpy()
+		
+		if (bits is None) == (indptr is None or indices is None):
+			raise ValueError("Pass either bits, or both indptr and indices.")
+		
+		if bits is not None:
+			# Stored column by column, so reading a tag's byte for every item is a contiguous read.
+			self.bits = numpy.asfortranarray(bits, dtype=numpy.uint8)
+			if self.bits.ndim != 2:
+				raise ValueError("bits must be a 2D array.")
+			
+			self.indptr = self.indices = None
+			self.num_items = self.bits.shape[0]
+		
+		else:
+			self.bits = None
+			self.indptr = numpy.asarray(indptr)
+			self.indices = numpy.asarray(indices)
+			if not numpy.issubdtype(self.indices.dtype, numpy.integer):
+				# Such as the float64 which an empty list becomes, when no item has any tags.
+				self.indices = self.indices.astype(numpy.int64)
+			
+			self.num_items = len(self.indptr) - 1
+	
+	def __len__(self):
+		return self.num_items
+	
+	# Returns a boolean array, with an entry per item, of whether each item has any of the passed canonical tag ids.
+	def column(self, tag_ids):
+		numpy = load_numpy()
+		
+		if self.bits is not None:
+			# The mask of the bits to test in each byte. Bytes past the end of the rows are never set.
+			masks = {}
+			for tag_id in tag_ids:
+				if tag_id >> 3 < self.bits.shape[1]:
+					masks[tag_id >> 3] = masks.get(tag_id >> 3, 0) | 1 << (tag_id & 7)
+			
+			if len(masks) == 0:
+				return numpy.zeros(self.num_items, dtype=bool)
+			
+			if len(masks) == 1:
+				(byte_i, mask), = masks.items()
+				return self.bits[:, byte_i] & mask != 0
+			
+			return (self.bits[:, list(masks)] & numpy.array(list(masks.values()), dtype=numpy.uint8)).any(axis=1)
+		
+		# Ids too large for the indices' dtype can't be in any row, and would overflow it.
+		max_id = numpy.iinfo(self.indices.dtype).max
+		tag_ids = [tag_id for tag_id in tag_ids if tag_id <= max_id]
+		if len(tag_ids) == 0:
+			return numpy.zeros(self.num_items, dtype=bool)
+		
+		if len(tag_ids) == 1:
+			tag_id, = tag_ids
+			hits = self.indices == tag_id
+		
+		else:
+			hits = numpy.isin(self.indices, numpy.fromiter(tag_ids, dtype=self.indices.dtype, count=len(tag_ids)))
+		
+		# An item has one of the tags if the running count of hits grows across its row.
+		counts = numpy.concatenate(([0], numpy.cumsum(hits)))
+		return counts[self.indptr[1:]] > counts[self.indptr[:-1]]
+	
+	# Returns the items matching the passed tagified TagExpression, as a boolean array with an entry per item, or if indices is true, as a sorted array of their numbers.
+	def evaluate(self, tag_expr, indices=False):
+		return self.evaluate_many([tag_expr], indices)[0]
+	
+	# Returns a list of the items matching each of the passed tagified TagExpressions, as evaluate() does.
+	# Expressions are evaluated together, so a tag, or a subexpression shared by cached trees, is only evaluated once however many expressions contain it.
+	# Throws TagExpressionValidationError if an expression is not tagified or contains operators other than AND, OR and NOT.
+	def evaluate_many(self, tag_exprs, indices=False):
+		numpy = load_numpy()
+		
+		columns = {} # Frozenset of canonical tag ids -> column of the items with any of them.
+		results = {} # Operator -> column of the items matching it.
+		
+		# Returns the column of the items matching the passed operand, which has been through TagExpression.negated().
+		def matching(operand, negate):
+			if isinstance(operand, TagOperator):
+				column = results[operand]
+			
+			else:
+				if type(operand) is str:
+					raise TagExpressionValidationError("Expression must be tagified before it is evaluated.", operand)
+				
+				tag_ids = operand.tag_ids() if type(operand) is TagExpansion else frozenset((operand.get_canon().tag_id,))
+				column = columns.get(tag_ids)
+				if column is None:
+					column = self.column(tag_ids)
+					columns[tag_ids] = column
+			
+			return ~column if negate else column
+		
+		matches = []
+		for tag_expr in tag_exprs:
+			ancestors = set() # Operators whose operands are still being evaluated.
+			root, root_negate = TagExpression.negated(tag_expr.root)
+			stack = [root] if isinstance(root, TagOperator) else []
+			while len(stack) > 0:
+				oper = stack[-1]
+				if oper in results:
+					stack.pop()
+					continue
+				
+				if type(oper) not in (TagConjunction, TagDisjunction):
+					raise TagExpressionValidationError(f"Cannot evaluate {type(oper).__name__}. Reduce the expression first.", oper)
+				
+				operands = [TagExpression.negated(operand) for operand in TagExpression.flattened(oper)]
+				pending = [operand for operand, negate in operands if isinstance(operand, TagOperator) and operand not in results]
+				if len(pending) > 0:
+					if any(operand in ancestors for operand in pending):
+						raise RuntimeError(f"TagOperator {oper} is its own descendant.")
+					
+					ancestors.add(oper)
+					stack.extend(pending)
+					continue
+				
+				stack.pop()
+				ancestors.discard(oper)
+				
+				# Combine the operands in place in a fresh column, since the operands' columns may be shared.
+				combine = numpy.logical_and if type(oper) is TagConjunction else numpy.logical_or
+				column = combine(matching(*operands[0]), matching(*operands[1]))
+				for operand, negate in operands[2:]:
+					combine(column, matching(operand, negate), out=column)
+				
+				results[oper] = column
+			
+			column = matching(root, root_negate)
+			matches.append(numpy.flatnonzero(column) if indices else column.copy())
+		
+		return matches
\ No newline at end of file
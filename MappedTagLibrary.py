@@ -0,0 +1,240 @@
+import array
+import mmap
+import sys
+
+from .TagLibrary import TagLibrary, TagIdentificationError, normalize_tag_name, taglib2_sections, TAGLIB2_HEADER, TAGLIB2_MAGIC, TAGLIB2_NONE
+from .TagExpression import TagExpressionCache
+from . import TagTrace
+
+# A read-only library which answers lookups directly from a memory-mapped TAGLIB2 file, without building a trie.
+# Opening one only reads the header, and processes which map the same file share a single copy of it through the page cache.
+# Tags are returned as MappedTag views, which are created on demand and hold nothing but their position in the file.
+class MappedTagLibrary:
+	def __init__(self, fn, disallowed_chars=""):
+		# Sections are used in place, and are stored little-endian.
+		if sys.byteorder != "little":
+			raise RuntimeError("MappedTagLibrary requires a little-endian machine. Load the file into a TagLibrary instead.")
+		
+		self.disallowed_chars = disallowed_chars
+		
+		# Tagified trees of recently tagified expressions. The file cannot change, so they are never invalidated.
+		self.tagify_cache = TagExpressionCache()
+		
+		# Closures of recently expanded or queried tags, by position and relation. See get_closure().
+		self.closure_cache = TagExpressionCache()
+		
+		with open(fn, "rb") as fin:
+			self.map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+		
+		try:
+			if len(self.map) < TAGLIB2_HEADER.size:
+				raise ValueError("EOF reached unexpectedly!")
+			
+			magic, self.next_id, self.num_tags, *lengths = TAGLIB2_HEADER.unpack_from(self.map)
+			if magic != TAGLIB2_MAGIC:
+				raise ValueError("Not a TAGLIB2 file.")
+			
+			# Each section is a typed view of the mapped bytes. Nothing is read until it is indexed.
+			self.view = memoryview(self.map)
+			self.sections = {}
+			
+			offset = TAGLIB2_HEADER.size
+			for name, typecode, length in taglib2_sections(self.num_tags, *lengths):
+				size = length * array.array(typecode).itemsize
+				if offset + size > len(self.map):
+					raise ValueError("EOF reached unexpectedly!")
+				
+				self.sections[name] = self.view[offset : offset + size].cast(typecode)
+				offset += size + (-size % 8)
+		
+		except Exception:
+			self.close()
+			raise
+	
+	# Unmaps the file. Views of its tags must not be used afterwards.
+	def close(self):
+		for section in getattr(self, "sections", {}).values():
+			section.release()
+		
+		self.sections = {}
+		
+		if getattr(self, "view", None) is not None:
+			self.view.release()
+			self.view = None
+		
+		self.map.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+	
+	# Returns a lowercase, unicode-normalized version of the string. See TagLibrary.validate_and_normalize().
+	def validate_and_normalize(self, tag):
+		return normalize_tag_name(tag, self.disallowed_chars)
+	
+	# Returns the UTF-8 encoded name of the tag at the passed position.
+	def name_bytes(self, position):
+		name_offsets = self.sections["name_offsets"]
+		return self.sections["names"][name_offsets[position] : name_offsets[position + 1]].tobytes()
+	
+	# Returns the position of the first tag whose name is not less than the passed UTF-8 encoded name.
+	# Tags are stored sorted by name, and UTF-8 preserves the order of codepoints, so names are compared as bytes.
+	def bisect(self, key):
+		low = 0
+		high = self.num_tags
+		while low < high:
+			mid = (low + high) // 2
+			if self.name_bytes(mid) < key:
+				low = mid + 1
+			
+			else:
+				high = mid
+		
+		return low
+	
+	# Returns the view for the requested tag if it exists, or None if it doesn't
+	def has(self, tag):
+		key = self.validate_and_normalize(tag).encode("utf-8")
+		
+		position = self.bisect(key)
+		if position < self.num_tags and self.name_bytes(position) == key:
+			return MappedTag(self, position)
+		
+		return None
+	
+	# Returns the view for the requested tag. Throws if the tag does not exist.
+	# Accepts the same arguments as TagLibrary.get() so that it can be used by tagify(), but never lists suggestions.
+	def get(self, tag, suggestions=0, max_distance=2):
+		res = self.has(tag)
+		if res is None:
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("lookup_miss", name=tag)
+			
+			raise TagIdentificationError(f"No such tag '{tag}'.")
+		
+		return res
+	
+	# Converts all strings in the passed TagExpression into views of their tags.
+	tagify = TagLibrary.tagify
+	tagified = TagLibrary.tagified
+	
+	# Yields the name and view of every tag whose name starts with the passed prefix, in sorted order.
+	def items(self, prefix=""):
+		key = self.validate_and_normalize(prefix).encode("utf-8") if prefix else b""
+		
+		for position in range(self.bisect(key), self.num_tags):
+			name = self.name_bytes(position)
+			if not name.startswith(key):
+				break
+			
+			yield str(name, "utf-8"), MappedTag(self, position)
+	
+	# Yields every tag, sorted by name.
+	def __iter__(self):
+		for position in range(self.num_tags):
+			yield MappedTag(self, position)
+	
+	# Returns a tuple of views of the tags related to the tag at the passed position.
+	# The relation is one of "antecedent", "implicant" or "consequent".
+	def related(self, position, relation):
+		offsets = self.sections[relation + "_offsets"]
+		return tuple(MappedTag(self, other) for other in self.sections[relation + "s"][offsets[position] : offsets[position + 1]])
+	
+	# Returns a frozenset of every canonical tag which the passed tag implies, directly or indirectly.
+	def all_consequents(self, tag):
+		return self.get_closure(tag.get_canon().position, "consequent")
+	
+	# Returns a frozenset of every canonical tag which implies the passed tag, directly or indirectly.
+	def all_implicants(self, tag):
+		return self.get_closure(tag.get_canon().position, "implicant")
+	
+	# Returns the transitive closure of the passed relation ("consequent" or "implicant") from the tag at the passed position.
+	# Recently used closures are cached, so that expanding a broad tag in every query only walks its implicants once. They are never invalidated, since the file cannot change.
+	def get_closure(self, position, relation):
+		closure = self.closure_cache.get((position, relation))
+		if closure is not None:
+			return closure
+		
+		offsets = self.sections[relation + "_offsets"]
+		values = self.sections[relation + "s"]
+		
+		seen = set()
+		stack = [position]
+		while len(stack) > 0:
+			current = stack.pop()
+			for other in values[offsets[current] : offsets[current + 1]]:
+				if other not in seen:
+					seen.add(other)
+					stack.append(other)
+		
+		closure = frozenset(MappedTag(self, other) for other in seen)
+		self.closure_cache[(position, relation)] = closure
+		return closure
+
+# A tag in a MappedTagLibrary. Reads its fields from the mapped file on access.
+# Any two views of the same tag compare equal.
+class MappedTag:
+	__slots__ = ("library", "position")
+	
+	def __init__(self, library, position):
+		self.library = library
+		self.position = position # Position of this tag in the file's name order.
+	
+	@property
+	def tag_id(self):
+		return self.library.sections["ids"][self.position]
+	
+	@property
+	def name(self):
+		return str(self.library.name_bytes(self.position), "utf-8")
+	
+	@property
+	def weight(self):
+		return self.library.sections["weights"][self.position]
+	
+	@property
+	def canonical(self):
+		canonical = self.library.sections["canonical"][self.position]
+		if canonical == TAGLIB2_NONE:
+			return None
+		
+		return MappedTag(self.library, canonical)
+	
+	@property
+	def antecedents(self):
+		return self.library.related(self.position, "antecedent")
+	
+	@property
+	def implicants(self):
+		return self.library.related(self.position, "implicant")
+	
+	@property
+	def consequents(self):
+		return self.library.related(self.position, "consequent")
+	
+	# Returns the canonical representation of this tag.
+	def get_canon(self):
+		canonical = self.canonical
+		return self if canonical is None else canonical
+	
+	def does_directly_imply(self, other):
+		return other.get_canon() in self.get_canon().consequents
+	
+	# Returns a frozenset of every canonical tag which this tag implies, directly or indirectly.
+	def all_consequents(self):
+		return self.library.all_consequents(self)
+	
+	# Returns a frozenset of every canonical tag which implies this tag, directly or indirectly.
+	def all_implicants(self):
+		return self.library.all_implicants(self)
+	
+	def __eq__(self, other):
+		return type(other) is MappedTag and self.library is other.library and self.position == other.position
+	
+	def __hash__(self):
+		return hash(self.position)
+	
+	def __repr__(self):
+		return f"<MappedTag {self.tag_id} '{self.name}'>"
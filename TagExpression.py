@@ -1,6 +1,11 @@
 from enum import Enum
+import itertools
+import re
+import time
 import unicodedata
 
+from . import TagTrace
+
 class TagExpressionParsingError(ValueError):
 	def __init__(self, message, expr_str, start=0, end=None, error_i=-1, error_len=1):
 		if end is None:
@@ -17,6 +22,10 @@ class TagExpressionParsingError(ValueError):
 			msg += f"\n    {" "*error_i}^{"~"*(error_len-1)}"
 		
 		super().__init__(msg)
+		
+		self.expr_str = expr_str
+		self.error_i = error_i
+		self.error_len = error_len
 
 class TagExpressionValidationError(ValueError):
 	def __init__(self, message, offending_tag):
@@ -29,18 +38,19 @@ class TagOperator():
 		LEFT_TO_RIGHT = 1
 		RIGHT_TO_LEFT  = 2
 	
-	# The below operations can be tricky. They will augment themselves and return self if they can, but they may very well return a fresh object instead.
+	# The below operations never modify the tree, since parsed trees are shared between expressions (see TagExpressionCache).
+	# They return self if nothing changes, and otherwise a fresh object which shares any unchanged subexpressions.
 	
-	# Returns an equivalent (possibl;y self, modified)  of this operator expressed only in terms of TagConjunction, TagDisjunction, and TagNegation
+	# Returns an equivalent (possibly self) of this operator expressed only in terms of TagConjunction, TagDisjunction, and TagNegation
 	def as_reduced(self):
 		raise NotImplementedError("Deriving classes must override as_reduced()")
 	
-	# Returns an equivalent (possibly self, modified) of this expression in negation normal form.
+	# Returns an equivalent (possibly self) of this expression in negation normal form.
 	# Assumes the tag is already reduced!
 	def as_negation_normal(self):
 		raise NotImplementedError("Deriving classes must override as_negation_normal()")
 	
-	# Returns an equivalent (possibl;y self, modified) of this expression in conjunctive normal form.
+	# Returns an equivalent (possibly self) of this expression in conjunctive normal form.
 	# Assumes the tag is already in negation normal form!
 	def as_conjunctive_normal(self):
 		raise NotImplementedError("Deriving classes must override as_conjunctive_normal()")
@@ -57,6 +67,13 @@ class TagBinaryOperator(TagOperator):
 		self.left = left
 		self.right = right
 	
+	# Returns this operator if the passed operands are its own, or a new operator of the same type with the passed operands.
+	def with_operands(self, left, right):
+		if left is self.left and right is self.right:
+			return self
+		
+		return type(self)(left, right)
+	
 	def validate_is_negation_normal(self):
 		raise TagExpressionValidationError("Unreduced binary operator.", self)
 
@@ -66,31 +83,22 @@ class TagConjunction(TagBinaryOperator):
 	associativity = TagOperator.Associativity.LEFT_TO_RIGHT
 	
 	def as_reduced(self):
-		if isinstance(self.left, TagOperator):
-			self.left = self.left.as_reduced()
-			
-		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_reduced()
+		left = self.left.as_reduced() if isinstance(self.left, TagOperator) else self.left
+		right = self.right.as_reduced() if isinstance(self.right, TagOperator) else self.right
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def as_negation_normal(self):
-		if isinstance(self.left, TagOperator):
-			self.left = self.left.as_negation_normal()
-			
-		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_negation_normal()
+		left = self.left.as_negation_normal() if isinstance(self.left, TagOperator) else self.left
+		right = self.right.as_negation_normal() if isinstance(self.right, TagOperator) else self.right
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def as_conjunctive_normal(self):
-		if isinstance(self.left, TagOperator):
-			self.left = self.left.as_conjunctive_normal()
-			
-		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_conjunctive_normal()
+		left = self.left.as_conjunctive_normal() if isinstance(self.left, TagOperator) else self.left
+		right = self.right.as_conjunctive_normal() if isinstance(self.right, TagOperator) else self.right
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def validate_is_negation_normal(self):
 		if isinstance(self.right, TagOperator):
@@ -105,47 +113,43 @@ class TagDisjunction(TagBinaryOperator):
 	associativity = TagOperator.Associativity.LEFT_TO_RIGHT
 	
 	def as_reduced(self):
-		if isinstance(self.left, TagOperator):
-			self.left = self.left.as_reduced()
-			
-		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_reduced()
+		left = self.left.as_reduced() if isinstance(self.left, TagOperator) else self.left
+		right = self.right.as_reduced() if isinstance(self.right, TagOperator) else self.right
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def as_negation_normal(self):
-		if isinstance(self.left, TagOperator):
-			self.left = self.left.as_negation_normal()
-			
-		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_negation_normal()
+		left = self.left.as_negation_normal() if isinstance(self.left, TagOperator) else self.left
+		right = self.right.as_negation_normal() if isinstance(self.right, TagOperator) else self.right
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def as_conjunctive_normal(self):
-		if isinstance(self.right, TagOperator):
-			if type(self.right) is not TagConjunction:
-				self.right = self.right.as_conjunctive_normal()
+		right = self.right
+		if isinstance(right, TagOperator):
+			if type(right) is not TagConjunction:
+				right = right.as_conjunctive_normal()
 			
 			# Critical: This "if" cannot be changed to "else" because the prior operation may have converted the child to a TagConjunction
-			if type(self.right) is TagConjunction:
+			if type(right) is TagConjunction:
 				return TagConjunction(
-					TagDisjunction(self.left, self.right.left).as_conjunctive_normal(),
-					TagDisjunction(self.left, self.right.right).as_conjunctive_normal()
+					TagDisjunction(self.left, right.left).as_conjunctive_normal(),
+					TagDisjunction(self.left, right.right).as_conjunctive_normal()
 				)
 		
-		if isinstance(self.left, TagOperator):
-			if type(self.left) is not TagConjunction:
-				self.left = self.left.as_conjunctive_normal()
+		left = self.left
+		if isinstance(left, TagOperator):
+			if type(left) is not TagConjunction:
+				left = left.as_conjunctive_normal()
 			
 			# Critical: This "if" cannot be changed to "else" because the prior operation may have converted the child to a TagConjunction
-			if type(self.left) is TagConjunction:
+			if type(left) is TagConjunction:
 				return TagConjunction(
-					TagDisjunction(self.left.left, self.right).as_conjunctive_normal(),
-					TagDisjunction(self.left.right, self.right).as_conjunctive_normal()
+					TagDisjunction(left.left, right).as_conjunctive_normal(),
+					TagDisjunction(left.right, right).as_conjunctive_normal()
 				)
 		
-		return self
+		return self.with_operands(left, right)
 	
 	def validate_is_negation_normal(self):
 		if isinstance(self.right, TagOperator):
@@ -161,18 +165,24 @@ class TagNegation(TagUnaryOperator):
 	
 	def as_reduced(self):
 		if isinstance(self.right, TagOperator):
-			self.right = self.right.as_reduced()
+			right = self.right.as_reduced()
+			if right is not self.right:
+				return type(self)(right)
 		
 		return self
 	
 	def as_negation_normal(self):
 		if type(self.right) is TagNegation:
 			if isinstance(self.right.right, TagOperator):
-				print("Recursing...")
+				if TagTrace.tracer is not None:
+					TagTrace.tracer("double_negation", operand=self.right.right)
+				
 				return self.right.right.as_negation_normal()
 			
 			else:
-				print(f"Returning {self.right.right} as val...")
+				if TagTrace.tracer is not None:
+					TagTrace.tracer("double_negation", operand=self.right.right)
+				
 				return self.right.right
 		
 		if type(self.right) is TagConjunction:
@@ -208,84 +218,251 @@ TagOperator.operations = (TagDisjunction, TagConjunction, TagNegation)
 for oper_i in range(1, len(TagOperator.operations)):
 	assert TagOperator.operations[oper_i].priority > TagOperator.operations[oper_i-1].priority
 
+# Operations by symbol, and a pattern matching every symbol and parenthesis, used by TagExpression.tokenize().
+TagOperator.symbols = {oper.symbol: oper for oper in TagOperator.operations}
+TagOperator.token_pattern = re.compile("|".join(re.escape(symbol) for symbol in sorted(["(", ")", *TagOperator.symbols], key=len, reverse=True)))
+
+# A leaf which matches its tag, any alias of it, or any tag which implies it, directly or indirectly. Made by TagLibrary.tagify(expand=True).
+# The tags are not listed in the tree. They are read from the library's cached closure of the tag's implicants when the expression is evaluated,
+# so expanding a broad tag costs nothing until then, and the closure is shared by every expression which expands the same tag.
+class TagExpansion:
+	__slots__ = ("tag",)
+	
+	def __init__(self, tag):
+		self.tag = tag
+	
+	def __repr__(self):
+		return f"TagExpansion({self.tag!r})"
+	
+	# Returns an iterable of the canonical tags which this leaf matches: the canonical form of its tag, followed by every tag which implies it.
+	def tags(self):
+		canon = self.tag.get_canon()
+		return itertools.chain((canon,), canon.all_implicants())
+	
+	# Returns a frozenset of the ids of the canonical tags which this leaf matches.
+	def tag_ids(self):
+		return frozenset(tag.tag_id for tag in self.tags())
+
+# A dict which holds at most maxsize entries, discarding the least recently used one to make room for another.
+# Used to cache parsed trees by expression string (see TagExpression.cache), and tagified trees by parsed tree (see TagLibrary.tagify()).
+class TagExpressionCache(dict):
+	def __init__(self, maxsize=4096):
+		super().__init__()
+		
+		self.maxsize = maxsize
+	
+	# Returns the value for the passed key, or default if it isn't cached, marking it as the most recently used.
+	def get(self, key, default=None):
+		value = self.pop(key, _MISSING)
+		if value is _MISSING:
+			return default
+		
+		super().__setitem__(key, value)
+		return value
+	
+	def __setitem__(self, key, value):
+		if key not in self and len(self) >= self.maxsize > 0:
+			del self[next(iter(self))]
+		
+		if self.maxsize > 0:
+			super().__setitem__(key, value)
+
+_MISSING = object()
+
+# Returns a bytearray in which bit (tag_id % 8) of byte (tag_id // 8) is set for each of the passed tag ids, for use with TagExpression.compile(bitmap=True).
+def tag_id_bitmap(tag_ids):
+	tag_ids = list(tag_ids)
+	
+	bitmap = bytearray((max(tag_ids) >> 3) + 1 if len(tag_ids) > 0 else 0)
+	for tag_id in tag_ids:
+		bitmap[tag_id >> 3] |= 1 << (tag_id & 7)
+	
+	return bitmap
+
 class TagExpression:
-	def __init__(self, expr_str, start=0, end=None, depth=0):
+	# Kinds of token produced by tokenize().
+	NAME = 0
+	OPEN = 1
+	CLOSE = 2
+	OPERATOR = 3
+	
+	# Parses the passed string, or the segment [start:end] of it, into a tree of TagOperators with tag names (strings) for leaves.
+	# The string is tokenized in a single pass, then parsed with an operator stack (shunting-yard), so parsing takes linear time and deep nesting does not recurse.
+	def __init__(self, expr_str, start=0, end=None):
 		if end is None:
 			end = len(expr_str)
 		
-		# One-time check for invalid characters
-		if depth == 0:
-			expr_has_non_whitespace = False
+		# Whole expressions are cached by their string, ignoring surrounding spaces, so that repeated queries are only parsed once.
+		# The cached tree is shared rather than copied, which is safe since nothing modifies a parsed tree.
+		key = expr_str.strip(" ") if start == 0 and end == len(expr_str) else None
+		if key is not None:
+			self.root = TagExpression.cache.get(key)
+			if self.root is not None:
+				return
+		
+		began = time.perf_counter() if TagTrace.tracer is not None else None
+		
+		# One-time check for invalid characters. Nearly every expression is printable, which rules them all out at once.
+		if not expr_str.isprintable():
 			for letter_i in range(len(expr_str)):
 				letter = expr_str[letter_i]
 				if unicodedata.category(letter) in ["Zl", "Zp", "Cc", "Cf", "Cs", "Co", "Cn"]:
 					raise TagExpressionParsingError(f"Expression contains invalid control or format character U+{ord(letter):04x}.", expr_str, start, end, letter_i)
-				
-				if letter not in (" ", "\t"):
-					expr_has_non_whitespace = True
-			
-			if not expr_has_non_whitespace:
-				raise TagExpressionParsingError(f"Expression must not be empty.", expr_str)
-		
-		# Check for empty expr
-		expr_has_non_whitespace = False
-		for letter_i in range(start, end):
-			letter = expr_str[letter_i]
-			if letter not in (" ", "\t"):
-				expr_has_non_whitespace = True
-				break
-		
-		if not expr_has_non_whitespace:
-			raise TagExpressionParsingError(f"Expression must not be empty. Did you forget an operand?", expr_str, start, end, start, end-start)
-		
-		print(f"{" "*start}'{expr_str[start:end]}'")
-		self.root = None
-		
-		oper, oper_i, sub_expr_start_i, sub_expr_end_i = TagExpression.get_lowest_precedence_operator(expr_str, start, end)
-		
-		# Fancy debugging stuff
-		if oper is not None:
-			msg = f" {" "*sub_expr_start_i}^{" "*(oper_i - sub_expr_start_i - 1)}{"-"*(len(oper.symbol))}{" "*(sub_expr_end_i - oper_i - len(oper.symbol))}^"
-			print(f"{msg}{" "*(len(expr_str) + 5 - len(msg))}({sub_expr_start_i}, {oper_i}, {sub_expr_end_i})")
-		else:
-			msg = f" {" "*sub_expr_start_i}^{" "*(sub_expr_end_i - sub_expr_start_i - 1)}^"
-			print(f"{msg}{" "*(len(expr_str) + 5 - len(msg))}({sub_expr_start_i}, {sub_expr_end_i})")
-		
-		# Check that no text exists in the region occluded by the subexpression bounds.
-		# This can happen if the user forgets on operator, as in:
-		# some tag (other tag with long name) another weirdly long tag
-		# ^ start   ^ sub_expr_start_i      ^ sub_expr_end_i          ^ end
-		for i in range(start, sub_expr_start_i):
-			if expr_str[i] not in (" ", "\t", "("):
-				raise TagExpressionParsingError("Expected operator before parenthetical.", expr_str, start, end, sub_expr_start_i-1)
-		
-		for i in range(sub_expr_end_i, end):
-			if expr_str[i] not in (" ", "\t", ")"):
-				raise TagExpressionParsingError("Expected operator before tag or parenthetical.", expr_str, start, end, i)
-		
-		# No operation. Whole expression is a single tag.
-		if oper is None:	
-			self.root = expr_str[sub_expr_start_i:sub_expr_end_i].strip()
-		
-		# Operation found.
-		else:
+		
+		if expr_str.strip(" \t") == "":
+			raise TagExpressionParsingError(f"Expression must not be empty.", expr_str)
+		
+		tokens = TagExpression.tokenize(expr_str, start, end)
+		
+		operands = [] # Parsed subexpressions, as (root, start, end) tuples.
+		operators = [] # Pending operators and open parentheses, as (oper, position) tuples. oper is None for an open parenthesis.
+		
+		# Pops the operator on top of the stack and replaces its operands with the operation.
+		def reduce():
+			oper, oper_i = operators.pop()
 			if issubclass(oper, TagUnaryOperator):
-				# Check that unary operators are not preceeded by an operand
-				for i in range(sub_expr_start_i, oper_i):
-					if expr_str[i] not in (" ", "\t"):
-						raise TagExpressionParsingError("Expected operator before unary operator.", expr_str, start, end, oper_i)
+				right, right_start, right_end = operands.pop()
+				operands.append((oper(right), oper_i, right_end))
+			
+			else:
+				right, right_start, right_end = operands.pop()
+				left, left_start, left_end = operands.pop()
+				operands.append((oper(left, right), left_start, right_end))
+			
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("parse", expr=expr_str, start=operands[-1][1], end=operands[-1][2], operator=oper, operator_i=oper_i)
+		
+		expect_operand = True
+		gap_start = start # End of the previous token, and therefore the start of a missing operand.
+		for token_i, (kind, token_start, token_end, value) in enumerate(tokens):
+			if expect_operand:
+				if kind == TagExpression.NAME:
+					operands.append((value, token_start, token_end))
+					expect_operand = False
+					
+					if TagTrace.tracer is not None:
+						TagTrace.tracer("parse", expr=expr_str, start=token_start, end=token_end, operator=None, operator_i=None)
+				
+				elif kind == TagExpression.OPEN:
+					operators.append((None, token_start))
+					gap_start = token_end
+				
+				elif kind == TagExpression.OPERATOR and issubclass(value, TagUnaryOperator):
+					operators.append((value, token_start))
+					gap_start = token_end
+				
+				# A binary operator or close parenthesis, where an operand should be.
+				else:
+					raise TagExpressionParsingError(f"Expression must not be empty. Did you forget an operand?", expr_str, gap_start, token_start, gap_start, token_start - gap_start)
+			
+			else:
+				if kind == TagExpression.OPERATOR and issubclass(value, TagBinaryOperator):
+					# Operators of higher priority bind more tightly, so their operations are complete. So are those of equal priority, if evaluated left-to-right.
+					while len(operators) > 0 and operators[-1][0] is not None and (operators[-1][0].priority > value.priority or (operators[-1][0].priority == value.priority and value.associativity == TagOperator.Associativity.LEFT_TO_RIGHT)):
+						reduce()
+					
+					operators.append((value, token_start))
+					expect_operand = True
+					gap_start = token_end
+				
+				elif kind == TagExpression.CLOSE:
+					while operators[-1][0] is not None:
+						reduce()
+					
+					operators.pop()
+				
+				elif kind == TagExpression.NAME:
+					raise TagExpressionParsingError("Expected operator before tag or parenthetical.", expr_str, start, end, token_start)
 				
-				sub_expr = TagExpression(expr_str, oper_i + len(oper.symbol), sub_expr_end_i, depth+1)
-				self.root = oper(sub_expr.root)
+				elif kind == TagExpression.OPEN:
+					# Report the innermost of any parentheses which directly enclose one another, as the original recursive parser did.
+					while tokens[token_i + 1][0] == TagExpression.OPEN and tokens[tokens[token_i + 1][3] + 1][1] == tokens[tokens[token_i][3]][1]:
+						token_i += 1
+					
+					raise TagExpressionParsingError("Expected operator before parenthetical.", expr_str, start, end, tokens[token_i][1])
+				
+				else:
+					raise TagExpressionParsingError("Expected operator before unary operator.", expr_str, start, end, token_start)
+		
+		if expect_operand:
+			raise TagExpressionParsingError(f"Expression must not be empty. Did you forget an operand?", expr_str, gap_start, end, gap_start, end - gap_start)
+		
+		while len(operators) > 0:
+			reduce()
+		
+		self.root = operands[0][0]
+		
+		if key is not None:
+			TagExpression.cache[key] = self.root
+		
+		if began is not None and TagTrace.tracer is not None:
+			TagTrace.tracer("parsed", expr=expr_str, seconds=time.perf_counter() - began)
+	
+	# Splits the segment [start:end] of the passed string into a list of (kind, start, end, value) tokens, in a single pass.
+	# Operator symbols and parentheses are tokens wherever they appear; the text between them is a tag name unless it is only spaces.
+	# The value of a NAME is the name, stripped of whitespace, and that of an OPERATOR is its TagOperator class.
+	# The value of an OPEN parenthesis is the index of its CLOSE parenthesis. Throws on mismatched or empty parentheses.
+	def tokenize(expr_str, start=0, end=None):
+		if end is None:
+			end = len(expr_str)
+		
+		tokens = []
+		
+		opens = [] # Indices of the open parentheses which have not yet been closed.
+		first_unmatched_close = None
+		last_empty_open = None
+		
+		prev_end = start
+		for match in TagOperator.token_pattern.finditer(expr_str, start, end):
+			match_start = match.start()
+			if match_start > prev_end:
+				name = expr_str[prev_end:match_start].lstrip(" ")
+				if name != "":
+					name_start = match_start - len(name)
+					tokens.append((TagExpression.NAME, name_start, name_start + len(name.rstrip(" ")), name.strip()))
 			
-			elif issubclass(oper, TagBinaryOperator):
-				left_expr = TagExpression(expr_str, sub_expr_start_i, oper_i, depth+1)
-				right_expr = TagExpression(expr_str, oper_i + len(oper.symbol), sub_expr_end_i, depth+1)
+			symbol = match.group()
+			if symbol == "(":
+				opens.append(len(tokens))
+				tokens.append((TagExpression.OPEN, match_start, match_start + 1, None))
+			
+			elif symbol == ")":
+				if len(opens) > 0:
+					open_i = opens.pop()
+					if open_i == len(tokens) - 1:
+						last_empty_open = open_i
+					
+					tokens[open_i] = (TagExpression.OPEN, tokens[open_i][1], tokens[open_i][2], len(tokens))
+				
+				elif first_unmatched_close is None:
+					first_unmatched_close = match_start
 				
-				self.root = oper(left_expr.root, right_expr.root)
+				tokens.append((TagExpression.CLOSE, match_start, match_start + 1, None))
 			
 			else:
-				raise RuntimeError(f"Unknown operation {oper}.")
+				tokens.append((TagExpression.OPERATOR, match_start, match.end(), TagOperator.symbols[symbol]))
+			
+			prev_end = match.end()
+		
+		if end > prev_end:
+			name = expr_str[prev_end:end].lstrip(" ")
+			if name != "":
+				name_start = end - len(name)
+				tokens.append((TagExpression.NAME, name_start, name_start + len(name.rstrip(" ")), name.strip()))
+		
+		# Report the rightmost bad open parenthesis, or failing that the leftmost unmatched close, as the original right-to-left scan did.
+		if len(opens) > 0 and (last_empty_open is None or opens[-1] > last_empty_open):
+			raise TagExpressionParsingError("Unmatched open parenthesis.", expr_str, start, end, tokens[opens[-1]][1])
+		
+		if last_empty_open is not None:
+			open_i = tokens[last_empty_open][1]
+			close_i = tokens[tokens[last_empty_open][3]][1]
+			raise TagExpressionParsingError("Empty expression.", expr_str, start, end, open_i, close_i - open_i + 1)
+		
+		if first_unmatched_close is not None:
+			raise TagExpressionParsingError("Unmatched close parenthesis.", expr_str, start, end, first_unmatched_close)
+		
+		return tokens
 	
 	# Convert one-way and two-way implication into negation, conjunction, and disjunction operators.
 	def reduce_implications(self):
@@ -304,7 +481,148 @@ class TagExpression:
 	def to_conjunctive_normal_form(self):
 		self.to_negation_normal_form()
 		if isinstance(self.root, TagOperator):
-			self.root = self.root.conjunctive_normal_form()
+			self.root = self.root.as_conjunctive_normal()
+	
+	# Subexpressions nested more deeply than this are compiled into functions of their own, since Python limits how deeply parentheses may nest.
+	compile_max_depth = 32
+	
+	# Returns a function which takes the tags of an item and returns whether the item matches this expression, which must have been tagified.
+	# Tags are given as a set (or any iterable supporting "in") of canonical tag ids, or if bitmap is true, as a bytes-like object in which
+	# bit (tag_id % 8) of byte (tag_id // 8) is set for each canonical tag id. See tag_id_bitmap(). Bitmaps may be shorter than the largest id.
+	# The function is generated as Python source, in which each tag is a membership test on its canonical id and each run of the same operator
+	# is flattened into a single "and" or "or", so evaluation short-circuits and involves no dispatch on the tree.
+	# A TagExpansion tests every id in its closure at once, without becoming a run of "or"s.
+	# Canonical ids and closures are read when compiling, so recompile after aliasing, canonizing or implying tags.
+	def compile(self, bitmap=False):
+		namespace = {}
+		size = 0 # Number of bytes a bitmap must have to contain every tag in the expression.
+		
+		# Returns the source of the test for the passed tag.
+		def test(tag):
+			nonlocal size
+			
+			if type(tag) is str or isinstance(tag, TagOperator):
+				raise TagExpressionValidationError("Expression must be tagified before it is compiled.", tag)
+			
+			if type(tag) is TagExpansion:
+				tag_ids = tag.tag_ids()
+				if len(tag_ids) > 1:
+					return expansion_test(tag_ids)
+				
+				tag_id, = tag_ids
+			
+			else:
+				tag_id = tag.get_canon().tag_id
+			
+			if not bitmap:
+				return f"{tag_id} in tags"
+			
+			size = max(size, (tag_id >> 3) + 1)
+			return f"tags[{tag_id >> 3}] & {1 << (tag_id & 7)} != 0"
+		
+		# Returns the source of the test for an expansion matching any of the passed ids, which are stored in the namespace rather than the source.
+		def expansion_test(tag_ids):
+			nonlocal size
+			
+			name = f"_{len(namespace)}"
+			if not bitmap:
+				namespace[name] = tag_ids
+				return f"not {name}.isdisjoint(tags)"
+			
+			# The mask of the bits to test in each byte.
+			masks = {}
+			for tag_id in tag_ids:
+				masks[tag_id >> 3] = masks.get(tag_id >> 3, 0) | 1 << (tag_id & 7)
+			
+			size = max(size, max(masks) + 1)
+			namespace[name] = tuple(masks.items())
+			return f"any(tags[byte_i] & mask for byte_i, mask in {name})"
+		
+		# The source of each compiled conjunction and disjunction, and how deeply its parentheses nest, built bottom-up without recursing.
+		compiled = {}
+		ancestors = set() # Operators whose operands are still being compiled.
+		root, root_negate = TagExpression.negated(self.root)
+		stack = [root] if isinstance(root, TagOperator) else []
+		while len(stack) > 0:
+			oper = stack[-1]
+			if oper in compiled:
+				stack.pop()
+				continue
+			
+			if type(oper) not in (TagConjunction, TagDisjunction):
+				raise TagExpressionValidationError(f"Cannot compile {type(oper).__name__}. Reduce the expression first.", oper)
+			
+			operands = [TagExpression.negated(operand) for operand in TagExpression.flattened(oper)]
+			pending = [operand for operand, negate in operands if isinstance(operand, TagOperator) and operand not in compiled]
+			if len(pending) > 0:
+				if any(operand in ancestors for operand in pending):
+					raise RuntimeError(f"TagOperator {oper} is its own descendant.")
+				
+				ancestors.add(oper)
+				stack.extend(pending)
+				continue
+			
+			stack.pop()
+			ancestors.discard(oper)
+			
+			parts = []
+			depth = 0
+			for operand, negate in operands:
+				if isinstance(operand, TagOperator):
+					part, part_depth = compiled[operand]
+					if part_depth >= TagExpression.compile_max_depth:
+						name = f"_{len(namespace)}"
+						namespace[name] = eval(f"lambda tags: {part}", namespace)
+						part, part_depth = f"{name}(tags)", 0
+					
+					part = f"({part})"
+					depth = max(depth, part_depth + 1)
+				
+				else:
+					part = test(operand)
+				
+				parts.append(f"not {part}" if negate else part)
+			
+			compiled[oper] = (" and " if type(oper) is TagConjunction else " or ").join(parts), depth
+		
+		source = f"({compiled[root][0]})" if isinstance(root, TagOperator) else test(root)
+		if root_negate:
+			source = f"not {source}"
+		
+		# Only integers are interpolated into the source.
+		code = "def evaluate(tags):\n"
+		if bitmap and size > 0:
+			code += f"\tif len(tags) < {size}:\n\t\ttags = bytes(tags).ljust({size}, b\"\\0\")\n"
+		
+		code += f"\treturn {source}\n"
+		
+		exec(code, namespace)
+		return namespace["evaluate"]
+	
+	# Returns the operand beneath the passed run of negations, and whether there are an odd number of them.
+	def negated(node):
+		negate = False
+		while type(node) is TagNegation:
+			node = node.right
+			negate = not negate
+		
+		return node, negate
+	
+	# Returns the operands of the passed binary operator and of every operator of the same type directly beneath it, from left to right.
+	# For example, the operands of the conjunction in "a AND (b AND c) AND (d OR e)" are a, b, c and the disjunction.
+	def flattened(oper):
+		operands = []
+		stack = [oper]
+		while len(stack) > 0:
+			node = stack.pop()
+			if type(node) is type(oper):
+				stack.append(node.right)
+				stack.append(node.left)
+			
+			else:
+				operands.append(node)
+		
+		return operands
 	
 	def conjunctive_normal_form():
 		self.negation_normal_form()
@@ -346,6 +664,7 @@ class TagExpression:
 	
 	# Returns the type and position of the lowest-priority operator in the passeed string segment.
 	# Also throws on mismatched parentheses.
+	# No longer used to parse, since it scans the whole segment, but still useful for finding where an expression splits.
 	def get_lowest_precedence_operator(expr_str, start=0, end=None):
 		if end is None:
 			end = len(expr_str)
@@ -390,7 +709,8 @@ class TagExpression:
 					raise TagExpressionParsingError("Unmatched open parenthesis.", expr_str, start, end, i)
 				
 				# If we are now exiting the parenthetical containing the lowest-precedence operator (so far), record its start and end.
-				if do_set_sub_expr_bounds:
+				# Parentheticals to the left of that operator, at a greater depth, are merely its operands.
+				if do_set_sub_expr_bounds and (min_oper is None or len(close_parens_i) == min_oper_depth):
 					sub_expr_start_i = i + 1
 					sub_expr_end_i = close_parens_i[-1]
 					do_set_sub_expr_bounds = False
@@ -442,4 +762,7 @@ class TagExpression:
 		assert sub_expr_start_i < sub_expr_end_i
 		assert (min_oper is None) == (oper_i is None)
 		
-		return min_oper, oper_i, sub_expr_start_i, sub_expr_end_i
\ No newline at end of file
+		return min_oper, oper_i, sub_expr_start_i, sub_expr_end_i
+
+# Parsed trees of recently parsed expressions, by expression string. Set its maxsize to 0 to disable caching.
+TagExpression.cache = TagExpressionCache()
\ No newline at end of file
@@ -1,8 +1,17 @@
+import array
 import csv
+import functools
+import gc
+import heapq
 import io
+import os
+import struct
+import sys
+import types
 import unicodedata
 
 from .TagExpression import *
+from . import TagTrace
 
 class TagIntegrityError(RuntimeError):
 	def __init__(self, message, /, *args, **kwargs):
@@ -11,224 +20,1402 @@ class TagIntegrityError(RuntimeError):
 		self.message = message
 
 class TagIdentificationError(ValueError):
-	pass
+	def __init__(self, message, suggestions=None):
+		if suggestions:
+			message += f" Did you mean {", ".join(f"'{suggestion}'" for suggestion in suggestions)}?"
+		
+		super().__init__(message)
+		
+		# Names of similar tags, if requested.
+		self.suggestions = [] if suggestions is None else suggestions
+
+# An insertion-ordered set of tags, used for all relations between tags.
+# Membership tests, additions and removals take constant time, while iteration (and therefore saving) stays deterministic.
+class TagRelationSet(dict):
+	__slots__ = ()
+	
+	def add(self, tag):
+		self[tag] = None
+	
+	def remove(self, tag):
+		del self[tag]
+	
+	def __repr__(self):
+		return f"TagRelationSet({list(self)})"
+
+# Returned by TagLibrary.create_many().
+# Lists the created tags in the order their names were passed, and every rejected name along with the exception explaining why.
+class TagCreationReport:
+	def __init__(self):
+		self.created = []
+		self.rejected = []
+	
+	def __repr__(self):
+		return f"<TagCreationReport; {len(self.created)} created; {len(self.rejected)} rejected>"
+
+# TAGLIB2 files begin with this magic number, which includes the format version. TAGLIB (version 1) files have no magic number.
+TAGLIB2_MAGIC = b"\x89TAGLIB\x02"
+
+# Follows the magic number: next_id, the number of tags, the length of the names section, and the total number of antecedents, implicants and consequents.
+TAGLIB2_HEADER = struct.Struct("<8s6I")
+
+# Marks a tag with no canonical form in the canonical section of a TAGLIB2 file.
+TAGLIB2_NONE = 0xFFFFFFFF
+
+# Returns the sections of a TAGLIB2 file as (name, typecode, length) triples, in the order they appear after the header.
+# Every section holds a little-endian array and is padded to a multiple of 8 bytes.
+# Tags are stored sorted by name. Canonical forms and relations refer to tags by their position in this order.
+# Relations are stored in compressed sparse row form: the relations of the tag at position i are relations[offsets[i]:offsets[i + 1]].
+def taglib2_sections(num_tags, names_size, num_antecedents, num_implicants, num_consequents):
+	return [
+		("ids", "I", num_tags),
+		("name_offsets", "I", num_tags + 1),
+		("names", "B", names_size),
+		("canonical", "I", num_tags),
+		("weights", "d", num_tags),
+		("antecedent_offsets", "I", num_tags + 1),
+		("antecedents", "I", num_antecedents),
+		("implicant_offsets", "I", num_tags + 1),
+		("implicants", "I", num_implicants),
+		("consequent_offsets", "I", num_tags + 1),
+		("consequents", "I", num_consequents),
+	]
+
+# Journals begin with this magic number, followed by the size and modification time of the snapshot they apply to.
+JOURNAL_MAGIC = b"\x89TAGJNL\x01"
+JOURNAL_HEADER = struct.Struct("<8sQq")
+
+# Every journal record begins with an operation, a tag id, and a value whose meaning depends on the operation.
+JOURNAL_RECORD = struct.Struct("<BII")
+
+# Records changes to a TagLibrary in an append-only file next to its snapshot, so that small changes don't require the whole library to be saved.
+# Records are buffered, then written and synced to disk together once batch_size have accumulated, or when flush() is called.
+# Used by TagLibrary.open_journal().
+class TagJournal:
+	CREATE = 1 # Value is the length of the name, which follows.
+	ALIAS = 2 # Value is the id of the other tag.
+	IMPLY = 3 # Value is the id of the consequent.
+	CANONIZE = 4 # Value is unused.
+	WEIGHT = 5 # Value is the length of the name, which follows, and is followed by the weight as a double.
+	
+	# Opens the journal for the passed snapshot, which must exist, and which is saved in the passed format when compacting.
+	# Appends to the existing journal if it belongs to this snapshot, and replaces it otherwise.
+	# A final record which was only partly written, such as by a crash, is cut off first, so that new records follow the last complete one.
+	def __init__(self, fn, fmt, batch_size):
+		self.fn = fn
+		self.journal_fn = fn + ".journal"
+		self.fmt = fmt
+		self.batch_size = batch_size
+		
+		self.buffer = bytearray()
+		self.num_buffered = 0
+		
+		header = TagJournal.header(fn)
+		
+		if os.path.exists(self.journal_fn):
+			self.fout = open(self.journal_fn, "r+b")
+			data = self.fout.read()
+			
+			if data.startswith(header):
+				end = TagJournal.complete_length(data)
+				if end < len(data):
+					self.fout.truncate(end)
+					self.sync()
+				
+				self.fout.seek(end)
+				return
+			
+			self.fout.close()
+		
+		self.fout = open(self.journal_fn, "wb")
+		self.fout.write(header)
+		self.sync()
+	
+	# Returns the header of a journal for the passed snapshot.
+	def header(fn):
+		stat = os.stat(fn)
+		return JOURNAL_HEADER.pack(JOURNAL_MAGIC, stat.st_size, stat.st_mtime_ns)
+	
+	# Yields the operation, tag id, value and payload of every complete record in the passed journal, which begins with a header,
+	# along with the offset just past the record. A final record which was only partly written is left out.
+	def records(data):
+		offset = JOURNAL_HEADER.size
+		while offset + JOURNAL_RECORD.size <= len(data):
+			op, tag_id, value = JOURNAL_RECORD.unpack_from(data, offset)
+			start = offset + JOURNAL_RECORD.size
+			
+			end = start
+			if op == TagJournal.CREATE:
+				end += value
+			
+			elif op == TagJournal.WEIGHT:
+				end += value + 8
+			
+			if end > len(data):
+				return
+			
+			yield op, tag_id, value, data[start:end], end
+			offset = end
+	
+	# Returns the value and payload of a WEIGHT record setting the weight of the tag with the passed name.
+	def weight_payload(name, weight):
+		encoded = name.encode("utf-8")
+		return len(encoded), encoded + struct.pack("<d", weight)
+	
+	# Returns the length of the passed journal up to the end of its last complete record.
+	def complete_length(data):
+		end = JOURNAL_HEADER.size
+		for op, tag_id, value, payload, end in TagJournal.records(data):
+			pass
+		
+		return end
+	
+	# Buffers a record, flushing once enough have accumulated.
+	def write(self, op, tag_id, value=0, payload=b""):
+		self.buffer += JOURNAL_RECORD.pack(op, tag_id, value)
+		self.buffer += payload
+		
+		self.num_buffered += 1
+		if self.num_buffered >= self.batch_size:
+			self.flush()
+	
+	# Writes every buffered record with a single write, and waits for it to reach the disk.
+	def flush(self):
+		if self.num_buffered == 0:
+			return
+		
+		self.fout.write(self.buffer)
+		self.sync()
+		
+		self.buffer.clear()
+		self.num_buffered = 0
+	
+	def sync(self):
+		self.fout.flush()
+		os.fsync(self.fout.fileno())
+	
+	def close(self):
+		self.flush()
+		self.fout.close()
+
+# Waits for the entries of the passed directory, such as files just renamed into it, to reach the disk.
+# Does nothing where directories can't be opened, as on Windows.
+def sync_directory(path):
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	
+	except OSError:
+		return
+	
+	try:
+		os.fsync(fd)
+	
+	finally:
+		os.close(fd)
+
+# Unicode categories which must not appear in tag names.
+_INVALID_CATEGORIES = frozenset(("Zl", "Zp", "Cc", "Cf", "Cs", "Co", "Cn"))
+
+# Returns a lowercase, unicode-normalized version of the string.
+# Throws on invalid tags such as those containing control or non-printing characters, or any of the disallowed characters.
+# Results are cached, since the same names tend to be looked up over and over.
+@functools.lru_cache(maxsize=65536)
+def normalize_tag_name(tag, disallowed_chars=""):
+	tag = tag.strip().lower()
+	
+	# Printable ASCII is unchanged by NFKC normalization and contains no invalid categories.
+	if not (tag.isascii() and tag.isprintable()):
+		tag = unicodedata.normalize("NFKC", tag)
+		
+		for letter in tag:
+			if unicodedata.category(letter) in _INVALID_CATEGORIES:
+				raise ValueError(f"Tag name must not include control or formatting unicode characters such as U+{ord(letter):04X} ({unicodedata.category(letter)}).")
+	
+	if disallowed_chars:
+		for letter in tag:
+			if letter in disallowed_chars:
+				raise ValueError(f"Tag name must not include {letter}.")
+	
+	return tag
 
 class TagLibrary:
-	def __init__(self, fn, fmt="TAGLIB", disallowed_chars="", csv_name_col="name"):
+	def __init__(self, fn, fmt=None, disallowed_chars="", csv_name_col="name", name_index=False, lazy=False, journal=False):
 		self.root = TagNode()
 		self.next_id = 1
 		
 		self.disallowed_chars = disallowed_chars
 		
+		# Optional map from normalized names to tags, allowing exact lookups to skip the trie.
+		# Costs a dict entry per tag. The trie is still used for everything else.
+		self.name_index = {} if name_index else None
+		
+		# Transitive closures of the consequents and implicants of canonical tags, computed on demand.
+		# Whenever a tag is cached, so is every tag it (transitively) implies, or is implied by, respectively.
+		self.consequent_closures = {}
+		self.implicant_closures = {}
+		
+		# Canonical tags, ordered such that every tag comes after all the tags it implies.
+		# Each canonical tag's position is its "order". Tags which become aliases leave a None behind.
+		# Maintained incrementally (Pearce-Kelly), so that only the region between two tags is reordered when one comes to imply the other.
+		self.tag_order = []
+		
+		# Tagified trees of recently tagified expressions, by parsed tree and whether they were expanded. See tagify().
+		# Cleared whenever tags are created, aliased or canonized.
+		self.tagify_cache = TagExpressionCache()
+		
+		# TagJournal in which changes are recorded, if any. See open_journal().
+		self.journal = None
+		
+		# Set while the library is lazily loaded from a TAGLIB2 file. See load().
+		self.lazy = None # MappedTagLibrary from which subtrees and relations are read.
+		self.lazy_nodes = None # The tag at each position in the file, or None if its subtree has not been read.
+		self.lazy_positions = None # Maps each LazyTagNode to its position in the file.
+		
 		if fn is None:
 			return
 		
 		else:
-			self.load(fn, fmt=fmt, csv_name_col=csv_name_col)
+			self.load(fn, fmt=fmt, csv_name_col=csv_name_col, lazy=lazy)
+			
+			if journal:
+				self.open_journal(fn)
 	
 	# Returns a lowercase, unicode-normalized version of the string.
 	# Throws on invalid tags such as those containing the comma, parentheses, control, or non-printing characters.
 	def validate_and_normalize(self, tag):
-		tag = unicodedata.normalize("NFKC", tag.strip().lower())
-		
-		for letter in tag:
-			if unicodedata.category(letter) in ["Zl", "Zp", "Cc", "Cf", "Cs", "Co", "Cn"]:
-				raise ValueError(f"Tag name must not include control or formatting unicode characters such as U+{ord(letter):04X} ({unicodedata.category(letter)}).")
-			
-			if letter in self.disallowed_chars:
-				raise ValueError(f"Tag name must not include {letter}.")
-		
-		return tag
+		return normalize_tag_name(tag, self.disallowed_chars)
 	
 	# Create a new tag.
 	# Errors if the tag already exists.
 	def create(self, tag):
+		self.load_all()
+		
 		if self.next_id == 2**32:
 			raise RuntimeError("Tag limit exceeded!")
 		
 		#print(f"Creating {self.next_id}: {tag}.")
 		tag = self.validate_and_normalize(tag)
 		
-		current_node = self.root
-		cursor_i = 0
-		
-		while cursor_i < len(tag):
-			codepoint = ord(tag[cursor_i])
-			if codepoint not in current_node.children:
-				current_node.children[codepoint] = TagNode()
-			
-			current_node = current_node.children[codepoint]
-			cursor_i += 1
+		current_node = self.root.insert(tag)
 			
 		if current_node.tag_id is not None:
 			raise TagIntegrityError(f"Tag '{tag}' already exists.")
 		
-		current_node.tag_id = self.next_id
-		current_node.antecedents = []
-		current_node.implicants = []
-		current_node.consequents = []
+		self._register(current_node, tag)
+		return current_node
+	
+	# Create many tags at once, assigning them contiguous ids in the order they are passed.
+	# Names are normalized up-front and inserted in sorted order, so shared prefixes are walked only once.
+	# Returns a TagCreationReport instead of throwing on invalid or duplicate names.
+	def create_many(self, tags):
+		self.load_all()
+		
+		report = TagCreationReport()
+		
+		# Normalize everything first, remembering the position of each name so that ids follow the passed order.
+		positions = []
+		names = []
+		rejected = []
+		for tag_i, tag in enumerate(tags):
+			try:
+				names.append(self.validate_and_normalize(tag))
+				positions.append(tag_i)
+			
+			except ValueError as err:
+				rejected.append((tag_i, tag, err))
+		
+		if self.next_id + len(set(names)) > 2**32:
+			raise RuntimeError("Tag limit exceeded!")
+		
+		# The cyclic garbage collector would otherwise repeatedly scan the (acyclic) nodes allocated below.
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			self._create_sorted(names, positions, report, rejected)
+		
+		finally:
+			if gc_was_enabled:
+				gc.enable()
+		
+		rejected.sort(key=lambda rejection: rejection[0])
+		report.rejected = [(tag, err) for tag_i, tag, err in rejected]
+		
+		return report
+	
+	# Used by create_many() to create the passed normalized names.
+	def _create_sorted(self, names, positions, report, rejected):
+		nodes = [None] * len(names)
+		claimed = set()
+		
+		order = sorted(range(len(names)), key=names.__getitem__)
+		for name_i, node in zip(order, self._insert_sorted(names[name_i] for name_i in order)):
+			name = names[name_i]
+			
+			if node.tag_id is not None or node in claimed:
+				rejected.append((positions[name_i], name, TagIntegrityError(f"Tag '{name}' already exists.")))
+			
+			else:
+				claimed.add(node)
+				nodes[name_i] = node
+		
+		for name_i, node in enumerate(nodes):
+			if node is not None:
+				self._register(node, names[name_i])
+				report.created.append(node)
+	
+	# Yields the node for each of the passed names, which must be normalized and in sorted order, creating nodes as needed.
+	# Each insertion resumes from the deepest node shared with the previous name, so shared prefixes are walked only once.
+	def _insert_sorted(self, names):
+		path = [(0, self.root)]
+		prev_name = ""
+		for name in names:
+			# Every node on the path spells out a prefix of the previous name. Drop those which don't prefix this one.
+			while not name.startswith(prev_name[:path[-1][0]]):
+				path.pop()
+			
+			depth, node = path[-1]
+			yield node.insert(name[depth:], path, depth)
+			prev_name = name
+	
+	# Turns an empty node into a tag, assigning it the next available id.
+	# Used by create() and create_many() once the node for the passed (normalized) name has been found.
+	def _register(self, node, name):
+		self.tagify_cache.clear()
+		
+		node.tag_id = self.next_id
+		node.library = self
+		node.antecedents = TagRelationSet()
+		node.implicants = TagRelationSet()
+		node.consequents = TagRelationSet()
 		self.next_id += 1
 		
-		return current_node
+		node.order = len(self.tag_order)
+		self.tag_order.append(node)
+		
+		if self.name_index is not None:
+			self.name_index[name] = node
+		
+		if self.journal is not None:
+			self.journal.write(TagJournal.CREATE, node.tag_id, len(name.encode("utf-8")), name.encode("utf-8"))
 	
 	# Returns the node for the requested tag if it exists, or None if it doesn't
 	def has(self, tag):
 		tag = self.validate_and_normalize(tag)
 		
-		current_node = self.root
-		cursor_i = 0
+		# The index is only built once a lazily loaded library has been read in full.
+		if self.name_index is not None and self.lazy is None:
+			return self.name_index.get(tag)
+		
+		current_node = self.root.find(tag)
+		if current_node is None:
+			return None
 		
-		while cursor_i < len(tag):
-			codepoint = ord(tag[cursor_i])
-			if codepoint not in current_node.children:
-				return None
-			
-			current_node = current_node.children[codepoint]
-			cursor_i += 1
-
 		if current_node.tag_id is None:
 			return None
 		
 		return current_node
 	
 	# Returns the node for the requested tag.
-	# Throws if the tag does not exist.
-	def get(self, tag):
+	# Throws if the tag does not exist. If suggestions is nonzero, the error lists up to that many similarly-named tags.
+	def get(self, tag, suggestions=0, max_distance=2):
 		res = self.has(tag)
 		if res is None:
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("lookup_miss", name=tag)
+			
+			if suggestions > 0:
+				raise TagIdentificationError(f"No such tag '{tag}'.", [name for name, distance, node in self.fuzzy(tag, max_distance, suggestions)])
+			
 			raise TagIdentificationError(f"No such tag '{tag}'.")
 		
 		return res
 	
-	# Takes a TagExpression and converts all the leaf nodes into TagNode instances.
-	# Throws TagIdentificationError if one of those tags does not exist.
-	def tagify(self, tag_expr):
-		if type(tag_expr.root) is str:
-			tag_expr.root = self.get(tag_expr.root)
-			return
+	# Returns up to k (name, distance, tag) tuples for the tags whose names are within max_distance edits (Levenshtein distance) of the passed name.
+	# Sorted by distance, then name.
+	def fuzzy(self, tag, max_distance=2, k=10):
+		tag = self.validate_and_normalize(tag)
 		
-		opers_stack = [tag_expr.root]
-		num_iters = 0
-		while len(opers_stack) > 0:
-			num_iters += 1
-			if num_iters >= 10000: # Infinite iteration is possible if a TagOperation is (somehow) its own descendant.
-				raise RuntimeError(f"Max TagExpression complexity ({num_iters} operations) exceeded. Infinite loop?")
-			
-			oper = opers_stack.pop()
-			print(f"On {oper}...")
-			
-			if isinstance(oper, TagUnaryOperator):
-				if type(oper.right) is str:
-					oper.right = self.get(oper.right)
-				
-				else:
-					opers_stack.append(oper.right)
+		# Walks the trie one character at a time, keeping the row of the edit distance table for the name spelled out so far.
+		# Branches are abandoned once every entry in the row exceeds the bound, since the distance can only grow from there.
+		# The bound shrinks as soon as k results have been found within a smaller distance.
+		bound = max_distance
+		found_per_distance = [0] * (max_distance + 1)
+		results = []
+		
+		# Only entries within bound of the diagonal can be within bound, so the rest are left at max_distance + 1.
+		too_far = max_distance + 1
+		first_row = [min(tag_i, too_far) for tag_i in range(len(tag) + 1)]
+		if self.root.tag_id is not None and first_row[-1] <= bound:
+			results.append(("", first_row[-1], self.root))
+		
+		stack = [(child, child.key, first_row) for child in self.root.children.values()]
+		while len(stack) > 0:
+			node, name, row = stack.pop()
+			name_len = len(name) - len(node.key)
 			
-			elif isinstance(oper, TagBinaryOperator):
-				if type(oper.right) is str:
-					oper.right = self.get(oper.right)
+			for letter in node.key:
+				name_len += 1
+				prev_row = row
+				row = [too_far] * (len(tag) + 1)
+				if name_len <= bound:
+					row[0] = name_len
 				
-				else:
-					opers_stack.append(oper.right)
+				row_min = row[0]
+				for tag_i in range(max(0, name_len - bound - 1), min(len(tag), name_len + bound)):
+					distance = min(
+						prev_row[tag_i + 1] + 1, # Deletion
+						row[tag_i] + 1, # Insertion
+						prev_row[tag_i] + (tag[tag_i] != letter) # Substitution
+					)
+					
+					if distance < row[tag_i + 1]:
+						row[tag_i + 1] = distance
+						if distance < row_min:
+							row_min = distance
 				
-				if type(oper.left) is str:
-					oper.left = self.get(oper.left)
+				if row_min > bound:
+					break
+			
+			else:
+				distance = row[-1]
+				if node.tag_id is not None and distance <= bound:
+					results.append((name, distance, node))
+					
+					# Tighten the bound once k results are known to lie within it.
+					found_per_distance[distance] += 1
+					total_found = 0
+					for bound_distance in range(bound + 1):
+						total_found += found_per_distance[bound_distance]
+						if total_found >= k:
+							bound = bound_distance
+							break
 				
-				else:
-					opers_stack.append(oper.left)
+				for child in node.children.values():
+					stack.append((child, name + child.key, row))
+		
+		results = [result for result in results if result[1] <= bound]
+		results.sort(key=lambda result: (result[1], result[0]))
+		return results[:k]
+	
+	# Sets the weight used to rank the passed tag in complete().
+	def set_weight(self, tag, weight):
+		self.load_all()
+		
+		tag = self.validate_and_normalize(tag)
+		
+		path = [self.root]
+		node = self.root.find(tag, path)
+		if node is None or node.tag_id is None:
+			raise TagIdentificationError(f"No such tag '{tag}'.")
+		
+		node.weight = weight
+		for path_node in reversed(path):
+			path_node.update_max_weight()
+		
+		if self.journal is not None:
+			self.journal.write(TagJournal.WEIGHT, node.tag_id, *TagJournal.weight_payload(tag, weight))
+	
+	# Returns up to k (name, tag) pairs for the highest-weighted tags whose names start with the passed prefix.
+	# Each tag is replaced with its canonical form, and each canonical form appears only once.
+	# Ties are broken alphabetically by name.
+	def complete(self, prefix, k=10):
+		prefix = self.validate_and_normalize(prefix)
+		
+		node, name = self.root.find_prefix(prefix)
+		if node is None:
+			return []
+		
+		# Best-first search. Subtrees are ranked by max_weight, so they are only expanded while they could still contain a result.
+		# Entries are (-weight, name, is_subtree, node). Names are unique per node, so nodes are never compared.
+		heap = [(-node.max_weight, name, True, node)]
+		results = []
+		seen = set()
+		while len(heap) > 0 and len(results) < k:
+			neg_weight, name, is_subtree, node = heapq.heappop(heap)
+			
+			if is_subtree:
+				if node.tag_id is not None:
+					heapq.heappush(heap, (-node.weight, name, False, node))
 				
+				for child in node.children.values():
+					heapq.heappush(heap, (-child.max_weight, name + child.key, True, child))
+			
 			else:
+				canon = node.get_canon()
+				if canon not in seen:
+					seen.add(canon)
+					results.append((name, canon))
+		
+		return results
+	
+	# Takes a TagExpression and converts all the leaf nodes into TagNode instances.
+	# Throws TagIdentificationError if one of those tags does not exist. If suggestions is nonzero, the error lists up to that many similarly-named tags.
+	# The expression's tree is replaced rather than modified, since parsed trees are shared (see TagExpression.cache).
+	# Tagified trees are cached by the tree they were made from until tags are next created, aliased or canonized, so tagifying a repeated query is a single lookup.
+	# If expand is true, every tag is wrapped in a TagExpansion, so that it also matches its aliases and every tag which implies it.
+	def tagify(self, tag_expr, suggestions=0, max_distance=2, expand=False):
+		root = tag_expr.root
+		
+		tagified = self.tagify_cache.get((root, expand))
+		if tagified is None:
+			tagified = self.tagified(root, suggestions, max_distance, expand)
+			self.tagify_cache[(root, expand)] = tagified
+		
+		tag_expr.root = tagified
+	
+	# Returns a copy of the passed tree in which every string is replaced by its tag, or by a TagExpansion of it if expand is true. Used by tagify().
+	# Subexpressions which contain no strings (or when expanding, no unexpanded tags) are shared with the passed tree rather than copied.
+	def tagified(self, root, suggestions=0, max_distance=2, expand=False):
+		# Returns the tagified form of the passed leaf.
+		def leaf(operand):
+			if type(operand) is str:
+				operand = self.get(operand, suggestions, max_distance)
+			
+			if expand and type(operand) is not TagExpansion:
+				return TagExpansion(operand)
+			
+			return operand
+		
+		if not isinstance(root, TagOperator):
+			return leaf(root)
+		
+		# Walk the tree in post-order without recursing, since expressions may be nested arbitrarily deeply.
+		results = {}
+		ancestors = set() # Operators whose operands are still being tagified.
+		stack = [root]
+		while len(stack) > 0:
+			oper = stack[-1]
+			if oper in results:
+				stack.pop()
+				continue
+			
+			operands = (oper.left, oper.right) if isinstance(oper, TagBinaryOperator) else (oper.right,)
+			if not isinstance(oper, (TagUnaryOperator, TagBinaryOperator)):
 				raise TypeError(f"No such operation '{oper}'.")
+			
+			pending = [operand for operand in operands if isinstance(operand, TagOperator) and operand not in results]
+			if len(pending) > 0:
+				if any(operand in ancestors for operand in pending):
+					raise RuntimeError(f"TagOperator {oper} is its own descendant.")
+				
+				ancestors.add(oper)
+				stack.extend(reversed(pending))
+				continue
+			
+			stack.pop()
+			ancestors.discard(oper)
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("tagify", operator=oper)
+			
+			operands = [results[operand] if isinstance(operand, TagOperator) else leaf(operand) for operand in operands]
+			if isinstance(oper, TagBinaryOperator):
+				results[oper] = oper.with_operands(*operands)
+			
+			elif operands[0] is oper.right:
+				results[oper] = oper
+			
+			else:
+				results[oper] = type(oper)(operands[0])
+		
+		return results[root]
 	
-	# Saves this library at the passed filename
+	# Saves this library at the passed filename.
+	# TAGLIB is the original format. TAGLIB2 is a versioned, columnar format which also stores weights and has no limit on the number of relations per tag.
 	def save(self, fn, fmt="TAGLIB"):
-		if fmt not in ["CSV", "TAGLIB"]:
-			raise RuntimeError(f"Unknown TagLibrary format '{fmt}', must be one of 'CSV', 'TAGLIB'.")
+		if fmt not in ["CSV", "TAGLIB", "TAGLIB2"]:
+			raise RuntimeError(f"Unknown TagLibrary format '{fmt}', must be one of 'CSV', 'TAGLIB', 'TAGLIB2'.")
+			
+		self.load_all()
+		
+		# Overwriting a journaled snapshot would leave its journal applying to a file which no longer exists.
+		if self.journal is not None and fmt != "CSV" and os.path.abspath(fn) == os.path.abspath(self.journal.fn):
+			self.compact(fmt)
+			return
+		
+		if fmt == "CSV":
+			with open(fn, "w", newline="") as fout:
+				self._save_csv(fout)
 			
+			return
+		
 		with open(fn, "wb") as fout:
 			if fmt == "TAGLIB":
 				fout.write(self.next_id.to_bytes(4))
+				self.root.save(fout)
+			
+			elif fmt == "TAGLIB2":
+				self._save_v2(fout)
+	
+	# Writes this library to the passed text file as CSV, with one row per tag in order of id, so that loading it into an empty library gives every tag the same id.
+	# Rows are written as they are formatted, from a list of the tags indexed by id, rather than from a sorted copy of items().
+	# Columns are name, id, canonical, consequents and implicants. Relations are written as space-separated ids, and only canonical tags have any.
+	def _save_csv(self, fout):
+		csv_out = csv.writer(fout)
+		csv_out.writerow(["name", "id", "canonical", "consequents", "implicants"])
+		
+		entries = [None] * self.next_id
+		for name, tag in self.items():
+			entries[tag.tag_id] = (name, tag)
+		
+		for name, tag in filter(None, entries):
+			csv_out.writerow([
+				name,
+				tag.tag_id,
+				"" if tag.canonical is None else tag.canonical.tag_id,
+				" ".join(str(consequent.tag_id) for consequent in tag.consequents),
+				" ".join(str(implicant.tag_id) for implicant in tag.implicants),
+			])
+	
+	# Writes this library to the passed file in the TAGLIB2 format. See taglib2_sections().
+	def _save_v2(self, fout):
+		entries = sorted(self.items(), key=lambda entry: entry[0])
+		positions = {tag: position for position, (name, tag) in enumerate(entries)}
+		
+		sections = {}
+		sections["ids"] = array.array("I", (tag.tag_id for name, tag in entries))
+		
+		names = bytearray()
+		name_offsets = array.array("I", [0])
+		for name, tag in entries:
+			names += name.encode("utf-8")
+			name_offsets.append(len(names))
+		
+		sections["name_offsets"] = name_offsets
+		sections["names"] = names
+		
+		sections["canonical"] = array.array("I", (TAGLIB2_NONE if tag.canonical is None else positions[tag.canonical] for name, tag in entries))
+		sections["weights"] = array.array("d", (tag.weight for name, tag in entries))
+		
+		for relation in ("antecedent", "implicant", "consequent"):
+			offsets = array.array("I", [0])
+			values = array.array("I")
+			for name, tag in entries:
+				values.extend(positions[other] for other in getattr(tag, relation + "s"))
+				offsets.append(len(values))
 			
-			elif fmt == "CSV":
-				raise NotImplementedError()
+			sections[relation + "_offsets"] = offsets
+			sections[relation + "s"] = values
+		
+		fout.write(TAGLIB2_HEADER.pack(TAGLIB2_MAGIC, self.next_id, len(entries), len(names), len(sections["antecedents"]), len(sections["implicants"]), len(sections["consequents"])))
+		
+		for name, typecode, length in taglib2_sections(len(entries), len(names), len(sections["antecedents"]), len(sections["implicants"]), len(sections["consequents"])):
+			section = sections[name]
+			if sys.byteorder == "big" and typecode != "B":
+				section = array.array(typecode, section)
+				section.byteswap()
 			
-			self.root.save(fout)
+			data = memoryview(section).cast("B")
+			fout.write(data)
+			fout.write(bytes(-len(data) % 8))
 	
 	# Load from file. Accepts taglib files as well as CSV files.
-	# In the case of a CSV file, the csv_name_col parameter gives the name of the column to extract tags from.
-	def load(self, fn, fmt="TAGLIB", csv_name_col="name", _fin=None):
-		if fmt not in ["CSV", "TAGLIB"]:
-			raise RuntimeError(f"Unknown TagLibrary format '{fmt}', must be one of 'CSV', 'TAGLIB'.")
+	# If fmt is None, the format is detected from the file's magic number, and must be either TAGLIB or TAGLIB2.
+	# In the case of a CSV file, the csv_name_col parameter gives the name of the column to extract tags from, and a TagCreationReport listing any rejected names is returned.
+	# If lazy is true, the file must be in the TAGLIB2 format. It is memory-mapped, and each subtree of the root is only read the first time something descends into it. See load_all().
+	def load(self, fn, fmt=None, csv_name_col="name", lazy=False, _fin=None):
+		if fmt not in [None, "CSV", "TAGLIB", "TAGLIB2"]:
+			raise RuntimeError(f"Unknown TagLibrary format '{fmt}', must be one of 'CSV', 'TAGLIB', 'TAGLIB2'.")
 		
-		# Call slef with context manager.
-		if _fin is None:
-			if fmt == "TAGLIB":
-				with open(fn, "rb") as fin:
-					return self.load(fn=None, fmt="TAGLIB", csv_name_col=csv_name_col, _fin=fin)
+		# Finish reading any library this one was lazily loaded from, which may be added to or replaced.
+		self.load_all()
+		self.tagify_cache.clear()
+		
+		if lazy:
+			if fmt not in [None, "TAGLIB2"]:
+				raise RuntimeError(f"Only TAGLIB2 files can be loaded lazily, not '{fmt}'.")
 			
-			elif fmt == "CSV":
+			self._load_lazy(fn)
+			self._replay_journal(fn)
+			return None
+		
+		# Call self with context manager.
+		if _fin is None:
+			if fmt == "CSV":
 				with open(fn, "r", newline="") as fin:
 					return self.load(fn=None, fmt="CSV", csv_name_col=csv_name_col, _fin=fin)
 			
 			else:
-				raise RuntimeError("Invalid format.")
+				with open(fn, "rb") as fin:
+					report = self.load(fn=None, fmt=fmt, csv_name_col=csv_name_col, _fin=fin)
+				
+				self._replay_journal(fn)
+				return report
 		
 		fin = _fin
+		report = None
+		
+		if fmt is None:
+			magic = fin.read(len(TAGLIB2_MAGIC))
+			fin.seek(-len(magic), io.SEEK_CUR)
+			
+			fmt = "TAGLIB2" if magic == TAGLIB2_MAGIC else "TAGLIB"
 		
 		if fmt == "TAGLIB":
 			self.next_id = int.from_bytes(fin.read(4))
 			self.root = TagNode(fin)
+			self._resolve_relation_ids()
+		
+		elif fmt == "TAGLIB2":
+			self._load_v2(fin)
 		
 		elif fmt == "CSV":
-			csv_in = csv.DictReader(fin)
-			error_count = 0
-			for row in csv_in:
+			report = self._load_csv(fin, csv_name_col)
+			
+		else:
+			raise RuntimeError("Invalid format.")
+		
+		if self.name_index is not None:
+			self.name_index = dict(self.items())
+		
+		self.consequent_closures = {}
+		self.implicant_closures = {}
+		
+		# _load_csv() sorts before journaling the relations it adds.
+		if fmt != "CSV":
+			self.sort_tag_order()
+		
+		return report
+	
+	# Used by load() to create a tag for every row of a CSV file, then add the aliases and implications given by its canonical, consequents and implicants columns, if present.
+	# Relations refer to other rows by the value in their id column, and are added directly rather than one at a time. The topological order is rebuilt afterwards.
+	# If the implications turn out to contain a cycle, they are added again one at a time as imply() would, and those which would close a cycle are rejected.
+	# Returns a TagCreationReport. Relations which can't be added are listed alongside rejected names, as the name of the row they appear in and the reason.
+	def _load_csv(self, fin, csv_name_col):
+		csv_in = csv.DictReader(fin)
+		rows = list(csv_in)
+		
+		report = self.create_many(row[csv_name_col] for row in rows)
+		if "id" not in (csv_in.fieldnames or []):
+			self.sort_tag_order()
+			return report
+		
+		# Match rows to the tags created for them. Of several rows with the same name, only the first is created.
+		unclaimed = set(report.created)
+		nodes = []
+		for row in rows:
+			try:
+				node = self.has(row[csv_name_col])
+			
+			except ValueError:
+				node = None
+			
+			if node in unclaimed:
+				unclaimed.remove(node)
+				nodes.append(node)
+			
+			else:
+				nodes.append(None)
+		
+		nodes_by_id = {row["id"].strip(): node for row, node in zip(rows, nodes) if node is not None}
+		aliased = [] # Aliases to journal.
+		implied = [] # The name of the row, implicant and consequent of each implication, to journal once they are known not to form a cycle.
+		
+		# Yields the tag for every id in the passed column of the passed row, rejecting those which aren't known.
+		def related(row, column):
+			for related_id in (row.get(column) or "").split():
+				node = nodes_by_id.get(related_id)
+				if node is None:
+					report.rejected.append((row[csv_name_col], TagIdentificationError(f"No tag with id {related_id}, listed in the {column} column.")))
+				
+				else:
+					yield node
+		
+		for row, node in zip(rows, nodes):
+			if node is None:
+				continue
+			
+			for canonical in related(row, "canonical"):
+				if canonical is node:
+					continue
+				
+				if canonical.canonical is not None or len(node.antecedents) > 0:
+					report.rejected.append((row[csv_name_col], TagIntegrityError(f"Can not alias tag '{node.tag_id}' to '{canonical.tag_id}', since only canonical tags may have aliases.")))
+					continue
+				
+				node.canonical = canonical
+				canonical.antecedents.add(node)
+				aliased.append((node, canonical))
+		
+		for row, node in zip(rows, nodes):
+			if node is None:
+				continue
+			
+			implications = [(node, consequent) for consequent in related(row, "consequents")]
+			implications.extend((implicant, node) for implicant in related(row, "implicants"))
+			
+			for implicant, consequent in implications:
+				implicant = implicant.get_canon()
+				consequent = consequent.get_canon()
+				
+				if implicant is consequent:
+					report.rejected.append((row[csv_name_col], TagIntegrityError(f"Tag '{implicant.tag_id}' can not imply itself.")))
+				
+				elif consequent not in implicant.consequents:
+					implicant.consequents.add(consequent)
+					consequent.implicants.add(implicant)
+					implied.append((row[csv_name_col], implicant, consequent))
+		
+		try:
+			self.sort_tag_order()
+		
+		except TagIntegrityError:
+			# Undo every implication, leaving the library as it was apart from the new tags and aliases, which can't form a cycle.
+			for name, implicant, consequent in implied:
+				implicant.consequents.remove(consequent)
+				consequent.implicants.remove(implicant)
+			
+			self.sort_tag_order()
+			
+			# Then add them back with the same check imply() makes, keeping the topological order as it goes.
+			accepted = []
+			for name, implicant, consequent in implied:
 				try:
-					new_tag = row[csv_name_col]
-					self.create(new_tag)
+					self.order_implication(implicant, consequent)
 				
-				except ValueError as err:
-					print(f"Failed to create tag '{row[csv_name_col]}'. Got error: {err.args[0]}")
-					error_count += 1
+				except TagIntegrityError as error:
+					report.rejected.append((name, error))
+					continue
 				
-				except TagIntegrityError as err:
-					print(f"Failed to create tag '{row[csv_name_col]}'. Got error: {err.args[0]}")
-					error_count += 1
+				implicant.consequents.add(consequent)
+				consequent.implicants.add(implicant)
+				accepted.append((name, implicant, consequent))
 			
-			print(f"Failed to load {error_count} tags.")
+			implied = accepted
+		
+		if self.journal is not None:
+			for tag, other in aliased:
+				self.journal.write(TagJournal.ALIAS, tag.tag_id, other.tag_id)
 			
-		else:
-			raise RuntimeError("Invalid format.")
+			for name, tag, other in implied:
+				self.journal.write(TagJournal.IMPLY, tag.tag_id, other.tag_id)
+		
+		return report
+	
+	# Begins recording every change to this library in a journal next to the passed snapshot, named fn + ".journal".
+	# The snapshot is saved first if it doesn't exist. Loading the snapshot replays the journal, so an existing journal is kept only if it was written against this snapshot.
+	# Changes are written in batches of batch_size. Call flush() to write them sooner, and compact() to fold the journal into a new snapshot.
+	def open_journal(self, fn, batch_size=1000):
+		self.close_journal()
+		self.load_all()
+		
+		if not os.path.exists(fn):
+			self.save(fn, fmt="TAGLIB2")
+		
+		# Compaction keeps the snapshot's format.
+		with open(fn, "rb") as fin:
+			fmt = "TAGLIB2" if fin.read(len(TAGLIB2_MAGIC)) == TAGLIB2_MAGIC else "TAGLIB"
+		
+		self.journal = TagJournal(fn, fmt, batch_size)
+	
+	# Writes and syncs any buffered journal records.
+	def flush(self):
+		if self.journal is not None:
+			self.journal.flush()
+	
+	# Flushes and stops recording changes in the journal, if one is open.
+	def close_journal(self):
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+	
+	# Saves a new snapshot which includes every change recorded in the journal, then starts a new, empty journal.
+	# Both are written to temporary files and renamed into place, snapshot first. A journal whose header doesn't match the snapshot is ignored when loading, so an interrupted compaction loses nothing.
+	# TAGLIB snapshots don't store weights, so when compacting to one, the new journal begins with a record of every weight which isn't 0.
+	def compact(self, fmt=None):
+		if self.journal is None:
+			raise RuntimeError("No journal is open.")
+		
+		journal = self.journal
+		journal.flush()
+		
+		fmt = journal.fmt if fmt is None else fmt
 		
-		# Convert all integer relations to TagNodes
+		# Saving the snapshot must not itself be journaled.
+		self.journal = None
+		try:
+			self.save(journal.fn + ".tmp", fmt)
+			with open(journal.fn + ".tmp", "rb") as fin:
+				os.fsync(fin.fileno())
+			
+			with open(journal.journal_fn + ".tmp", "wb") as fout:
+				fout.write(TagJournal.header(journal.fn + ".tmp"))
+				if fmt == "TAGLIB":
+					for name, tag in self.items():
+						if tag.weight != 0:
+							value, payload = TagJournal.weight_payload(name, tag.weight)
+							fout.write(JOURNAL_RECORD.pack(TagJournal.WEIGHT, tag.tag_id, value) + payload)
+				
+				fout.flush()
+				os.fsync(fout.fileno())
+		
+		except Exception:
+			self.journal = journal
+			raise
+		
+		journal.close()
+		os.replace(journal.fn + ".tmp", journal.fn)
+		os.replace(journal.journal_fn + ".tmp", journal.journal_fn)
+		sync_directory(os.path.dirname(os.path.abspath(journal.fn)))
+		
+		self.journal = TagJournal(journal.fn, fmt, journal.batch_size)
+	
+	# Used by load() to apply the changes recorded in the journal of the passed snapshot, if it has one.
+	# A journal written against some other snapshot, such as one since replaced by compact(), is ignored, as is a final record which was only partly written.
+	def _replay_journal(self, fn):
+		if not os.path.exists(fn + ".journal"):
+			return
+		
+		with open(fn + ".journal", "rb") as fin:
+			data = fin.read()
+		
+		if not data.startswith(TagJournal.header(fn)):
+			return
+		
+		# Changes made while replaying are already in the journal.
+		journal = self.journal
+		self.journal = None
+		
+		try:
+			tags = None
+			for op, tag_id, value, payload, end in TagJournal.records(data):
+				if op == TagJournal.CREATE or op == TagJournal.WEIGHT:
+					name = str(payload[:value], "utf-8")
+					
+					if op == TagJournal.CREATE:
+						tag = self.create(name)
+						if tag.tag_id != tag_id:
+							raise TagIntegrityError(f"Journal created tag '{name}' with id {tag_id}, but replaying it gave id {tag.tag_id}.")
+						
+						if tags is not None:
+							tags[tag_id] = tag
+					
+					else:
+						self.set_weight(name, struct.unpack_from("<d", payload, value)[0])
+					
+					continue
+				
+				if tags is None:
+					tags = {tag.tag_id: tag for tag in self}
+				
+				if op == TagJournal.ALIAS:
+					tags[tag_id].alias(tags[value])
+				
+				elif op == TagJournal.IMPLY:
+					tags[tag_id].imply(tags[value])
+				
+				elif op == TagJournal.CANONIZE:
+					tags[tag_id].canonize()
+				
+				else:
+					raise TagIntegrityError(f"Unknown journal operation {op}.")
+		
+		finally:
+			self.journal = journal
+	
+	# Used by load() to convert the integer relations read from a TAGLIB file into TagNodes.
+	def _resolve_relation_ids(self):
 		all_tags = [None] * self.next_id
 		for tag in self:
 			all_tags[tag.tag_id] = tag
 		
 		for tag in self:
+			tag.library = self
+			
 			if tag.canonical is not None:
 				tag.canonical = all_tags[tag.canonical]
 			
-			for antecedent_i in range(len(tag.antecedents)):
-				tag.antecedents[antecedent_i] = all_tags[tag.antecedents[antecedent_i]]
+			tag.antecedents = TagRelationSet.fromkeys(all_tags[antecedent_id] for antecedent_id in tag.antecedents)
+			tag.implicants = TagRelationSet.fromkeys(all_tags[implicant_id] for implicant_id in tag.implicants)
+			tag.consequents = TagRelationSet.fromkeys(all_tags[consequent_id] for consequent_id in tag.consequents)
+	
+	# Reads a library in the TAGLIB2 format from the passed file, replacing the trie. See taglib2_sections().
+	# Each section is read with a single call. Since tags are stored sorted by name, the trie is built without sorting, and relations are resolved by position without searching the trie.
+	def _load_v2(self, fin):
+		header = fin.read(TAGLIB2_HEADER.size)
+		if len(header) < TAGLIB2_HEADER.size:
+			raise ValueError("EOF reached unexpectedly!")
+		
+		magic, next_id, num_tags, *lengths = TAGLIB2_HEADER.unpack(header)
+		if magic != TAGLIB2_MAGIC:
+			raise ValueError("Not a TAGLIB2 file.")
+		
+		sections = {}
+		for name, typecode, length in taglib2_sections(num_tags, *lengths):
+			section = array.array(typecode)
+			size = length * section.itemsize
+			
+			data = fin.read(size + (-size % 8))
+			if len(data) < size:
+				raise ValueError("EOF reached unexpectedly!")
+			
+			section.frombytes(data[:size])
+			if sys.byteorder == "big":
+				section.byteswap()
+			
+			sections[name] = section
+		
+		names = memoryview(sections["names"])
+		name_offsets = sections["name_offsets"]
+		
+		self.next_id = next_id
+		self.root = TagNode()
+		
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			tags = list(self._insert_sorted(str(names[name_offsets[position] : name_offsets[position + 1]], "utf-8") for position in range(num_tags)))
+			
+			for tag, tag_id, weight in zip(tags, sections["ids"], sections["weights"]):
+				if tag.tag_id is not None:
+					raise ValueError(f"Tag {tag_id} has the same name as tag {tag.tag_id}.")
+				
+				tag.tag_id = tag_id
+				tag.library = self
+				tag.weight = weight
+			
+			for position, canonical in enumerate(sections["canonical"]):
+				if canonical != TAGLIB2_NONE:
+					tags[position].canonical = tags[canonical]
+			
+			for relation in ("antecedent", "implicant", "consequent"):
+				offsets = sections[relation + "_offsets"]
+				values = sections[relation + "s"]
+				
+				for position, tag in enumerate(tags):
+					setattr(tag, relation + "s", TagRelationSet.fromkeys(map(tags.__getitem__, values[offsets[position] : offsets[position + 1]])))
+		
+		finally:
+			if gc_was_enabled:
+				gc.enable()
+		
+		if any(sections["weights"]):
+			self.root.update_max_weights()
+	
+	# Used by load() to begin lazily loading the passed TAGLIB2 file, replacing the trie.
+	# Only the header is read, and the extent of each subtree of the root is found by binary search. Names are sorted, so each subtree is a contiguous range of positions.
+	def _load_lazy(self, fn):
+		from .MappedTagLibrary import MappedTagLibrary
+		
+		source = MappedTagLibrary(fn)
+		
+		self.lazy = source
+		self.lazy_nodes = [None] * source.num_tags
+		self.lazy_positions = {}
+		
+		self.next_id = source.next_id
+		self.root = TagNode()
+		self.tag_order = []
+		
+		self.consequent_closures = {}
+		self.implicant_closures = {}
+		
+		# The root is a tag if the empty name is. It sorts first.
+		position = 0
+		if source.num_tags > 0 and source.name_bytes(0) == b"":
+			self._load_lazy_tag(self.root, 0)
+			position = 1
+		
+		pending = {}
+		while position < source.num_tags:
+			# No UTF-8 sequence contains 0xFF, so every name beginning with this character sorts before this key.
+			first = str(source.name_bytes(position), "utf-8")[0]
+			end = source.bisect(first.encode("utf-8") + b"\xff")
+			
+			pending[ord(first)] = (position, end)
+			position = end
+		
+		self.root.children = LazyChildren(self, pending)
+		self.root.max_weight = max(self.root.weight, max(source.sections["weights"], default=0))
+	
+	# Reads the tags at the passed range of positions in a lazily loaded file, which must make up an entire subtree of the root.
+	# Their relations are read later, by resolve_lazy().
+	def load_subtree(self, start, end):
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			names = [str(self.lazy.name_bytes(position), "utf-8") for position in range(start, end)]
+			
+			for position, tag in zip(range(start, end), self._insert_sorted(names)):
+				self._load_lazy_tag(tag, position)
+		
+		finally:
+			if gc_was_enabled:
+				gc.enable()
+		
+		dict.get(self.root.children, ord(names[0][0])).update_max_weights()
+	
+	# Turns the passed empty node into a LazyTagNode for the tag at the passed position in a lazily loaded file.
+	def _load_lazy_tag(self, tag, position):
+		tag.__class__ = LazyTagNode
+		tag.tag_id = self.lazy.sections["ids"][position]
+		tag.library = self
+		tag.weight = self.lazy.sections["weights"][position]
+		
+		self.lazy_nodes[position] = tag
+		self.lazy_positions[tag] = position
+	
+	# Returns the tag at the passed position in a lazily loaded file, reading its subtree if necessary.
+	def lazy_node(self, position):
+		tag = self.lazy_nodes[position]
+		if tag is None:
+			self.root.children.load(ord(str(self.lazy.name_bytes(position), "utf-8")[0]))
+			tag = self.lazy_nodes[position]
+		
+		return tag
+	
+	# Reads the canonical form and relations of the passed LazyTagNode, turning it into an ordinary TagNode.
+	def resolve_lazy(self, tag):
+		position = self.lazy_positions.pop(tag)
+		sections = self.lazy.sections
+		
+		tag.__class__ = TagNode
+		
+		canonical = sections["canonical"][position]
+		tag.canonical = None if canonical == TAGLIB2_NONE else self.lazy_node(canonical)
+		
+		for relation in ("antecedent", "implicant", "consequent"):
+			offsets = sections[relation + "_offsets"]
+			setattr(tag, relation + "s", TagRelationSet.fromkeys(map(self.lazy_node, sections[relation + "s"][offsets[position] : offsets[position + 1]])))
+	
+	# Reads everything not yet read from the file a library was lazily loaded from, then unmaps it.
+	# Called before anything which modifies the library or needs its topological order. Does nothing if the library is not being lazily loaded.
+	def load_all(self):
+		if self.lazy is None:
+			return
+		
+		self.root.children.load_all()
+		for tag in list(self.lazy_positions):
+			self.resolve_lazy(tag)
+		
+		self.root.children = dict(sorted(dict.items(self.root.children))) or _NO_CHILDREN
+		
+		self.lazy.close()
+		self.lazy = None
+		self.lazy_nodes = None
+		self.lazy_positions = None
+		
+		if self.name_index is not None:
+			self.name_index = dict(self.items())
+		
+		self.sort_tag_order()
+	
+	# Yields every canonical tag after all the tags it implies, or before them if reverse is true.
+	def topological_order(self, reverse=False):
+		self.load_all()
+		
+		for tag in (reversed(self.tag_order) if reverse else self.tag_order):
+			if tag is not None:
+				yield tag
+	
+	# Rebuilds tag_order from scratch, removing any gaps left by aliased tags.
+	# Throws TagIntegrityError if the implications contain a cycle.
+	def sort_tag_order(self):
+		self.tag_order = []
+		
+		# Kahn's algorithm. A tag is ready once every tag it implies has been placed.
+		num_unplaced = {}
+		ready = []
+		for tag in self:
+			tag.order = None
+			if tag.canonical is None:
+				num_unplaced[tag] = len(tag.consequents)
+				if len(tag.consequents) == 0:
+					ready.append(tag)
+		
+		while len(ready) > 0:
+			tag = ready.pop()
+			tag.order = len(self.tag_order)
+			self.tag_order.append(tag)
+			
+			for implicant in tag.implicants:
+				num_unplaced[implicant] -= 1
+				if num_unplaced[implicant] == 0:
+					ready.append(implicant)
+		
+		if len(self.tag_order) != len(num_unplaced):
+			raise TagIntegrityError(f"Implications contain a cycle involving {len(num_unplaced) - len(self.tag_order)} tags.")
+	
+	# Updates tag_order such that the passed consequent comes before the passed (canonical) tag, in preparation for the tag implying it.
+	# Throws TagIntegrityError if the consequent already implies the tag, in which case tag_order is left unchanged.
+	def order_implication(self, tag, consequent):
+		self.load_all()
+		
+		lower = tag.order
+		upper = consequent.order
+		if upper < lower:
+			return
+		
+		# Only tags positioned between the two need to move.
+		# Find the tags which (transitively) imply the tag, and which must therefore move after the consequent along with it.
+		forward = [tag]
+		visited = {tag}
+		stack = [tag]
+		while len(stack) > 0:
+			for implicant in stack.pop().implicants:
+				if implicant is consequent:
+					raise TagIntegrityError(f"Tag {tag.tag_id} cannot imply {consequent.tag_id}, which already implies it!")
+				
+				if implicant.order < upper and implicant not in visited:
+					visited.add(implicant)
+					forward.append(implicant)
+					stack.append(implicant)
+		
+		# Find the tags which the consequent (transitively) implies, and which must therefore move before the tag along with it.
+		backward = [consequent]
+		visited = {consequent}
+		stack = [consequent]
+		while len(stack) > 0:
+			for next_consequent in stack.pop().consequents:
+				if next_consequent.order > lower and next_consequent not in visited:
+					visited.add(next_consequent)
+					backward.append(next_consequent)
+					stack.append(next_consequent)
+		
+		# Reuse the same positions, placing every backward tag before every forward tag and otherwise keeping their relative order.
+		forward.sort(key=lambda node: node.order)
+		backward.sort(key=lambda node: node.order)
+		moved = backward + forward
+		
+		positions = sorted(node.order for node in moved)
+		for node, position in zip(moved, positions):
+			node.order = position
+			self.tag_order[position] = node
+	
+	# Merges the alias groups of the two passed tags. Used by TagNode.alias().
+	# Alias groups form a union-find structure in which every alias points directly at its canonical form, so get_canon() never follows a chain.
+	# Groups are merged by size: the smaller group's aliases are re-pointed and its canonical form's implications moved, so merging two large groups costs time proportional to the smaller one.
+	def merge_aliases(self, a, b):
+		self.load_all()
+		
+		a_canon = a.get_canon()
+		b_canon = b.get_canon()
+		if a_canon is b_canon:
+			return
+		
+		self.check_alias_order(a_canon, b_canon)
+		self.tagify_cache.clear()
+		
+		if len(a_canon.antecedents) > len(b_canon.antecedents):
+			canon, old_canon = a_canon, b_canon
+		
+		else:
+			canon, old_canon = b_canon, a_canon
+		
+		for antecedent in old_canon.antecedents:
+			antecedent.canonical = canon
+			canon.antecedents.add(antecedent)
+		
+		old_canon.antecedents = TagRelationSet()
+		old_canon.canonical = canon
+		canon.antecedents.add(old_canon)
+		old_canon.canonize_implications()
+		
+		if self.journal is not None:
+			self.journal.write(TagJournal.ALIAS, a.tag_id, b.tag_id)
+	
+	# Throws TagIntegrityError if merging the alias groups of the two passed canonical tags would create a cycle.
+	# That is the case when one implies the other indirectly, through some third tag which would then be equivalent to both.
+	def check_alias_order(self, a, b):
+		for start, target in ((a, b), (b, a)):
+			# Consequents always come earlier in tag_order, so the search stops at tags before the target.
+			visited = set()
+			stack = [consequent for consequent in start.consequents if consequent is not target]
+			while len(stack) > 0:
+				node = stack.pop()
+				if node is target:
+					raise TagIntegrityError(f"Can not alias tags '{a.tag_id}' and '{b.tag_id}', since {start.tag_id} implies {target.tag_id} through other tags.")
+				
+				if node.order > target.order and node not in visited:
+					visited.add(node)
+					stack.extend(node.consequents)
+	
+	# Returns a frozenset of every canonical tag which the passed tag implies, directly or indirectly.
+	def all_consequents(self, tag):
+		return TagLibrary.get_closure(tag.get_canon(), self.consequent_closures, "consequents")
+	
+	# Returns a frozenset of every canonical tag which implies the passed tag, directly or indirectly.
+	def all_implicants(self, tag):
+		return TagLibrary.get_closure(tag.get_canon(), self.implicant_closures, "implicants")
+	
+	# Returns the transitive closure of the passed relation ("consequents" or "implicants") from the passed canonical tag.
+	# The closures of every tag visited along the way are added to the cache as well.
+	def get_closure(tag, cache, relation):
+		closure = cache.get(tag)
+		if closure is not None:
+			return closure
+		
+		# Depth-first, post-order, so that a tag's closure is built from the cached closures of its relations.
+		stack = [(tag, False)]
+		while len(stack) > 0:
+			node, is_expanded = stack.pop()
+			if node in cache:
+				continue
 			
-			for implicant_i in range(len(tag.implicants)):
-				tag.implicants[implicant_i] = all_tags[tag.implicants[implicant_i]]
+			if not is_expanded:
+				stack.append((node, True))
+				for related in getattr(node, relation):
+					if related not in cache:
+						stack.append((related, False))
 			
-			for consequent_i in range(len(tag.consequents)):
-				tag.consequents[consequent_i] = all_tags[tag.consequents[consequent_i]]
+			else:
+				closure = set()
+				for related in getattr(node, relation):
+					closure.add(related)
+					closure.update(cache.get(related, ())) # Missing only if the relations form a cycle.
+				
+				cache[node] = frozenset(closure)
+		
+		return cache[tag]
+	
+	# Discards the cached closures which may change when the passed canonical tag gains or loses consequents (upward) or implicants (downward).
+	# Relies on the cache holding every tag reachable from a cached tag, so the search stops at the first uncached tag.
+	def invalidate_closures(self, tag, upward=True, downward=True):
+		if upward:
+			stack = [tag]
+			while len(stack) > 0:
+				node = stack.pop()
+				if self.consequent_closures.pop(node, None) is not None:
+					stack.extend(node.implicants)
+		
+		if downward:
+			stack = [tag]
+			while len(stack) > 0:
+				node = stack.pop()
+				if self.implicant_closures.pop(node, None) is not None:
+					stack.extend(node.consequents)
 	
 	def __iter__(self):
 		yield from self.root
 	
+	# Yields the name and node of every tag.
+	def items(self):
+		yield from self.root.items()
+	
 	# Checks all the types and inter-relationships between all the tags!
 	# A slow function used only for testing.
 	def validate_integrity(self):
+		self.load_all()
+		
 		self.root.cascade_validate_integrity()
+		
+		for tag in self:
+			if tag.canonical is None:
+				if tag.order is None or self.tag_order[tag.order] is not tag:
+					raise TagIntegrityError(f"Tag {tag.tag_id} is missing from the topological order.")
+				
+				for consequent in tag.consequents:
+					if consequent.order >= tag.order:
+						raise TagIntegrityError(f"Tag {tag.tag_id} precedes its consequent {consequent.tag_id} in the topological order.")
+			
+			elif tag.order is not None:
+				raise TagIntegrityError(f"Tag {tag.tag_id} is an alias, but appears in the topological order.")
 	
 	# Used during testing to validate save/load functionality.
 	# Throws if passed two libraries which aren't the same.
 	def validate_identical(a, b):
+		a.load_all()
+		b.load_all()
+		
 		if type(a) is not TagLibrary:
 			raise RuntimeError(f"are_identical accepts only libraries, not {type(a)}.")
 		if type(b) is not TagLibrary:
@@ -239,9 +1426,72 @@ class TagLibrary:
 		
 		TagNode.validate_identical(a.root, b.root)
 
+# Shared by every node without children, so that leaves do not each allocate an empty dict.
+# Read-only; a node must replace it with a fresh dict before adding its first child.
+_NO_CHILDREN = types.MappingProxyType({})
+
+# The children of the root of a lazily loaded TagLibrary, keyed by codepoint like any other children.
+# Each subtree is read from the file the first time it is looked up. Anything which iterates over the children reads every subtree.
+class LazyChildren(dict):
+	__slots__ = ("library", "pending")
+	
+	def __init__(self, library, pending):
+		super().__init__()
+		self.library = library
+		self.pending = pending # Maps the first codepoint of each unread subtree to its range of positions in the file.
+	
+	# Reads the subtree under the passed codepoint, if it has not been read already.
+	def load(self, key):
+		# Removed first, since reading the subtree inserts into this dict.
+		span = self.pending.pop(key, None)
+		if span is not None:
+			self.library.load_subtree(*span)
+	
+	def load_all(self):
+		for key in list(self.pending):
+			self.load(key)
+	
+	def get(self, key, default=None):
+		self.load(key)
+		return dict.get(self, key, default)
+	
+	def __getitem__(self, key):
+		self.load(key)
+		return dict.__getitem__(self, key)
+	
+	def __contains__(self, key):
+		return key in self.pending or dict.__contains__(self, key)
+	
+	def __len__(self):
+		return dict.__len__(self) + len(self.pending)
+	
+	def __iter__(self):
+		self.load_all()
+		return dict.__iter__(self)
+	
+	def keys(self):
+		self.load_all()
+		return dict.keys(self)
+	
+	def values(self):
+		self.load_all()
+		return dict.values(self)
+	
+	def items(self):
+		self.load_all()
+		return dict.items(self)
+
+# Separates the codepoints of a multi-character key in the TAGLIB format: an intermediate node with no tag and one child.
+_CHAIN_SEPARATOR = b"\x00" + (1).to_bytes(4)
+
 class TagNode:
+	# Tries hold several nodes per tag, so nodes are kept as small as possible.
+	__slots__ = ("tag_id", "library", "order", "canonical", "antecedents", "consequents", "implicants", "weight", "max_weight", "key", "children")
+	
 	def __init__(self, fin=None):
 		self.tag_id = None
+		self.library = None # Set on tags only.
+		self.order = None # Position in the library's tag_order. Set on canonical tags only.
 		
 		# All aliased tags have a single canonical form.
 		# If this tag is the canonical form of its alias group, self.canonical is none.
@@ -252,12 +1502,126 @@ class TagNode:
 		self.consequents = None # Tags implied by this tag.
 		self.implicants = None # Tags which imply this tag.
 		
-		# Tags for which this tag is a prefix
-		self.children = {}
+		# Used to rank tags, such as by usage count. Higher is better.
+		# max_weight is the greatest weight of any tag at or below this node.
+		self.weight = 0
+		self.max_weight = 0
+		
+		# Tags for which this tag is a prefix, keyed by the first codepoint of their key.
+		# Keys may be multiple characters long. A node without a tag_id always has at least two children, except for the root.
+		self.key = ""
+		self.children = _NO_CHILDREN
 		
 		if fin is not None:
 			self.load(fin)
 	
+	# Returns the node reached by following the passed string from this node, creating nodes as needed.
+	# Splits an existing key in two if the string diverges from it part-way through.
+	# If a path list is passed, appends (depth, node) for every node descended into, where depth is the length of the string consumed plus the passed depth.
+	def insert(self, key, path=None, depth=0):
+		current_node = self
+		cursor_i = 0
+		
+		while cursor_i < len(key):
+			codepoint = ord(key[cursor_i])
+			child = current_node.children.get(codepoint)
+			if child is None:
+				child = TagNode()
+				child.key = key[cursor_i:]
+				
+				if current_node.children is _NO_CHILDREN:
+					current_node.children = {}
+				
+				current_node.children[codepoint] = child
+				
+				if path is not None:
+					path.append((depth + len(key), child))
+				
+				return child
+			
+			if not key.startswith(child.key, cursor_i):
+				# Find the length of the shared prefix. The first character always matches.
+				split_i = 1
+				while split_i < len(child.key) and cursor_i + split_i < len(key) and child.key[split_i] == key[cursor_i + split_i]:
+					split_i += 1
+				
+				# Insert an intermediate node holding the shared part of the key.
+				intermediate = TagNode()
+				intermediate.key = child.key[:split_i]
+				intermediate.max_weight = child.max_weight
+				child.key = child.key[split_i:]
+				intermediate.children = {ord(child.key[0]): child}
+				current_node.children[codepoint] = intermediate
+				
+				child = intermediate
+			
+			current_node = child
+			cursor_i += len(child.key)
+			
+			if path is not None:
+				path.append((depth + cursor_i, child))
+		
+		return current_node
+	
+	# Returns the node reached by following the passed string from this node, or None if no such node exists.
+	# Note that the returned node may not have a tag_id.
+	# If a path list is passed, appends every node descended into.
+	def find(self, key, path=None):
+		current_node = self
+		cursor_i = 0
+		
+		while cursor_i < len(key):
+			child = current_node.children.get(ord(key[cursor_i]))
+			if child is None or not key.startswith(child.key, cursor_i):
+				return None
+			
+			current_node = child
+			cursor_i += len(child.key)
+			
+			if path is not None:
+				path.append(child)
+		
+		return current_node
+	
+	# Returns the highest node below this one whose name starts with the passed string, along with that name.
+	# Returns (None, None) if there is no such node.
+	def find_prefix(self, key):
+		current_node = self
+		cursor_i = 0
+		
+		while cursor_i < len(key):
+			child = current_node.children.get(ord(key[cursor_i]))
+			if child is None:
+				return None, None
+			
+			# The prefix may end part-way through the child's key.
+			if not key.startswith(child.key, cursor_i) and not child.key.startswith(key[cursor_i:]):
+				return None, None
+			
+			current_node = child
+			cursor_i += len(child.key)
+		
+		return current_node, key[:cursor_i - len(current_node.key)] + current_node.key
+	
+	# Recalculates max_weight from this node's weight and its children's max_weight.
+	def update_max_weight(self):
+		max_weight = self.weight
+		for child in self.children.values():
+			if child.max_weight > max_weight:
+				max_weight = child.max_weight
+		
+		self.max_weight = max_weight
+	
+	# Recomputes max_weight for this node and every node below it.
+	def update_max_weights(self):
+		# Parents are listed before their children, so updating in reverse visits every child before its parent.
+		nodes = [self]
+		for node in nodes:
+			nodes.extend(node.children.values())
+		
+		for node in reversed(nodes):
+			node.update_max_weight()
+	
 	# Returns the canonical representation of this tag.
 	# Either self, or self's canonical. If a chain of aliases is found, throws a TagIntegrityError.
 	def get_canon(self):
@@ -267,26 +1631,16 @@ class TagNode:
 		else:
 			return self
 	
-	# Ensures that this token and the passed token have the same canonical form.
-	# Errors if they both already have separate canonical forms.
+	# Ensures that this token and the passed token have the same canonical form, merging their alias groups if necessary.
+	# The canonical form of the larger group is kept. If both are the same size, the passed tag's canonical form is kept.
 	def alias(self, other):
 		if self.tag_id is None or other.tag_id is None:
 			raise TagIntegrityError("Cannot alias node without tag_id.")
 		
-		print(f"Alias {self.tag_id} -> {other.tag_id}")
+		if TagTrace.tracer is not None:
+			TagTrace.tracer("alias", tag=self.tag_id, other=other.tag_id)
 		
-		if self.canonical is None and len(self.antecedents) == 0:
-			self.canonical = other.get_canon()
-			other.antecedents.append(self)
-			self.canonize_implications()
-		
-		elif other.canonical is None and len(other.antecedents) == 0:
-			other.canonical = self.get_canon()
-			self.antecedents.append(other)
-			other.canonize_implications()
-		
-		else:
-			raise TagIntegrityError(f"Can not alias tags '{self.tag_id}' and '{other.tag_id}' which belong to separate alias groups.")
+		self.library.merge_aliases(self, other)
 	
 	# Sets self to imply the passed tag.
 	# Returns true on success, false if the implication relation already exists.
@@ -297,11 +1651,21 @@ class TagNode:
 		if self_canon is other_canon:
 			raise TagIntegrityError(f"Tag {self.tag_id} cannot imply {other.tag_id}, its alias!")
 		
-		print(f"Imply {self.tag_id} (= {self_canon.tag_id}) -> {other.tag_id} (= {other_canon.tag_id})")
+		if TagTrace.tracer is not None:
+			TagTrace.tracer("imply", tag=self.tag_id, other=other.tag_id)
 		
 		if not self_canon.does_directly_imply(other_canon):
-			self_canon.consequents.append(other_canon)
-			other_canon.implicants.append(self_canon)
+			self.library.order_implication(self_canon, other_canon)
+			
+			self.library.invalidate_closures(self_canon, downward=False)
+			self.library.invalidate_closures(other_canon, upward=False)
+			
+			self_canon.consequents.add(other_canon)
+			other_canon.implicants.add(self_canon)
+			
+			if self.library.journal is not None:
+				self.library.journal.write(TagJournal.IMPLY, self.tag_id, other.tag_id)
+			
 			return True
 		
 		else:
@@ -311,134 +1675,269 @@ class TagNode:
 	def does_directly_imply(self, other):
 		return other.get_canon() in self.get_canon().consequents
 	
+	# Returns a frozenset of every canonical tag which this tag implies, directly or indirectly.
+	# Cached by the library until the implications of this tag or its consequents change.
+	def all_consequents(self):
+		return self.library.all_consequents(self)
+	
+	# Returns a frozenset of every canonical tag which implies this tag, directly or indirectly.
+	# Cached by the library until the implications of this tag or its implicants change.
+	def all_implicants(self):
+		return self.library.all_implicants(self)
+	
+	# Makes this tag the canonical representation of itself and all its aliases.
+	# The implications of the previous canonical form, and its place in the topological order, move to this tag.
+	def canonize(self):
+		old_canon = self.canonical
+		if old_canon is None:
+			return
+		
+		library = self.library
+		library.load_all()
+		library.tagify_cache.clear()
+		
+		if TagTrace.tracer is not None:
+			TagTrace.tracer("canonize", tag=self.tag_id, other=old_canon.tag_id)
+		
+		library.invalidate_closures(old_canon)
+		
+		antecedents = old_canon.antecedents
+		antecedents.remove(self)
+		antecedents.add(old_canon)
+		for antecedent in antecedents:
+			antecedent.canonical = self
+		
+		self.canonical = None
+		self.antecedents = antecedents
+		old_canon.antecedents = TagRelationSet()
+		
+		# Aliases have no implications of their own.
+		self.consequents, old_canon.consequents = old_canon.consequents, self.consequents
+		self.implicants, old_canon.implicants = old_canon.implicants, self.implicants
+		
+		for consequent in self.consequents:
+			consequent.implicants.remove(old_canon)
+			consequent.implicants.add(self)
+		
+		for implicant in self.implicants:
+			implicant.consequents.remove(old_canon)
+			implicant.consequents.add(self)
+		
+		self.order = old_canon.order
+		library.tag_order[self.order] = self
+		old_canon.order = None
+		
+		if library.journal is not None:
+			library.journal.write(TagJournal.CANONIZE, self.tag_id)
+	
 	# Move all consequents and implicants to the canonical representation of this tag.
 	# Always called while aliasing two tags together.
 	def canonize_implications(self):
-		print(f"Canonizing implications of {self.tag_id}")
+		if TagTrace.tracer is not None:
+			TagTrace.tracer("canonize_implications", tag=self.tag_id, other=self.canonical.tag_id)
+		
+		self.library.invalidate_closures(self)
+		self.library.invalidate_closures(self.canonical)
 		
 		for implicant in self.implicants:
-			print(f"  implicant {implicant.tag_id}...")
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("move_implicant", tag=self.tag_id, other=implicant.tag_id)
+			
 			implicant.consequents.remove(self)
 			
-			if self.canonical not in implicant.consequents:
-				implicant.consequents.append(self.canonical)
-				self.canonical.implicants.append(implicant)
+			# An implication between two aliases is meaningless, and dropped.
+			if implicant is not self.canonical and self.canonical not in implicant.consequents:
+				self.library.order_implication(implicant, self.canonical)
+				implicant.consequents.add(self.canonical)
+				self.canonical.implicants.add(implicant)
 		
-		self.implicants = []
+		self.implicants = TagRelationSet()
 		
 		for consequent in self.consequents:
-			print(f"  consequent {consequent.tag_id}...")
+			if TagTrace.tracer is not None:
+				TagTrace.tracer("move_consequent", tag=self.tag_id, other=consequent.tag_id)
+			
 			consequent.implicants.remove(self)
 			
-			if self.canonical not in consequent.implicants:
-				consequent.implicants.append(self.canonical)
-				self.canonical.consequents.append(consequent)
+			if consequent is not self.canonical and self.canonical not in consequent.implicants:
+				self.library.order_implication(self.canonical, consequent)
+				consequent.implicants.add(self.canonical)
+				self.canonical.consequents.add(consequent)
 		
-		self.consequents = []
+		self.consequents = TagRelationSet()
+		
+		# No longer canonical, so no longer ordered.
+		if self.order is not None:
+			self.library.tag_order[self.order] = None
+			self.order = None
 	
 	def cascade_validate_integrity(self, curr_tag=""):
 		self.validate_internal_integrity()
 		
-		for key in self.children:
+		for child in self.children.values():
 			try:
-				self.children[key].cascade_validate_integrity(curr_tag + chr(key))
+				child.cascade_validate_integrity(curr_tag + child.key)
 		
 			except TagIntegrityError as e:
-				raise RuntimeError(f"While validating '{curr_tag + chr(key)}': {e.message}")
+				raise RuntimeError(f"While validating '{curr_tag + child.key}': {e.message}")
 		
 		self.validate_referential_integrity()
 	
-	# Saves to the passed file
-	def save(self, fout):
-		if self.tag_id is None:
-			fout.write(False.to_bytes())
+	# Saves to the passed file.
+	# The output is assembled in a buffer which is written out in large chunks. Nodes are visited with an explicit stack, so deep tries cannot exceed the recursion limit.
+	def save(self, fout, chunk_size=1 << 20):
+		pack = struct.pack
+		out = bytearray()
 		
-		else:
-			fout.write(True.to_bytes())
-			fout.write(self.tag_id.to_bytes(4))
+		# Every node is preceded by its key. The root's key is empty.
+		stack = [self]
+		while len(stack) > 0:
+			node = stack.pop()
+			
+			# The file format stores one codepoint per node.
+			# Multi-character keys are written out as a chain of intermediate nodes with a single child each.
+			if len(node.key) < 2:
+				out += node.key.encode("utf-8")
 			
-			# Store relations
-			if self.canonical is not None:
-				fout.write(self.canonical.tag_id.to_bytes(4))
 			else:
-				fout.write((0).to_bytes(4))
+				out += _CHAIN_SEPARATOR.join(map(str.encode, node.key))
 			
-			fout.write(len(self.antecedents).to_bytes(2))
-			for antecedent in self.antecedents:
-				fout.write(antecedent.tag_id.to_bytes(4))
+			if node.tag_id is None:
+				out += b"\x00"
 			
-			fout.write(len(self.implicants).to_bytes(2))
-			for implicant in self.implicants:
-				fout.write(implicant.tag_id.to_bytes(4))
+			else:
+				out += pack(">BII", True, node.tag_id, 0 if node.canonical is None else node.canonical.tag_id)
+				
+				# Store relations
+				if len(node.antecedents) == 0 and len(node.implicants) == 0 and len(node.consequents) == 0:
+					out += b"\x00" * 6
+				
+				else:
+					for relation in (node.antecedents, node.implicants, node.consequents):
+						if len(relation) > 0xFFFF:
+							raise TagIntegrityError(f"Tag '{node.tag_id}' has {len(relation)} relations of one kind, but the TAGLIB format stores at most {0xFFFF}.")
+						
+						out += pack(f">H{len(relation)}I", len(relation), *[tag.tag_id for tag in relation])
 			
-			fout.write(len(self.consequents).to_bytes(2))
-			for consequent in self.consequents:
-				fout.write(consequent.tag_id.to_bytes(4))
+			out += pack(">I", len(node.children))
+			
+			# Pushed in reverse so that children are written in order.
+			stack.extend(reversed(node.children.values()))
+			
+			if len(out) >= chunk_size:
+				fout.write(out)
+				out.clear()
 		
-		fout.write(len(self.children).to_bytes(4))
-		for key in self.children:
-			fout.write(chr(key).encode('utf-8'))
-			self.children[key].save(fout)
+		fout.write(out)
+	
+	# Loads the trie rooted at this node from the passed file.
+	# Relations remain lists of tag ids until the library converts them into TagRelationSets of TagNodes.
+	def load(self, fin):
+		start = fin.tell() if fin.seekable() else None
+		data = fin.read()
+		
+		end = self.load_buffer(data)
+		
+		# Leave the file positioned after the trie, as though it had been read incrementally.
+		if start is not None:
+			fin.seek(start + end)
 	
-	def load(self, fin, depth=0):
+	# Loads the trie rooted at this node from the passed bytes-like object, beginning at the passed offset.
+	# Returns the offset just past the end of the trie.
+	def load_buffer(self, data, offset=0):
 		if self.tag_id is not None:
 			raise RuntimeError("Cannot load an initialized tag!")
 		
-		has_tag_id = bool.from_bytes(fin.read(1))
+		data = memoryview(data)
+		unpack_uint = struct.Struct(">I").unpack_from
 		
-		if has_tag_id:
-			self.tag_id = int.from_bytes(fin.read(4))
-			
-			# Read relations
-			self.canonical = int.from_bytes(fin.read(4))
-			if self.canonical == 0:
-				self.canonical = None
+		# The trie is built from a large number of small objects. Collection passes over them cannot free anything.
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+		
+		try:
+			offset = self.load_header(data, offset)
 			
-			self.antecedents = []
-			num_antecedents = int.from_bytes(fin.read(2))
-			for antecedent_i in range(num_antecedents):
-				self.antecedents.append(int.from_bytes(fin.read(4)))
+			# Each frame holds a node whose children are being read and the number of children left to read.
+			stack = [[self, unpack_uint(data, offset)[0]]]
+			offset += 4
 			
-			self.implicants = []
-			num_implicants = int.from_bytes(fin.read(2))
-			for implicant_i in range(num_implicants):
-				self.implicants.append(int.from_bytes(fin.read(4)))
+			if stack[0][1] > 0:
+				self.children = {}
 			
-			self.consequents = []
-			num_consequents = int.from_bytes(fin.read(2))
-			for consequent_i in range(num_consequents):
-				self.consequents.append(int.from_bytes(fin.read(4)))
-		
-		else:
-			self.tag_id = None
-			
-			self.canonical = None
-			self.antecedents = None
-			self.implicants = None
-			self.consequents = None
-		
-		# Read children.
-		num_children = int.from_bytes(fin.read(4))
-		for child_i in range(num_children):
-			unicode_bytes = b''
-			key = None
-			for i in range(4):
-				unicode_bytes += fin.read(1)
-				if len(unicode_bytes) <= i:
-					raise ValueError("EOF reached unexpectedly!")
+			while len(stack) > 0:
+				frame = stack[-1]
+				if frame[1] == 0:
+					stack.pop()
+					continue
 				
-				try:
-					key = ord(unicode_bytes.decode("utf-8"))
-					break
+				frame[1] -= 1
 				
-				except UnicodeDecodeError:
-					pass
+				# Read the child's key. Chains of intermediate nodes with no tag and a single child are merged back into a single multi-character key.
+				key = []
+				while True:
+					# The length of a UTF-8 sequence is given by its leading byte.
+					lead = data[offset]
+					if lead < 0x80:
+						key.append(chr(lead))
+						offset += 1
+					
+					else:
+						length = 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+						key.append(str(data[offset : offset + length], "utf-8"))
+						offset += length
+					
+					if data[offset] != 0 or unpack_uint(data, offset + 1)[0] != 1:
+						break
+					
+					offset += 5
+				
+				child = TagNode()
+				child.key = "".join(key)
+				offset = child.load_header(data, offset)
+				
+				num_children = unpack_uint(data, offset)[0]
+				offset += 4
+				
+				frame[0].children[ord(key[0])] = child
+				
+				if num_children > 0:
+					child.children = {}
+					stack.append([child, num_children])
+		
+		except (IndexError, struct.error):
+			raise ValueError("EOF reached unexpectedly!")
+		
+		finally:
+			if gc_was_enabled:
+				gc.enable()
+		
+		return offset
+	
+	# Reads the tag id and relations of this node from the passed memoryview. Returns the offset just past them.
+	def load_header(self, data, offset):
+		has_tag_id = data[offset]
+		offset += 1
+		
+		if has_tag_id:
+			self.tag_id, canonical, num_antecedents = struct.unpack_from(">IIH", data, offset)
+			offset += 10
+			
+			self.canonical = None if canonical == 0 else canonical
 			
-			if key is None:
-				raise UnicodeDecodeError("Failed to read codepoint.")
+			self.antecedents = list(struct.unpack_from(f">{num_antecedents}I", data, offset))
+			offset += 4 * num_antecedents
 			
-			self.children[key] = TagNode(fin)
+			num_implicants = struct.unpack_from(">H", data, offset)[0]
+			self.implicants = list(struct.unpack_from(f">{num_implicants}I", data, offset + 2))
+			offset += 2 + 4 * num_implicants
+			
+			num_consequents = struct.unpack_from(">H", data, offset)[0]
+			self.consequents = list(struct.unpack_from(f">{num_consequents}I", data, offset + 2))
+			offset += 2 + 4 * num_consequents
 		
+		return offset
+	
 	def __iter__(self):
 		if self.tag_id is not None:
 			yield self
@@ -446,6 +1945,15 @@ class TagNode:
 		for child in self.children.values():
 			yield from child
 	
+	# Yields the name and node of every tag at or below this node.
+	# The passed name is the name of this node.
+	def items(self, name=""):
+		if self.tag_id is not None:
+			yield name, self
+		
+		for child in self.children.values():
+			yield from child.items(name + child.key)
+	
 	def __repr__(self):
 		if self.tag_id is None:
 			return "<Empty TagNode>"
@@ -534,29 +2042,50 @@ class TagNode:
 		# Check children
 		for key in b.children:
 			if key not in a.children:
-				raise RuntimeError(f"While checking {curr_tag}, left children lacks key {key}, present in right children.")
+				raise RuntimeError(f"While checking {curr_tag}, left children lacks key {b.children[key].key}, present in right children.")
 		
 		for key in a.children:
 			if key not in b.children:
-				raise RuntimeError(f"While checking {curr_tag}, right children lacks key {key}, present in left children.")
+				raise RuntimeError(f"While checking {curr_tag}, right children lacks key {a.children[key].key}, present in left children.")
+			
+			if a.children[key].key != b.children[key].key:
+				raise RuntimeError(f"While checking {curr_tag}, child keys do not match. ({a.children[key].key} == {b.children[key].key})")
 			
 			# Recurse
-			TagNode.validate_identical(a.children[key], b.children[key], curr_tag + chr(key))
+			TagNode.validate_identical(a.children[key], b.children[key], curr_tag + a.children[key].key)
 	
 	# Throws if basic assumptions about the values and types of this structure do not hold true.
 	def validate_internal_integrity(self):
 		# Check children
-		if type(self.children) is not dict:
+		if self.children is not _NO_CHILDREN and type(self.children) is not dict:
 			raise TagIntegrityError(f"Children must be dict, not {type(self.children)}.")
+		
+		for key in self.children:
+			if type(key) is not int:
+				raise TagIntegrityError(f"Keys into children must be ints (unicode codepoints), not {type(key)}.")
 			
-			for key in self.children:
-				if type(key) is not int:
-					raise TagIntegrityError(f"Keys into children must be ints (unicode codepoints), not {type(key)}.")
-				
-				if type(self.children[key]) is not TagNode:
-					raise TagIntegrityError(f"Keys into children must be ints (unicode codepoints), not {type(self.children[key])}.")
+			if type(self.children[key]) is not TagNode:
+				raise TagIntegrityError(f"Children must be TagNodes, not {type(self.children[key])}.")
+			
+			child_key = self.children[key].key
+			if type(child_key) is not str or len(child_key) == 0:
+				raise TagIntegrityError(f"Child key must be a non-empty string, not {child_key!r}.")
 			
+			if ord(child_key[0]) != key:
+				raise TagIntegrityError(f"Child key '{child_key}' is stored under the wrong codepoint U+{key:04X}.")
+		
+		max_weight = self.weight
+		for child in self.children.values():
+			max_weight = max(max_weight, child.max_weight)
+		
+		if self.max_weight != max_weight:
+			raise TagIntegrityError(f"Node has max_weight {self.max_weight}, but the greatest weight at or below it is {max_weight}.")
+		
 		if self.tag_id is None:
+			# The root is the only node permitted to have an empty key.
+			if self.key != "" and len(self.children) < 2:
+				raise TagIntegrityError(f"Non-tag, aka intermidiary value must have at least two children, or be merged into its child.")
+			
 			if self.canonical is not None:
 				raise TagIntegrityError(f"Non-tag, aka intermidiary value cannot have a canonical form.")
 			
@@ -586,14 +2115,14 @@ class TagNode:
 					raise TagIntegrityError(f"Tag {self.tag_id} has both antecedents and a canonical form.")
 			
 			# Check type of arrays
-			if type(self.antecedents) is not list:
-				raise TagIntegrityError(f"Tag {self.tag_id} has antecedents of type {type(self.antecedents)}, must be list of TagNodes.")
+			if type(self.antecedents) is not TagRelationSet:
+				raise TagIntegrityError(f"Tag {self.tag_id} has antecedents of type {type(self.antecedents)}, must be TagRelationSet of TagNodes.")
 				
-			if type(self.consequents) is not list:
-				raise TagIntegrityError(f"Tag {self.tag_id} has consequents of type {type(self.consequents)}, must be list of TagNodes.")
+			if type(self.consequents) is not TagRelationSet:
+				raise TagIntegrityError(f"Tag {self.tag_id} has consequents of type {type(self.consequents)}, must be TagRelationSet of TagNodes.")
 				
-			if type(self.implicants) is not list:
-				raise TagIntegrityError(f"Tag {self.tag_id} has implicants of type {type(self.implicants)}, must be list of TagNodes.")
+			if type(self.implicants) is not TagRelationSet:
+				raise TagIntegrityError(f"Tag {self.tag_id} has implicants of type {type(self.implicants)}, must be TagRelationSet of TagNodes.")
 		
 			# Check members of arrays.
 			for antecedent in self.antecedents:
@@ -648,19 +2177,48 @@ class TagNode:
 					
 					if self not in implicant.consequents:
 						raise TagIntegrityError(f"Tag {self.tag_id} has implicant {consequent.tag_id} for which it is not a consequent.")
-			
-				# Check for duplicate entries
-				for i in range(len(self.antecedents)-1):
-					for j in range(i+1, len(self.antecedents)):
-						if self.antecedents[i] == self.antecedents[j]:
-							raise TagIntegrityError(f"Tag {self.tag_id} has duplicate antecedent {self.antecedents[i].tag_id}.")
-				
-				for i in range(len(self.consequents)-1):
-					for j in range(i+1, len(self.consequents)):
-						if self.consequents[i] == self.consequents[j]:
-							raise TagIntegrityError(f"Tag {self.tag_id} has duplicate consequent {self.consequents[i].tag_id}.")
-				
-				for i in range(len(self.implicants)-1):
-					for j in range(i+1, len(self.implicants)):
-						if self.implicants[i] == self.implicants[j]:
-							raise TagIntegrityError(f"Tag {self.tag_id} has duplicate implicant {self.implicants[i].tag_id}.")
+
+# A tag in a lazily loaded TagLibrary whose canonical form and relations have not yet been read from the file.
+# Reading or assigning any of them reads all of them, and turns the node into an ordinary TagNode.
+class LazyTagNode(TagNode):
+	__slots__ = ()
+	
+	@property
+	def canonical(self):
+		self.library.resolve_lazy(self)
+		return self.canonical
+	
+	@canonical.setter
+	def canonical(self, value):
+		self.library.resolve_lazy(self)
+		self.canonical = value
+	
+	@property
+	def antecedents(self):
+		self.library.resolve_lazy(self)
+		return self.antecedents
+	
+	@antecedents.setter
+	def antecedents(self, value):
+		self.library.resolve_lazy(self)
+		self.antecedents = value
+	
+	@property
+	def implicants(self):
+		self.library.resolve_lazy(self)
+		return self.implicants
+	
+	@implicants.setter
+	def implicants(self, value):
+		self.library.resolve_lazy(self)
+		self.implicants = value
+	
+	@property
+	def consequents(self):
+		self.library.resolve_lazy(self)
+		return self.consequents
+	
+	@consequents.setter
+	def consequents(self, value):
+		self.library.resolve_lazy(self)
+		self.consequents = value
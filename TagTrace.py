@@ -0,0 +1,34 @@
+import logging
+
+__all__ = ["set_tracer", "trace_to_logger"]
+
+# Called as tracer(event, **fields) for every trace event, or None when tracing is disabled.
+# Call sites check for None before building any fields, so disabled tracing costs one comparison.
+tracer = None
+
+# Installs the passed callback, which is called as callback(event, **fields) for every event. Pass None to disable tracing.
+# Events and their fields:
+#   parse: expr, start, end, operator, operator_i. One per subexpression once it is parsed, giving its bounds and operator (None for a tag name). Operands come before their operator.
+#   parsed: expr, seconds. Once per TagExpression, after parsing completes. Neither is emitted when the tree is found in TagExpression.cache.
+#   double_negation: operand. A double negation was removed while converting to negation normal form.
+#   tagify: operator. An operator was visited by TagLibrary.tagify().
+#   lookup_miss: name. No tag has the requested name.
+#   alias, imply: tag, other. A relation edit between two tags, by id.
+#   canonize: tag, other. A tag (tag) replaced the canonical form (other) of its alias group.
+#   canonize_implications: tag, other. The implications of a tag (tag) are about to move to its new canonical form (other).
+#   move_implicant, move_consequent: tag, other. An implication moved from a tag (tag) to its new canonical form.
+def set_tracer(callback):
+	global tracer
+	tracer = callback
+
+# Forwards every event to the passed logger, or the "TagLibrary" logger by default, at the passed level.
+# The event name and fields are attached to each record as its tag_event and tag_fields attributes.
+def trace_to_logger(logger=None, level=logging.DEBUG):
+	if logger is None:
+		logger = logging.getLogger("TagLibrary")
+	
+	def forward(event, **fields):
+		if logger.isEnabledFor(level):
+			logger.log(level, "%s %s", event, fields, extra={"tag_event": event, "tag_fields": fields})
+	
+	set_tracer(forward)
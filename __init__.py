@@ -1,2 +1,6 @@
 from .TagLibrary import *
-from .TagExpression import *
\ No newline at end of file
+from .TagExpression import *
+from .MappedTagLibrary import *
+from .TagTrace import *
+from .ItemIndex import *
+from .ItemMatrix import *
\ No newline at end of file
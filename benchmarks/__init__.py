@@ -0,0 +1 @@
+from .generators import generate_names, generate_library, generate_expressions
@@ -0,0 +1,146 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from ..TagLibrary import TagLibrary
+from ..TagExpression import TagExpression
+from .generators import generate_names, generate_library, generate_expressions
+
+# Returns the least time, in seconds, taken by any of repeat calls to fn. Each call is passed the value returned by setup(), which is not timed.
+def best_of(fn, repeat=1, setup=lambda: None):
+	best = None
+	for _ in range(repeat):
+		arg = setup()
+		
+		began = time.perf_counter()
+		fn(arg)
+		seconds = time.perf_counter() - began
+		
+		if best is None or seconds < best:
+			best = seconds
+	
+	return best
+
+# Runs every benchmark against a generated library of each of the passed sizes and returns the results, ready to be written as JSON.
+# Each result names its benchmark and library size, along with the number of operations timed, the total time in seconds, and the time per operation in microseconds.
+def run(sizes, seed=0, repeat=3, lookups=100000, expressions=1000, progress=None):
+	results = []
+	
+	for size in sizes:
+		# Records a result, and reports it through progress, if passed.
+		def record(benchmark, ops, seconds, **extra):
+			results.append({"benchmark": benchmark, "size": size, "ops": ops, "seconds": seconds, "us_per_op": seconds / ops * 1e6, **extra})
+			
+			if progress is not None:
+				progress(f"{size:>10} {benchmark:<16} {seconds:10.4f} s {seconds / ops * 1e6:12.3f} us/op")
+		
+		names = generate_names(size, seed)
+		
+		def create(library):
+			for name in names:
+				library.create(name)
+		
+		# Benchmarks which take time proportional to the size of the library are only run once.
+		record("create", size, best_of(create, setup=lambda: TagLibrary(None)))
+		record("create_many", size, best_of(lambda library: library.create_many(names), setup=lambda: TagLibrary(None)))
+		
+		began = time.perf_counter()
+		library = generate_library(names, seed)
+		record("generate_library", size, time.perf_counter() - began)
+		
+		rng = random.Random(seed)
+		sample = rng.choices(names, k=lookups)
+		
+		def get(sample):
+			for name in sample:
+				library.get(name)
+		
+		record("get", lookups, best_of(get, repeat, lambda: sample))
+		
+		with tempfile.TemporaryDirectory() as directory:
+			for fmt in ("TAGLIB", "TAGLIB2"):
+				fn = os.path.join(directory, "library." + fmt.lower())
+				
+				record(f"save_{fmt.lower()}", size, best_of(lambda _: library.save(fn, fmt=fmt)), bytes=os.path.getsize(fn))
+				record(f"load_{fmt.lower()}", size, best_of(lambda _: TagLibrary(fn, fmt=fmt)))
+		
+		expr_strs = generate_expressions(names, expressions, seed)
+		
+		def parse(_):
+			for expr_str in expr_strs:
+				TagExpression(expr_str)
+		
+		# Empty and disable the cache of parsed trees while timing parsing, so that every round parses every expression rather than only the first.
+		maxsize = TagExpression.cache.maxsize
+		TagExpression.cache.clear()
+		TagExpression.cache.maxsize = 0
+		try:
+			record("parse", expressions, best_of(parse, repeat))
+		
+		finally:
+			TagExpression.cache.maxsize = maxsize
+		
+		def tagify(exprs):
+			for expr in exprs:
+				library.tagify(expr)
+		
+		# Empty and disable the library's cache of tagified trees while timing tagify(), since every round tagifies the same cached parsed trees, and so would only look them up.
+		maxsize = library.tagify_cache.maxsize
+		library.tagify_cache.clear()
+		library.tagify_cache.maxsize = 0
+		try:
+			record("tagify", expressions, best_of(tagify, repeat, lambda: [TagExpression(expr_str) for expr_str in expr_strs]))
+		
+		finally:
+			library.tagify_cache.maxsize = maxsize
+		
+		def to_conjunctive_normal_form(exprs):
+			for expr in exprs:
+				expr.to_conjunctive_normal_form()
+		
+		record("cnf", expressions, best_of(to_conjunctive_normal_form, repeat, lambda: [TagExpression(expr_str) for expr_str in expr_strs]))
+		
+		del library
+	
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="benchmarks", description="Times TagLibrary and TagExpression operations on generated libraries, and writes the results as JSON.")
+	parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000], help="Numbers of tags in the generated libraries.")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the generators. Libraries and expressions are identical for the same seed.")
+	parser.add_argument("--repeat", type=int, default=3, help="Number of times to repeat fast benchmarks, keeping the best time.")
+	parser.add_argument("--lookups", type=int, default=100000, help="Number of names to look up with get().")
+	parser.add_argument("--expressions", type=int, default=1000, help="Number of expressions to parse, tagify and convert to CNF.")
+	parser.add_argument("--label", default=None, help="Free-form label stored with the results, such as a version or commit.")
+	parser.add_argument("--output", "-o", default=None, help="File to write the results to. Defaults to standard output.")
+	args = parser.parse_args(argv)
+	
+	results = run(args.sizes, args.seed, args.repeat, args.lookups, args.expressions, progress=lambda line: print(line, file=sys.stderr))
+	
+	report = {
+		"label": args.label,
+		"timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		"python": platform.python_version(),
+		"implementation": platform.python_implementation(),
+		"platform": platform.platform(),
+		"seed": args.seed,
+		"repeat": args.repeat,
+		"results": results,
+	}
+	
+	if args.output is None:
+		json.dump(report, sys.stdout, indent="\t")
+		print()
+	
+	else:
+		with open(args.output, "w") as fout:
+			json.dump(report, fout, indent="\t")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,103 @@
+import itertools
+import random
+
+from ..TagLibrary import TagLibrary
+
+# Syllables from which the words in generated names are built.
+SYLLABLES = (
+	"ka", "ri", "mo", "ta", "ne", "lu", "shi", "po", "ve", "da",
+	"zor", "min", "bel", "qua", "tor", "fen", "gal", "hu", "jin", "ox",
+	"el", "ar", "is", "un", "py", "sto", "cre", "bla", "dri", "wex",
+)
+
+# Returns cumulative weights for the ranks 1 to n of a Zipfian distribution with the passed exponent.
+# Rank 1 is the most likely, rank 2 is 2**exponent times less likely, and so on.
+def zipf_cum_weights(n, exponent):
+	return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+# Returns a list of the passed number of distinct tag names, which is the same for the same seed.
+# Each name is a sequence of words, and both the number of words in a name and the choice of each word follow Zipfian distributions.
+# Most names are therefore one or two common words long, with a long tail of longer names, and many names share prefixes as real tags do.
+def generate_names(count, seed=0, vocabulary=20000, max_words=8, exponent=1.2):
+	rng = random.Random(seed)
+	
+	words = set()
+	while len(words) < vocabulary:
+		words.add("".join(rng.choices(SYLLABLES, k=rng.randint(1, 4))))
+	
+	words = sorted(words)
+	rng.shuffle(words)
+	
+	word_weights = zipf_cum_weights(len(words), exponent)
+	length_weights = zipf_cum_weights(max_words, exponent)
+	lengths = range(1, max_words + 1)
+	
+	seen = set()
+	names = []
+	while len(names) < count:
+		for num_words in rng.choices(lengths, cum_weights=length_weights, k=count - len(names)):
+			name = " ".join(rng.choices(words, cum_weights=word_weights, k=num_words))
+			if name not in seen:
+				seen.add(name)
+				names.append(name)
+	
+	return names
+
+# Returns a new TagLibrary containing the passed names, related in the same way for the same seed.
+# A fraction (alias_fraction) of the tags are gathered into alias groups whose sizes follow a Zipfian distribution, up to max_alias_group tags.
+# The remaining tags form chains of depth tags, each implying the one before it, and every tag also implies up to extra_implications tags shortly before it.
+# Every implication points at an earlier tag, so the implication graph is a deep DAG and no implication is ever rejected.
+def generate_library(names, seed=0, depth=32, extra_implications=2, alias_fraction=0.1, max_alias_group=64):
+	rng = random.Random(seed)
+	
+	library = TagLibrary(None)
+	tags = library.create_many(names).created
+	
+	aliased = rng.sample(range(len(tags)), int(len(tags) * alias_fraction))
+	group_sizes = zipf_cum_weights(max_alias_group - 1, 1.0)
+	sizes = range(2, max_alias_group + 1)
+	
+	group_start = 0
+	while group_start + 1 < len(aliased):
+		group_size = rng.choices(sizes, cum_weights=group_sizes)[0]
+		group = aliased[group_start : group_start + group_size]
+		for tag_i in group[1:]:
+			tags[tag_i].alias(tags[group[0]])
+		
+		group_start += group_size
+	
+	canonical = [tag for tag in tags if tag.canonical is None]
+	window = depth * 4
+	for tag_i, tag in enumerate(canonical):
+		if tag_i % depth != 0:
+			tag.imply(canonical[tag_i - 1])
+		
+		for _ in range(min(extra_implications, tag_i)):
+			tag.imply(canonical[tag_i - rng.randint(1, min(window, tag_i))])
+	
+	return library
+
+# Returns a list of the passed number of expression strings over the passed names, which is the same for the same seed.
+# Each expression has the passed number of tags, combined at random with AND, OR and NOT and parenthesized as needed.
+def generate_expressions(names, count, seed=0, leaves=6):
+	rng = random.Random(seed)
+	
+	# Builds an expression with num_leaves tags, returning its string and whether it must be parenthesized to be used as an operand.
+	def build(num_leaves):
+		if num_leaves == 1:
+			expr, compound = rng.choice(names), False
+		
+		else:
+			split = rng.randint(1, num_leaves - 1)
+			left, left_compound = build(split)
+			right, right_compound = build(num_leaves - split)
+			
+			expr = f"{f"({left})" if left_compound else left} {rng.choice(("AND", "OR"))} {f"({right})" if right_compound else right}"
+			compound = True
+		
+		if rng.random() < 0.2:
+			expr, compound = f"NOT {f"({expr})" if compound else expr}", False
+		
+		return expr, compound
+	
+	return [build(leaves)[0] for _ in range(count)]
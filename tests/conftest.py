@@ -0,0 +1,8 @@
+import pytest
+
+from ..TagExpression import TagExpression
+
+# Parsed trees are cached for the whole process. Clear the cache before each test, so that no test depends on which expressions ran before it.
+@pytest.fixture(autouse=True)
+def clear_expression_cache():
+	TagExpression.cache.clear()
\ No newline at end of file
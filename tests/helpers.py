@@ -0,0 +1,4 @@
+# Returns a random expression with the passed number of leaves, each one of the tags "tag 0" to "tag {num_tags - 1}", drawn from the passed random.Random.
+def random_expression(rng, num_leaves, num_tags):
+	expr = f"tag {rng.randrange(num_tags)}" if num_leaves == 1 else f"({random_expression(rng, num_leaves // 2, num_tags)}) {rng.choice(['AND', 'OR'])} ({random_expression(rng, num_leaves - num_leaves // 2, num_tags)})"
+	return f"NOT {expr}" if rng.random() < 0.25 else expr
\ No newline at end of file
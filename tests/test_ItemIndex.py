@@ -0,0 +1,244 @@
+import array
+import pytest
+import random
+
+from ..TagLibrary import TagLibrary, TagIdentificationError
+from ..TagExpression import *
+from ..MappedTagLibrary import MappedTagLibrary
+from ..ItemIndex import ItemIndex, Posting, ARRAY_MAX, CHUNK_SIZE, gallop, intersect_arrays, subtract_arrays, intersect_postings, subtract_postings, merge_postings
+from .helpers import random_expression
+
+def build_library():
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(30)).created
+	tags[1].alias(tags[2])
+	tags[3].alias(tags[20])
+	tags[3].alias(tags[21])
+	return lib, tags
+
+def test_gallop():
+	ids = array.array("I", range(0, 1000, 3))
+	
+	for tag_id in range(-1, 1002):
+		for lo in (0, 5, 200):
+			assert gallop(ids, tag_id, lo) == max(lo, (tag_id + 2) // 3)
+
+def test_arrays():
+	rng = random.Random(23)
+	
+	for i in range(200):
+		a = sorted(rng.sample(range(5000), rng.choice((0, 1, 10, 100, 3000))))
+		b = sorted(rng.sample(range(5000), rng.choice((0, 1, 10, 100, 3000))))
+		
+		assert list(intersect_arrays(array.array("H", a), array.array("H", b))) == sorted(set(a) & set(b))
+		assert list(subtract_arrays(array.array("H", a), array.array("H", b))) == sorted(set(a) - set(b))
+
+# Returns a posting of the passed ids, added in a random order.
+def build_posting(rng, ids):
+	posting = Posting()
+	for item_id in rng.sample(sorted(ids), len(ids)):
+		posting.add(item_id)
+	
+	return posting
+
+def test_posting_containers():
+	rng = random.Random(23)
+	
+	# Dense chunks become bitmaps, and sparse ones stay arrays.
+	ids = set(range(CHUNK_SIZE, CHUNK_SIZE + 10000)) | {5, 0xFFFFFFFF}
+	posting = build_posting(rng, ids)
+	assert posting.keys == [0, 1, 0xFFFF]
+	assert type(posting.chunks[0]) is array.array and type(posting.chunks[1]) is bytearray
+	assert len(posting) == len(ids)
+	assert list(posting) == sorted(ids)
+	assert posting.to_array() == array.array("I", sorted(ids))
+	
+	# Bitmaps become arrays again once they are half as full as an array may be.
+	for item_id in rng.sample(range(CHUNK_SIZE, CHUNK_SIZE + 10000), 10000 - ARRAY_MAX // 2 - 1):
+		posting.remove(item_id)
+		ids.remove(item_id)
+	
+	assert type(posting.chunks[1]) is bytearray
+	assert list(posting) == sorted(ids)
+	
+	item_id = max(ids - {0xFFFFFFFF})
+	posting.remove(item_id)
+	ids.remove(item_id)
+	assert type(posting.chunks[1]) is array.array
+	assert list(posting) == sorted(ids)
+	
+	posting.remove(5)
+	assert posting.keys == [1, 0xFFFF]
+
+def test_postings():
+	rng = random.Random(23)
+	
+	# Ids are drawn from three chunks, so that chunks are sometimes dense enough to be bitmaps and sometimes missing.
+	def sample():
+		ids = set()
+		for key in rng.sample(range(3), rng.randint(0, 3)):
+			ids.update(rng.sample(range(key * CHUNK_SIZE, key * CHUNK_SIZE + 8000), rng.choice((1, 10, 3000, 5000, 7900))))
+		
+		return ids
+	
+	for i in range(60):
+		sets = [sample() for i in range(rng.randint(1, 4))]
+		postings = [build_posting(rng, ids) for ids in sets]
+		a, b = sets[0], sets[-1]
+		
+		intersection = intersect_postings(postings[0], postings[-1])
+		assert list(intersection) == sorted(a & b)
+		assert len(intersection) == len(a & b)
+		
+		difference = subtract_postings(postings[0], postings[-1])
+		assert list(difference) == sorted(a - b)
+		assert len(difference) == len(a - b)
+		
+		union = merge_postings(postings)
+		assert list(union) == sorted(set().union(*sets))
+		assert len(union) == len(set().union(*sets))
+		
+		# Results share containers with their operands, which are left untouched.
+		assert [list(posting) for posting in postings] == [sorted(ids) for ids in sets]
+
+def test_add_remove():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	index.add(7, ["tag 0", tags[1], "tag 2"])
+	index.add(3, [tags[0]])
+	
+	assert len(index) == 2
+	assert 7 in index and 3 in index and 4 not in index
+	assert index.items[7] == (tags[0].tag_id, tags[1].get_canon().tag_id)
+	assert list(index.posting(tags[0])) == [3, 7]
+	assert list(index.posting(tags[2])) == [7]
+	
+	# Adding an existing item replaces its tags.
+	index.add(7, ["tag 4"])
+	assert list(index.posting(tags[0])) == [3]
+	assert list(index.posting(tags[1])) == []
+	assert list(index.posting(tags[4])) == [7]
+	
+	index.remove(3)
+	assert len(index) == 1
+	assert list(index.live) == [7]
+	assert tags[0].tag_id not in index.postings
+	
+	with pytest.raises(KeyError):
+		index.remove(3)
+	
+	with pytest.raises(TagIdentificationError):
+		index.add(8, ["zebra"])
+	
+	assert 8 not in index
+	
+	with pytest.raises(ValueError):
+		index.add(-1, ["tag 0"])
+	
+	with pytest.raises(ValueError):
+		index.add(1 << 32, ["tag 0"])
+	
+	assert len(index) == 1
+
+def test_search():
+	rng = random.Random(23)
+	
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	items = {}
+	for item_id in rng.sample(range(10000), 2000):
+		items[item_id] = rng.sample(tags, rng.choice((0, 1, 2, 5, 12)))
+		index.add(item_id, items[item_id])
+	
+	for item_id in rng.sample(list(items), 200):
+		index.remove(item_id)
+		del items[item_id]
+	
+	for i in range(300):
+		expr = TagExpression(random_expression(rng, rng.randint(1, 10), 30))
+		lib.tagify(expr)
+		matches = expr.compile()
+		
+		expected = sorted(item_id for item_id, item_tags in items.items() if matches({tag.get_canon().tag_id for tag in item_tags}))
+		assert list(index.search(expr)) == expected
+
+def test_search_dense():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	# Enough items that every tag's chunks are stored as bitmaps.
+	for item_id in range(CHUNK_SIZE + 20000):
+		index.add(item_id, [tags[item_id % 3], tags[3 + item_id % 5]])
+	
+	assert list(index.search("tag 0 AND tag 4")) == list(range(6, CHUNK_SIZE + 20000, 15))
+	assert list(index.search("tag 0 AND NOT tag 4")) == [item_id for item_id in range(0, CHUNK_SIZE + 20000, 3) if item_id % 5 != 1]
+	assert list(index.search("tag 0 OR tag 4")) == [item_id for item_id in range(CHUNK_SIZE + 20000) if item_id % 3 == 0 or item_id % 5 == 1]
+	assert list(index.search("NOT tag 1")) == list(range(0, CHUNK_SIZE + 20000, 3))
+
+def test_search_aliased_later():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	index.add(1, ["tag 5"])
+	index.add(2, ["tag 6"])
+	index.add(3, ["tag 7"])
+	
+	tags[5].alias(tags[6])
+	assert list(index.search("tag 5")) == [1, 2]
+	assert list(index.search("tag 6 AND NOT tag 7")) == [1, 2]
+	
+	tags[6].canonize()
+	assert list(index.search("NOT tag 5")) == [3]
+
+def test_search_results_are_copies():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	index.add(1, ["tag 5"])
+	
+	index.search("tag 5").append(2)
+	assert list(index.search("tag 5")) == [1]
+
+def test_search_invalid():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	with pytest.raises(TagIdentificationError):
+		index.search("zebra")
+
+def test_search_mapped(tmp_path):
+	lib, tags = build_library()
+	fn = str(tmp_path / "library.taglib2")
+	lib.save(fn, fmt="TAGLIB2")
+	
+	with MappedTagLibrary(fn) as mapped:
+		index = ItemIndex(mapped)
+		index.add(1, ["tag 2"])
+		index.add(2, ["tag 1", "tag 4"])
+		index.add(3, ["tag 4"])
+		
+		assert list(index.search("tag 1")) == [1, 2]
+		assert list(index.search("tag 2 AND NOT tag 4")) == [1]
+		assert list(index.search("NOT tag 20")) == [1, 2, 3]
+
+def test_search_expand():
+	lib, tags = build_library()
+	index = ItemIndex(lib)
+	
+	tags[5].imply(tags[4])
+	tags[6].imply(tags[5])
+	tags[7].alias(tags[6])
+	
+	index.add(1, ["tag 4"])
+	index.add(2, ["tag 5"])
+	index.add(3, ["tag 7"])
+	index.add(4, ["tag 8"])
+	
+	assert list(index.search("tag 4")) == [1]
+	assert list(index.search("tag 4", expand=True)) == [1, 2, 3]
+	assert list(index.search("tag 5 OR tag 8", expand=True)) == [2, 3, 4]
+	assert list(index.search("NOT tag 5", expand=True)) == [1, 4]
+	
+	tags[8].imply(tags[4])
+	assert list(index.search("tag 4", expand=True)) == [1, 2, 3, 4]
\ No newline at end of file
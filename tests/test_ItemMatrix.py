@@ -0,0 +1,127 @@
+import pytest
+import random
+
+from ..TagLibrary import TagLibrary
+from ..TagExpression import *
+from ..ItemMatrix import ItemMatrix
+from .helpers import random_expression
+
+numpy = pytest.importorskip("numpy")
+
+# Returns a library of 40 tags with some aliases and implications, and the sets of canonical ids of the tags of 500 items, drawn from the passed random.Random.
+def build_items(rng):
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(40)).created
+	for i in range(10, 40, 3):
+		tags[i].imply(tags[rng.randrange(i)])
+	
+	tags[1].alias(tags[2])
+	tags[3].alias(tags[4])
+	
+	items = [{tag.get_canon().tag_id for tag in rng.sample(tags, rng.choice((0, 1, 3, 8)))} for i in range(500)]
+	return lib, items
+
+# Returns the passed items as a packed bit matrix and in compressed sparse row form.
+def matrices(items):
+	dense = numpy.zeros((len(items), 48), dtype=bool)
+	for item_i, tag_ids in enumerate(items):
+		dense[item_i, list(tag_ids)] = True
+	
+	indptr = numpy.cumsum([0] + [len(tag_ids) for tag_ids in items])
+	indices = numpy.array([tag_id for tag_ids in items for tag_id in sorted(tag_ids)], dtype=numpy.int64)
+	
+	return ItemMatrix(bits=numpy.packbits(dense, axis=1, bitorder="little")), ItemMatrix(indptr=indptr, indices=indices)
+
+def test_evaluate():
+	rng = random.Random(25)
+	
+	lib, items = build_items(rng)
+	for matrix in matrices(items):
+		assert len(matrix) == 500
+		
+		for i in range(100):
+			expr = TagExpression(random_expression(rng, rng.randint(1, 10), 40))
+			lib.tagify(expr, expand=rng.random() < 0.5)
+			matches = expr.compile()
+			
+			expected = [matches(tag_ids) for tag_ids in items]
+			assert matrix.evaluate(expr).tolist() == expected
+			assert matrix.evaluate(expr, indices=True).tolist() == [item_i for item_i, match in enumerate(expected) if match]
+
+def test_evaluate_many():
+	rng = random.Random(25)
+	
+	lib, items = build_items(rng)
+	expr_strs = [random_expression(rng, rng.randint(1, 10), 40) for i in range(50)]
+	exprs = [TagExpression(expr_str) for expr_str in expr_strs + expr_strs[:1]]
+	for expr in exprs:
+		lib.tagify(expr)
+	
+	for matrix in matrices(items):
+		results = matrix.evaluate_many(exprs)
+		
+		assert len(results) == len(exprs)
+		for expr, result in zip(exprs, results):
+			assert result.tolist() == matrix.evaluate(expr).tolist()
+		
+		# Identical expressions share a tree, but not a result.
+		assert exprs[-1].root is exprs[0].root
+		assert not numpy.shares_memory(results[-1], results[0])
+
+def test_short_rows():
+	lib = TagLibrary(None)
+	lib.create_many(f"tag {i}" for i in range(40))
+	low, high = lib.get("tag 0").tag_id, lib.get("tag 39").tag_id
+	
+	expr = TagExpression("tag 0 OR NOT tag 39")
+	lib.tagify(expr)
+	
+	matrix = ItemMatrix(bits=numpy.array([[1 << low], [0]], dtype=numpy.uint8))
+	assert matrix.evaluate(expr).tolist() == [True, True]
+	
+	# Items with no tags, including at the end.
+	matrix = ItemMatrix(indptr=[0, 0, 1, 1, 2, 2], indices=[low, high])
+	assert matrix.evaluate(expr, indices=True).tolist() == [0, 1, 2, 4]
+
+def test_invalid():
+	with pytest.raises(ValueError):
+		ItemMatrix()
+	
+	with pytest.raises(ValueError):
+		ItemMatrix(bits=numpy.zeros((1, 1), dtype=numpy.uint8), indptr=[0, 0], indices=[])
+	
+	matrix = ItemMatrix(indptr=[0, 0], indices=[])
+	with pytest.raises(TagExpressionValidationError):
+		matrix.evaluate(TagExpression("this AND that"))
+
+
+def test_evaluate_large_ids():
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(300)).created
+	tags[298].imply(tags[2])
+	tags[299].imply(tags[2])
+	
+	# The ids of the later tags don't fit in the indices' dtype, so no item can have them.
+	matrix = ItemMatrix(indptr=numpy.array([0, 1, 3, 3]), indices=numpy.array([tags[1].tag_id, tags[1].tag_id, tags[2].tag_id], dtype=numpy.uint8))
+	for expr_str, expected in [("tag 299", []), ("tag 1 OR tag 299", [0, 1]), ("tag 2 OR tag 298 OR tag 299", [1]), ("NOT tag 299", [0, 1, 2])]:
+		expr = TagExpression(expr_str)
+		lib.tagify(expr)
+		assert matrix.evaluate(expr, indices=True).tolist() == expected
+	
+	expr = TagExpression("tag 2")
+	lib.tagify(expr, expand=True)
+	assert matrix.evaluate(expr, indices=True).tolist() == [1]
+	
+	assert matrix.column({tags[298].tag_id, tags[299].tag_id}).tolist() == [False, False, False]
+
+def test_evaluate_no_tags():
+	lib = TagLibrary(None)
+	lib.create_many(["tag 0", "tag 1"])
+	
+	expr = TagExpression("tag 0 OR NOT tag 1")
+	lib.tagify(expr, expand=True)
+	
+	for indptr in ([0], [0, 0, 0]):
+		matrix = ItemMatrix(indptr=indptr, indices=[])
+		assert matrix.evaluate(expr).tolist() == [True] * (len(indptr) - 1)
+		assert matrix.column({1, 2}).tolist() == [False] * (len(indptr) - 1)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import pytest
+import random
+
+from ..TagLibrary import TagLibrary, TagIntegrityError, TagIdentificationError
+from ..MappedTagLibrary import MappedTagLibrary, MappedTag
+from ..TagExpression import *
+
+def make_library():
+	lib = TagLibrary(None)
+	
+	basketball = lib.create("basketball")
+	ball = lib.create("ball")
+	sphere = lib.create("sphère")
+	sports = lib.create("sports")
+	lib.create("ballerina")
+	lib.create("zebra")
+	
+	basketball.imply(ball)
+	ball.alias(sphere)
+	ball.imply(lib.create("round"))
+	basketball.imply(sports)
+	lib.set_weight("ballerina", 5)
+	
+	return lib
+
+def test_mapped_lookup(tmpdir):
+	lib = make_library()
+	lib.save(tmpdir + "/test_mapped_lookup.taglib", fmt="TAGLIB2")
+	
+	with MappedTagLibrary(tmpdir + "/test_mapped_lookup.taglib") as mapped:
+		for name, tag in lib.items():
+			view = mapped.get(name.upper())
+			assert view.tag_id == tag.tag_id
+			assert view.name == name
+			assert view.weight == tag.weight
+			assert view.get_canon().tag_id == tag.get_canon().tag_id
+			
+			assert [other.tag_id for other in view.antecedents] == [other.tag_id for other in tag.antecedents]
+			assert [other.tag_id for other in view.implicants] == [other.tag_id for other in tag.implicants]
+			assert [other.tag_id for other in view.consequents] == [other.tag_id for other in tag.consequents]
+		
+		assert mapped.has("bal") is None
+		assert mapped.has("balls") is None
+		assert mapped.has("aardvark") is None
+		assert mapped.has("zzz") is None
+		
+		with pytest.raises(TagIdentificationError):
+			mapped.get("basket")
+		
+		assert mapped.get("ball") == mapped.get("ball")
+		assert mapped.get("ball") != mapped.get("sports")
+		assert mapped.get("basketball").does_directly_imply(mapped.get("sphère"))
+
+def test_mapped_prefix(tmpdir):
+	lib = make_library()
+	lib.save(tmpdir + "/test_mapped_prefix.taglib", fmt="TAGLIB2")
+	
+	with MappedTagLibrary(tmpdir + "/test_mapped_prefix.taglib") as mapped:
+		assert [name for name, tag in mapped.items("ba")] == ["ball", "ballerina", "basketball"]
+		assert [name for name, tag in mapped.items("ball")] == ["ball", "ballerina"]
+		assert [name for name, tag in mapped.items("q")] == []
+		assert [name for name, tag in mapped.items()] == sorted(name for name, tag in lib.items())
+		assert [tag.name for tag in mapped] == sorted(name for name, tag in lib.items())
+
+def test_mapped_closures(tmpdir):
+	rng = random.Random(14)
+	
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(60)).created
+	for i in range(120):
+		a, b = rng.sample(tags, 2)
+		
+		try:
+			a.imply(b)
+		
+		except TagIntegrityError:
+			pass
+	
+	lib.save(tmpdir + "/test_mapped_closures.taglib", fmt="TAGLIB2")
+	
+	with MappedTagLibrary(tmpdir + "/test_mapped_closures.taglib") as mapped:
+		for i, tag in enumerate(tags):
+			view = mapped.get(f"tag {i}")
+			assert {other.tag_id for other in view.all_consequents()} == {other.tag_id for other in tag.all_consequents()}
+			assert {other.tag_id for other in view.all_implicants()} == {other.tag_id for other in tag.all_implicants()}
+
+def test_mapped_tagify(tmpdir):
+	lib = make_library()
+	lib.save(tmpdir + "/test_mapped_tagify.taglib", fmt="TAGLIB2")
+	
+	with MappedTagLibrary(tmpdir + "/test_mapped_tagify.taglib") as mapped:
+		expr = TagExpression("ball AND NOT zebra")
+		mapped.tagify(expr)
+		
+		assert expr.root.left == mapped.get("ball")
+		assert expr.root.right.right == mapped.get("zebra")
+
+def test_mapped_errors(tmpdir):
+	lib = make_library()
+	
+	lib.save(tmpdir + "/test_mapped_errors.taglib")
+	with pytest.raises(ValueError):
+		MappedTagLibrary(tmpdir + "/test_mapped_errors.taglib")
+	
+	lib.save(tmpdir + "/test_mapped_errors.taglib", fmt="TAGLIB2")
+	with open(tmpdir + "/test_mapped_errors.taglib", "rb") as fin:
+		data = fin.read()
+	
+	with open(tmpdir + "/test_mapped_errors.taglib", "wb") as fout:
+		fout.write(data[:-16])
+	
+	with pytest.raises(ValueError):
+		MappedTagLibrary(tmpdir + "/test_mapped_errors.taglib")
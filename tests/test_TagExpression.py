@@ -1,4 +1,5 @@
 import pytest
+import random
 
 # TagExpression, TagExpressionParsingError, TagOperator, TagUnaryOperator, TagBinaryOperator, TagConjunction, TagDisjunction, TagNegation
 from ..TagExpression import *
@@ -317,3 +318,166 @@ def test_unary_binary_mix():
 	assert type(expr.root.right.right) is TagConjunction
 	assert      expr.root.right.right.left == "stuff"
 	assert      expr.root.right.right.right == "things"
+
+def test_parenthetical_left_operand():
+	expr = TagExpression("(this OR that) AND stuff")
+	
+	assert type(expr.root) is TagConjunction
+	assert      expr.root.right == "stuff"
+	assert type(expr.root.left) is TagDisjunction
+	assert      expr.root.left.left == "this"
+	assert      expr.root.left.right == "that"
+	
+	expr = TagExpression("((this) OR that) AND NOT (stuff OR things)")
+	
+	assert type(expr.root) is TagConjunction
+	assert type(expr.root.left) is TagDisjunction
+	assert      expr.root.left.left == "this"
+	assert      expr.root.left.right == "that"
+	assert type(expr.root.right) is TagNegation
+	assert type(expr.root.right.right) is TagDisjunction
+	assert      expr.root.right.right.left == "stuff"
+	assert      expr.root.right.right.right == "things"
+
+#### Test parser limits and error positions ####
+
+def test_error_positions():
+	for expr_str, error_i, message in [
+		("uh oh AND", 9, "Expression must not be empty. Did you forget an operand?"),
+		("uh oh AND    ", 9, "Expression must not be empty. Did you forget an operand?"),
+		("    AND uh oh", 0, "Expression must not be empty. Did you forget an operand?"),
+		("a AND  OR b", 5, "Expression must not be empty. Did you forget an operand?"),
+		("(NOT )", 4, "Expression must not be empty. Did you forget an operand?"),
+		("() AND uh oh", 0, "Empty expression."),
+		("a OR (b AND (c OR ()))", 18, "Empty expression."),
+		("((uh oh)", 0, "Unmatched open parenthesis."),
+		("uh) (oh", 4, "Unmatched open parenthesis."),
+		("(a OR b) AND c)", 14, "Unmatched close parenthesis."),
+		("uh (oh)", 3, "Expected operator before parenthetical."),
+		("uh ((a OR b))", 4, "Expected operator before parenthetical."),
+		("uh ((a) OR b)", 3, "Expected operator before parenthetical."),
+		("(uh) oh", 5, "Expected operator before tag or parenthetical."),
+		("a AND b NOT c", 8, "Expected operator before unary operator."),
+		("(a) NOT b", 4, "Expected operator before unary operator."),
+	]:
+		with pytest.raises(TagExpressionParsingError) as excinfo:
+			TagExpression(expr_str)
+		
+		assert excinfo.value.error_i == error_i
+		assert str(excinfo.value).startswith(f"Error at position {error_i}: {message}\n")
+
+def test_deep_nesting():
+	expr = TagExpression("(" * 10000 + "this" + ")" * 10000)
+	assert expr.root == "this"
+	
+	expr = TagExpression("NOT " * 10000 + "this")
+	node = expr.root
+	for i in range(10000):
+		assert type(node) is TagNegation
+		node = node.right
+	
+	assert node == "this"
+
+def test_long_expression():
+	expr = TagExpression(" OR ".join(f"(tag {i} AND NOT other {i})" for i in range(5000)))
+	
+	node = expr.root
+	for i in range(4999, 0, -1):
+		assert type(node) is TagDisjunction
+		assert type(node.right) is TagConjunction
+		assert node.right.left == f"tag {i}"
+		assert node.right.right.right == f"other {i}"
+		node = node.left
+	
+	assert node.left == "tag 0"
+
+# Renders the passed tree with as few parentheses as possible, or with parentheses around every operation.
+def render(node, parenthesize):
+	if type(node) is str:
+		return node
+	
+	if type(node) is TagNegation:
+		operand = render(node.right, parenthesize)
+		if type(node.right) is not str and (parenthesize or type(node.right) is not TagNegation):
+			operand = f"({operand})"
+		
+		return f"NOT {operand}"
+	
+	left = render(node.left, parenthesize)
+	if type(node.left) is not str and (parenthesize or node.left.priority < node.priority):
+		left = f"({left})"
+	
+	right = render(node.right, parenthesize)
+	if type(node.right) is not str and (parenthesize or node.right.priority <= node.priority):
+		right = f"({right})"
+	
+	return f"{left} {node.symbol} {right}"
+
+def same_tree(a, b):
+	if type(a) is not type(b):
+		return False
+	
+	if type(a) is str:
+		return a == b
+	
+	if type(a) is TagNegation:
+		return same_tree(a.right, b.right)
+	
+	return same_tree(a.left, b.left) and same_tree(a.right, b.right)
+
+def test_random_round_trip():
+	rng = random.Random(20)
+	
+	def build(depth):
+		kind = rng.randrange(4) if depth > 0 else 3
+		if kind == 0:
+			return TagNegation(build(depth - 1))
+		
+		if kind == 1:
+			return TagConjunction(build(depth - 1), build(depth - 1))
+		
+		if kind == 2:
+			return TagDisjunction(build(depth - 1), build(depth - 1))
+		
+		return rng.choice(["this", "that", "some thing", "other thing"])
+	
+	for i in range(500):
+		tree = build(5)
+		assert same_tree(TagExpression(render(tree, False)).root, tree)
+		assert same_tree(TagExpression(render(tree, True)).root, tree)
+
+#### Test expression cache ####
+
+def test_cache():
+	expr = TagExpression("this AND (that OR stuff)")
+	assert TagExpression("  this AND (that OR stuff) ").root is expr.root
+	assert TagExpression("this AND (that OR things)").root is not expr.root
+	
+	# Errors are not cached, and report positions in the string as passed.
+	for i in range(2):
+		with pytest.raises(TagExpressionParsingError) as excinfo:
+			TagExpression("  uh (oh)")
+		
+		assert excinfo.value.error_i == 5
+
+def test_cache_eviction():
+	maxsize = TagExpression.cache.maxsize
+	try:
+		TagExpression.cache.clear()
+		TagExpression.cache.maxsize = 2
+		
+		this = TagExpression("NOT this").root
+		that = TagExpression("NOT that").root
+		assert TagExpression("NOT this").root is this
+		
+		TagExpression("NOT stuff")
+		assert len(TagExpression.cache) == 2
+		assert TagExpression("NOT this").root is this
+		assert TagExpression("NOT that").root is not that
+		
+		TagExpression.cache.maxsize = 0
+		TagExpression.cache.clear()
+		assert TagExpression("NOT this").root is not TagExpression("NOT this").root
+	
+	finally:
+		TagExpression.cache.maxsize = maxsize
\ No newline at end of file
@@ -1,7 +1,10 @@
+import os
 import pytest
+import random
 
-from ..TagLibrary import TagLibrary, TagIntegrityError, TagIdentificationError
+from ..TagLibrary import TagLibrary, TagIntegrityError, TagIdentificationError, TagRelationSet, TagNode, LazyTagNode, TAGLIB2_MAGIC
 from ..TagExpression import *
+from .helpers import random_expression
 
 #### Test integrity validation ####
 
@@ -32,6 +35,32 @@ def test_tag_validation():
 		tag = lib.create("tag\n!")
 	lib.validate_integrity()
 
+def test_normalization():
+	lib = TagLibrary(None)
+	
+	assert lib.validate_and_normalize("  Big Dog ") == "big dog"
+	assert lib.validate_and_normalize("Ｂｉｇ　Ｄｏｇ") == "big dog"
+	assert lib.validate_and_normalize("ﬁsh") == "fish"
+	assert lib.validate_and_normalize("Ünïcode") == "ünïcode"
+	
+	with pytest.raises(ValueError):
+		lib.validate_and_normalize("tab\tin name")
+	
+	with pytest.raises(ValueError):
+		lib.validate_and_normalize("zero\u200bwidth")
+	
+	# The cache must not leak results between libraries with different disallowed characters.
+	assert lib.validate_and_normalize("a,b") == "a,b"
+	
+	strict_lib = TagLibrary(None, disallowed_chars=",")
+	with pytest.raises(ValueError):
+		strict_lib.validate_and_normalize("a,b")
+	
+	with pytest.raises(ValueError):
+		strict_lib.validate_and_normalize("ａ,ｂ")
+	
+	assert lib.validate_and_normalize("a,b") == "a,b"
+
 def test_basic_integrity_errors():
 	lib = TagLibrary(None)
 	
@@ -45,17 +74,24 @@ def test_basic_integrity_errors():
 	tag.antecedents = None
 	with pytest.raises(RuntimeError):
 		lib.validate_integrity()
-	tag.antecedents = []
+	tag.antecedents = TagRelationSet()
 	
 	tag.implicants = None
 	with pytest.raises(RuntimeError):
 		lib.validate_integrity()
-	tag.implicants = []
+	tag.implicants = TagRelationSet()
 	
 	tag.consequents = None
 	with pytest.raises(RuntimeError):
 		lib.validate_integrity()
+	tag.consequents = TagRelationSet()
+	
 	tag.consequents = []
+	with pytest.raises(RuntimeError):
+		lib.validate_integrity()
+	tag.consequents = TagRelationSet()
+	
+	lib.validate_integrity()
 
 def test_dupe_errors():
 	lib = TagLibrary(None)
@@ -77,17 +113,13 @@ def test_dupe_errors():
 	assert len(imp) > 0
 	assert len(con) > 0
 	
-	with pytest.raises(RuntimeError):
-		canon.antecedents += ant
-		lib.validate_integrity()
-	
-	with pytest.raises(RuntimeError):
-		tag3.implicants += imp
-		lib.validate_integrity()
+	# Relations are sets, so duplicates can not be added.
+	for relation in (ant, imp, con):
+		relation_len = len(relation)
+		relation.add(next(iter(relation)))
+		assert len(relation) == relation_len
 	
-	with pytest.raises(RuntimeError):
-		tag2.consequents += con
-		lib.validate_integrity()
+	lib.validate_integrity()
 
 #### Test integrity violations caught ####
 
@@ -108,7 +140,107 @@ def test_cant_get_nothing():
 	
 	lib.validate_integrity()
 
-# Note this doesn't prevent circular implication chains...
+def test_cant_imply_cycle():
+	lib = TagLibrary(None)
+	
+	a = lib.create("a")
+	b = lib.create("b")
+	c = lib.create("c")
+	d = lib.create("d")
+	
+	a.imply(b)
+	b.imply(c)
+	c.imply(d)
+	
+	with pytest.raises(TagIntegrityError):
+		d.imply(a)
+	
+	with pytest.raises(TagIntegrityError):
+		c.imply(a)
+	
+	with pytest.raises(TagIntegrityError):
+		b.imply(a)
+	
+	assert not d.does_directly_imply(a)
+	assert len(a.implicants) == 0
+	lib.validate_integrity()
+	
+	assert list(lib.topological_order()) == [d, c, b, a]
+	assert list(lib.topological_order(reverse=True)) == [a, b, c, d]
+
+def test_cant_alias_into_cycle():
+	lib = TagLibrary(None)
+	
+	a = lib.create("a")
+	b = lib.create("b")
+	c = lib.create("c")
+	
+	a.imply(b)
+	b.imply(c)
+	
+	# b would be equivalent to both.
+	with pytest.raises(TagIntegrityError):
+		a.alias(c)
+	
+	with pytest.raises(TagIntegrityError):
+		c.alias(a)
+	
+	assert a.get_canon() is a
+	assert c.get_canon() is c
+	lib.validate_integrity()
+	
+	# Aliasing two tags where one directly implies the other drops the implication.
+	a.alias(b)
+	lib.validate_integrity()
+	
+	assert list(b.consequents) == [c]
+	assert len(b.implicants) == 0
+	assert list(lib.topological_order()) == [c, b]
+
+def test_topological_order_random():
+	rng = random.Random(9)
+	
+	lib = TagLibrary(None)
+	tags = [lib.create(f"tag {i}") for i in range(30)]
+	
+	for step in range(400):
+		a = rng.choice(tags)
+		b = rng.choice(tags)
+		if a.get_canon() is b.get_canon():
+			continue
+		
+		if rng.random() < 0.9:
+			makes_cycle = a.get_canon() in reachable(b, "consequents")
+			if makes_cycle:
+				with pytest.raises(TagIntegrityError):
+					a.imply(b)
+			
+			else:
+				a.imply(b)
+		
+		elif a.canonical is None and len(a.antecedents) == 0:
+			makes_cycle = False
+			for start, target in ((a, b.get_canon()), (b.get_canon(), a)):
+				for consequent in start.consequents:
+					if consequent is not target and target in reachable(consequent, "consequents"):
+						makes_cycle = True
+			
+			if makes_cycle:
+				with pytest.raises(TagIntegrityError):
+					a.alias(b)
+			
+			else:
+				a.alias(b)
+		
+		lib.validate_integrity()
+	
+	ordered = list(lib.topological_order())
+	assert set(ordered) == {tag for tag in tags if tag.canonical is None}
+	
+	lib.sort_tag_order()
+	lib.validate_integrity()
+	assert None not in lib.tag_order
+
 def test_cant_imply_alias():
 	lib = TagLibrary(None)
 	
@@ -151,6 +283,59 @@ def test_iter():
 	for tag in ret_tags:
 		assert tag in all_tags
 
+def test_radix_split():
+	lib = TagLibrary(None)
+	
+	ballerina = lib.create("ballerina")
+	assert lib.root.children[ord("b")].key == "ballerina"
+	
+	ball = lib.create("ball")
+	balloon = lib.create("balloon")
+	basket = lib.create("basket")
+	lib.validate_integrity()
+	
+	# "ball" was split out of "ballerina", and "ba" out of "ball".
+	ba = lib.root.children[ord("b")]
+	assert ba.key == "ba"
+	assert ba.tag_id is None
+	assert ba.children[ord("l")] is ball
+	assert ball.key == "ll"
+	assert ball.children[ord("e")] is ballerina
+	assert ballerina.key == "erina"
+	assert ball.children[ord("o")] is balloon
+	assert balloon.key == "oon"
+	
+	assert lib.has("ballerina") is ballerina
+	assert lib.has("balloon") is balloon
+	assert lib.has("ball") is ball
+	assert lib.has("basket") is basket
+	assert lib.has("ba") is None
+	assert lib.has("bal") is None
+	assert lib.has("balle") is None
+	assert lib.has("ballerinas") is None
+	assert lib.has("bask") is None
+	
+	assert set(lib) == {ballerina, ball, balloon, basket}
+
+def test_compact_nodes():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	basket = lib.create("basket")
+	
+	assert not hasattr(ball, "__dict__")
+	
+	# Leaves share a single read-only children mapping until they gain a child.
+	assert ball.children is basket.children
+	with pytest.raises(TypeError):
+		ball.children[0] = ball
+	
+	balloon = lib.create("balloon")
+	assert ball.children is not basket.children
+	assert ball.children[ord("o")] is balloon
+	assert len(basket.children) == 0
+	lib.validate_integrity()
+
 def test_add_recall():
 	lib = TagLibrary(None)
 	tag1 = lib.create("my tag")
@@ -171,6 +356,171 @@ def test_has():
 	assert lib.has("bl") is None
 	assert lib.has("bleh") is bleh
 
+def test_name_index(tmpdir):
+	lib = TagLibrary(None, name_index=True)
+	
+	ball = lib.create("ball")
+	ballerina = lib.create("Ballerina")
+	
+	assert lib.name_index == {"ball": ball, "ballerina": ballerina}
+	assert lib.has("BALL ") is ball
+	assert lib.has("bal") is None
+	assert lib.get("ballerina") is ballerina
+	
+	lib.save(tmpdir + "/test_name_index.taglib")
+	new_lib = TagLibrary(tmpdir + "/test_name_index.taglib", name_index=True)
+	
+	assert new_lib.name_index.keys() == {"ball", "ballerina"}
+	assert new_lib.has("ballerina").tag_id == ballerina.tag_id
+	
+	# The index is opt-in.
+	assert TagLibrary(None).name_index is None
+
+def test_items():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	ballerina = lib.create("ballerina")
+	basket = lib.create("basket")
+	
+	assert dict(lib.items()) == {"ball": ball, "ballerina": ballerina, "basket": basket}
+
+def test_create_many():
+	lib = TagLibrary(None, disallowed_chars=",")
+	ball = lib.create("ball")
+	
+	report = lib.create_many(["Basket", "ballerina", "bad,name", "ball", "balloon", "basket", "b"])
+	lib.validate_integrity()
+	
+	assert [tag.tag_id for tag in report.created] == [2, 3, 4, 5]
+	assert report.created == [lib.get("basket"), lib.get("ballerina"), lib.get("balloon"), lib.get("b")]
+	assert lib.next_id == 6
+	
+	assert [name for name, err in report.rejected] == ["bad,name", "ball", "basket"]
+	assert type(report.rejected[0][1]) is ValueError
+	assert type(report.rejected[1][1]) is TagIntegrityError
+	assert type(report.rejected[2][1]) is TagIntegrityError
+	
+	assert lib.get("ball") is ball
+
+# Tags created in bulk must end up exactly as if they had been created one at a time.
+def test_create_many_matches_create():
+	names = [
+		"a", "ab", "abc", "abd", "b", "ba", "bab", "abcdef", "abcdeg", "abx", "z",
+		"xyz", "xy", "x", "xyzzy", "xyzw", "dog", "dogs", "doge", "do", "d", "é", "éa", "éb"
+	]
+	
+	lib = TagLibrary(None)
+	for name in names:
+		lib.create(name)
+	
+	bulk_lib = TagLibrary(None)
+	report = bulk_lib.create_many(names)
+	
+	assert len(report.rejected) == 0
+	bulk_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, bulk_lib)
+
+def test_complete():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	ballerina = lib.create("ballerina")
+	balloon = lib.create("balloon")
+	basket = lib.create("basket")
+	bat = lib.create("bat")
+	lib.create("cat")
+	
+	lib.set_weight("ballerina", 5)
+	lib.set_weight("bat", 7)
+	lib.set_weight("balloon", 5)
+	lib.set_weight("ball", 1)
+	lib.validate_integrity()
+	
+	assert lib.complete("ba", 3) == [("bat", bat), ("ballerina", ballerina), ("balloon", balloon)]
+	assert lib.complete("Ba", 10) == [("bat", bat), ("ballerina", ballerina), ("balloon", balloon), ("ball", ball), ("basket", basket)]
+	assert lib.complete("ball", 2) == [("ballerina", ballerina), ("balloon", balloon)]
+	assert lib.complete("balle") == [("ballerina", ballerina)]
+	assert lib.complete("bas") == [("basket", basket)]
+	assert lib.complete("bask") == [("basket", basket)]
+	assert lib.complete("basket") == [("basket", basket)]
+	assert lib.complete("baskets") == []
+	assert lib.complete("dog") == []
+	assert len(lib.complete("", 100)) == 6
+	
+	# Lowering a weight must lower the cached maxima above it.
+	lib.set_weight("bat", 0)
+	lib.validate_integrity()
+	assert lib.complete("ba", 1) == [("ballerina", ballerina)]
+	
+	with pytest.raises(TagIdentificationError):
+		lib.set_weight("bal", 3)
+
+def test_complete_canonicalizes():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	spheroid = lib.create("spheroid")
+	lib.create("spear")
+	
+	spheroid.alias(sphere)
+	ball.alias(sphere)
+	
+	lib.set_weight("spheroid", 3)
+	lib.set_weight("sphere", 2)
+	
+	assert lib.complete("sp", 2) == [("spheroid", sphere), ("spear", lib.get("spear"))]
+
+def levenshtein(a, b):
+	row = list(range(len(b) + 1))
+	for a_i in range(len(a)):
+		prev_row = row
+		row = [a_i + 1]
+		for b_i in range(len(b)):
+			row.append(min(prev_row[b_i + 1] + 1, row[b_i] + 1, prev_row[b_i] + (a[a_i] != b[b_i])))
+	
+	return row[-1]
+
+def test_fuzzy():
+	lib = TagLibrary(None)
+	
+	names = ["ball", "balls", "bell", "bells", "ballerina", "call", "tall", "all", "a", "basket", "bat", "cat", "cart"]
+	for name in names:
+		lib.create(name)
+	
+	assert lib.fuzzy("bal", 1) == [("ball", 1, lib.get("ball")), ("bat", 1, lib.get("bat"))]
+	assert lib.fuzzy("ball", 0) == [("ball", 0, lib.get("ball"))]
+	assert lib.fuzzy("ball", 1, 3) == [("ball", 0, lib.get("ball")), ("all", 1, lib.get("all")), ("balls", 1, lib.get("balls"))]
+	assert lib.fuzzy("zzzzzz", 2) == []
+	
+	# Compare against brute force.
+	for query in ["bal", "cats", "", "bllerina", "xall", "b", "ballss"]:
+		for max_distance in range(4):
+			expected = sorted((levenshtein(query, name), name) for name in names if levenshtein(query, name) <= max_distance)
+			
+			for k in (1, 3, 100):
+				results = lib.fuzzy(query, max_distance, k)
+				assert [(distance, name) for name, distance, node in results] == expected[:k]
+
+def test_tagify_suggestions():
+	lib = TagLibrary(None)
+	lib.create("ball")
+	lib.create("basket")
+	
+	expr = TagExpression("basket AND bal")
+	with pytest.raises(TagIdentificationError) as err_info:
+		lib.tagify(expr, suggestions=3)
+	
+	assert err_info.value.suggestions == ["ball"]
+	assert "ball" in str(err_info.value)
+	
+	expr = TagExpression("basket AND bal")
+	with pytest.raises(TagIdentificationError) as err_info:
+		lib.tagify(expr)
+	
+	assert err_info.value.suggestions == []
+
 def test_alias():
 	lib = TagLibrary(None)
 	
@@ -197,6 +547,45 @@ def test_multi_alias():
 	assert ball.get_canon() is spheroid.get_canon()
 	lib.validate_integrity()
 
+def test_merge_alias_groups():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	orb = lib.create("orb")
+	globe = lib.create("globe")
+	round_thing = lib.create("round thing")
+	toy = lib.create("toy")
+	shape = lib.create("shape")
+	basketball = lib.create("basketball")
+	
+	ball.alias(sphere)
+	orb.alias(sphere)
+	round_thing.alias(globe)
+	
+	sphere.imply(shape)
+	globe.imply(toy)
+	basketball.imply(round_thing)
+	lib.validate_integrity()
+	
+	# The smaller group joins the larger one, whichever way around they are passed.
+	globe.alias(ball)
+	lib.validate_integrity()
+	
+	for tag in (ball, orb, globe, round_thing):
+		assert tag.get_canon() is sphere
+	
+	assert set(sphere.antecedents) == {ball, orb, globe, round_thing}
+	assert set(sphere.consequents) == {shape, toy}
+	assert set(sphere.implicants) == {basketball}
+	assert len(globe.consequents) == 0
+	assert basketball.does_directly_imply(ball)
+	
+	# Aliasing tags which are already aliases does nothing.
+	orb.alias(round_thing)
+	lib.validate_integrity()
+	assert orb.get_canon() is sphere
+
 def test_implication_migration():
 	lib = TagLibrary(None)
 	
@@ -334,6 +723,116 @@ def test_consequent_migration_no_dupes():
 	assert basketball.does_directly_imply(sphere)
 	assert basket_ball.does_directly_imply(ball)
 
+def test_all_implications():
+	lib = TagLibrary(None)
+	
+	animal = lib.create("animal")
+	mammal = lib.create("mammal")
+	dog = lib.create("dog")
+	puppy = lib.create("puppy")
+	cat = lib.create("cat")
+	pet = lib.create("pet")
+	
+	mammal.imply(animal)
+	dog.imply(mammal)
+	cat.imply(mammal)
+	puppy.imply(dog)
+	dog.imply(pet)
+	
+	assert puppy.all_consequents() == {dog, mammal, animal, pet}
+	assert animal.all_implicants() == {mammal, dog, cat, puppy}
+	assert pet.all_implicants() == {dog, puppy}
+	assert animal.all_consequents() == set()
+	
+	# Closures of everything visited along the way are cached.
+	assert lib.consequent_closures[dog] == {mammal, animal, pet}
+	
+	# Only the affected tags are invalidated.
+	kitten = lib.create("kitten")
+	kitten.imply(cat)
+	
+	assert lib.consequent_closures[dog] == {mammal, animal, pet}
+	assert cat not in lib.implicant_closures
+	assert animal not in lib.implicant_closures
+	assert mammal not in lib.implicant_closures
+	assert animal.all_implicants() == {mammal, dog, cat, puppy, kitten}
+	
+	# Aliases share the closures of their canonical form.
+	hound = lib.create("hound")
+	hound.alias(dog)
+	assert hound.all_consequents() == {mammal, animal, pet}
+	assert hound.all_implicants() == {puppy}
+	
+	# Aliasing moves implications, which must be reflected in the cache.
+	feline = lib.create("feline")
+	wildcat = lib.create("wildcat")
+	wildcat.imply(feline)
+	
+	assert feline.all_implicants() == {wildcat}
+	assert animal.all_implicants() == {mammal, dog, cat, puppy, kitten}
+	
+	feline.alias(cat)
+	assert cat.all_implicants() == {kitten, wildcat}
+	assert wildcat.all_consequents() == {cat, mammal, animal}
+	assert animal.all_implicants() == {mammal, dog, cat, puppy, kitten, wildcat}
+	lib.validate_integrity()
+
+def reachable(tag, relation):
+	found = set()
+	stack = [tag.get_canon()]
+	while len(stack) > 0:
+		for related in getattr(stack.pop(), relation):
+			if related not in found:
+				found.add(related)
+				stack.append(related)
+	
+	return found
+
+def test_all_implications_random():
+	rng = random.Random(8)
+	
+	lib = TagLibrary(None)
+	tags = [lib.create(f"tag {i}") for i in range(40)]
+	
+	for step in range(300):
+		a = rng.choice(tags)
+		b = rng.choice(tags)
+		related = {a.get_canon()} | reachable(a, "consequents") | reachable(a, "implicants")
+		
+		if rng.random() < 0.8:
+			# Avoid creating cycles.
+			if b.get_canon() not in related:
+				a.imply(b)
+		
+		elif a.get_canon() is not b.get_canon() and b.get_canon() not in related:
+			if a.canonical is None and len(a.antecedents) == 0 or b.canonical is None and len(b.antecedents) == 0:
+				a.alias(b)
+		
+		tag = rng.choice(tags)
+		assert tag.all_consequents() == reachable(tag, "consequents")
+		assert tag.all_implicants() == reachable(tag, "implicants")
+	
+	lib.validate_integrity()
+	for tag in tags:
+		assert tag.all_consequents() == reachable(tag, "consequents")
+		assert tag.all_implicants() == reachable(tag, "implicants")
+
+def test_relation_order():
+	lib = TagLibrary(None)
+	
+	hub = lib.create("hub")
+	tags = [lib.create(f"tag {i}") for i in range(20)]
+	for tag in reversed(tags):
+		tag.imply(hub)
+	
+	assert list(hub.implicants) == list(reversed(tags))
+	
+	# Moving implications to a canonical form keeps their order.
+	alias = lib.create("alias")
+	hub.alias(alias)
+	assert list(hub.get_canon().implicants) == list(reversed(tags))
+	lib.validate_integrity()
+
 #### Test tagify errors ####
 
 def test_infinite_tagify():
@@ -342,6 +841,7 @@ def test_infinite_tagify():
 	expr = TagExpression("NOT tag")
 	
 	assert type(expr.root) is TagNegation
+	expr.root = TagNegation("tag") # Parsed trees are shared, so build a new one to modify.
 	expr.root.right = expr.root # Create infinite regress.
 	
 	with pytest.raises(RuntimeError):
@@ -402,6 +902,166 @@ def test_save_simple(tmpdir):
 	new_lib.validate_integrity()
 	TagLibrary.validate_identical(lib, new_lib)
 
+# The file stores one node per codepoint, regardless of how keys are split in memory.
+def test_save_format(tmpdir):
+	lib = TagLibrary(None)
+	
+	lib.create("ab")
+	lib.create("ac")
+	
+	lib.save(tmpdir + "/test_save_format.taglib")
+	with open(tmpdir + "/test_save_format.taglib", "rb") as fin:
+		data = fin.read()
+	
+	no_relations = (0).to_bytes(4) + (0).to_bytes(2) * 3
+	assert data == (
+		(3).to_bytes(4) +
+		b"\x00" + (1).to_bytes(4) +
+		b"a" + b"\x00" + (2).to_bytes(4) +
+		b"b" + b"\x01" + (1).to_bytes(4) + no_relations + (0).to_bytes(4) +
+		b"c" + b"\x01" + (2).to_bytes(4) + no_relations + (0).to_bytes(4)
+	)
+	
+	new_lib = TagLibrary(tmpdir + "/test_save_format.taglib")
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	
+	assert new_lib.root.children[ord("a")].key == "a"
+
+def test_save_long_keys(tmpdir):
+	lib = TagLibrary(None)
+	
+	lib.create("ballerina")
+	lib.create("ball")
+	lib.create("balloon")
+	lib.create("bäsket")
+	lib.create("x" * 5000)
+	
+	lib.save(tmpdir + "/test_save_long_keys.taglib")
+	new_lib = TagLibrary(tmpdir + "/test_save_long_keys.taglib")
+	
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	assert new_lib.has("x" * 5000) is not None
+
+def test_load_truncated(tmpdir):
+	lib = TagLibrary(None)
+	
+	lib.create("ball")
+	lib.create("basket")
+	
+	lib.save(tmpdir + "/test_load_truncated.taglib")
+	with open(tmpdir + "/test_load_truncated.taglib", "rb") as fin:
+		data = fin.read()
+	
+	with open(tmpdir + "/test_load_truncated.taglib", "wb") as fout:
+		fout.write(data[:-3])
+	
+	with pytest.raises(ValueError):
+		TagLibrary(tmpdir + "/test_load_truncated.taglib")
+
+def test_save_relation_limit(tmpdir):
+	lib = TagLibrary(None)
+	
+	tag = lib.create("ball")
+	tag.consequents = TagRelationSet.fromkeys(range(0x10000))
+	
+	with pytest.raises(TagIntegrityError):
+		lib.save(tmpdir + "/test_save_relation_limit.taglib")
+
+def test_load_csv(tmpdir):
+	with open(tmpdir + "/test_load_csv.csv", "w", newline="") as fout:
+		fout.write("name,notes\nball,round\nBasket,\nball,again\n\"bad\nname\",\n")
+	
+	lib = TagLibrary(None)
+	report = lib.load(tmpdir + "/test_load_csv.csv", fmt="CSV")
+	lib.validate_integrity()
+	
+	assert lib.get("ball").tag_id == 1
+	assert lib.get("basket").tag_id == 2
+	assert [name for name, err in report.rejected] == ["ball", "bad\nname"]
+
+def test_save_csv_id_order(tmpdir):
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"t{i}" for i in range(25)).created
+	tags[3].alias(tags[11])
+	tags[20].imply(tags[2])
+	
+	# Names sort as t0, t1, t10, t11, ..., so rows must be ordered by id rather than by name for the ids to survive loading.
+	lib.save(tmpdir + "/test_save_csv_id_order.csv", fmt="CSV")
+	with open(tmpdir + "/test_save_csv_id_order.csv", newline="") as fin:
+		assert [row.split(",")[1] for row in fin.read().splitlines()[1:]] == [str(i) for i in range(1, 26)]
+	
+	new_lib = TagLibrary(None)
+	report = new_lib.load(tmpdir + "/test_save_csv_id_order.csv", fmt="CSV")
+	assert report.rejected == []
+	
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	assert new_lib.get("t11").tag_id == 12
+
+def test_save_csv(tmpdir):
+	lib = TagLibrary(None)
+	
+	basketball = lib.create("basketball")
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	sports = lib.create("sports, etc.")
+	orb = lib.create("orb")
+	
+	basketball.imply(ball)
+	ball.alias(sphere)
+	orb.alias(sphere)
+	basketball.imply(sports)
+	
+	lib.save(tmpdir + "/test_save_csv.csv", fmt="CSV")
+	with open(tmpdir + "/test_save_csv.csv", newline="") as fin:
+		assert fin.read().splitlines() == [
+			"name,id,canonical,consequents,implicants",
+			"basketball,1,,3 4,",
+			"ball,2,3,,",
+			"sphere,3,,,1",
+			"\"sports, etc.\",4,,,1",
+			"orb,5,3,,",
+		]
+	
+	new_lib = TagLibrary(None)
+	report = new_lib.load(tmpdir + "/test_save_csv.csv", fmt="CSV")
+	assert report.rejected == []
+	
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+
+def test_load_csv_relations(tmpdir):
+	with open(tmpdir + "/test_load_csv_relations.csv", "w", newline="") as fout:
+		fout.write("name,id,canonical,consequents\nball,10,,\nsphere,20,10,\norb,30,20,\nbasketball,40,,20 99\nround,50,,50\nball,60,,10\n")
+	
+	lib = TagLibrary(None)
+	report = lib.load(tmpdir + "/test_load_csv_relations.csv", fmt="CSV")
+	lib.validate_integrity()
+	
+	assert [name for name, err in report.rejected] == ["ball", "orb", "basketball", "round"]
+	
+	assert lib.get("sphere").get_canon() is lib.get("ball")
+	assert lib.get("orb").get_canon() is lib.get("orb")
+	assert lib.get("basketball").does_directly_imply(lib.get("ball"))
+	assert lib.get("round").consequents == TagRelationSet()
+
+def test_load_csv_cycle(tmpdir):
+	with open(tmpdir + "/test_load_csv_cycle.csv", "w", newline="") as fout:
+		fout.write("name,id,consequents,implicants\nball,1,2,3\nsphere,2,3,\nround,3,,\n")
+	
+	lib = TagLibrary(None)
+	report = lib.load(tmpdir + "/test_load_csv_cycle.csv", fmt="CSV")
+	lib.validate_integrity()
+	
+	# Round implies ball, which implies sphere, so sphere can't imply round.
+	assert [(name, type(err)) for name, err in report.rejected] == [("sphere", TagIntegrityError)]
+	assert lib.get("ball").does_directly_imply(lib.get("sphere"))
+	assert lib.get("round").does_directly_imply(lib.get("ball"))
+	assert not lib.get("sphere").does_directly_imply(lib.get("round"))
+	assert list(lib.topological_order()) == [lib.get("sphere"), lib.get("ball"), lib.get("round")]
+
 def test_save_aliases(tmpdir):
 	lib = TagLibrary(None)
 	
@@ -435,6 +1095,8 @@ def test_save_implications(tmpdir):
 	
 	new_lib.validate_integrity()
 	TagLibrary.validate_identical(lib, new_lib)
+	
+	assert [tag.tag_id for tag in new_lib.topological_order(reverse=True)][0] == basketball.tag_id
 
 def test_save_aliases_implications(tmpdir):
 	lib = TagLibrary(None)
@@ -452,4 +1114,563 @@ def test_save_aliases_implications(tmpdir):
 	new_lib = TagLibrary(tmpdir + "/test_save_aliases_implications.taglib")
 	
 	new_lib.validate_integrity()
-	TagLibrary.validate_identical(lib, new_lib)
\ No newline at end of file
+	TagLibrary.validate_identical(lib, new_lib)
+
+def test_save_v2(tmpdir):
+	lib = TagLibrary(None)
+	
+	basketball = lib.create("basketball")
+	ball = lib.create("ball")
+	sphere = lib.create("sphère")
+	sports = lib.create("sports")
+	lib.create("ballerina")
+	
+	basketball.imply(ball)
+	ball.alias(sphere)
+	basketball.imply(sports)
+	lib.set_weight("ballerina", 5)
+	
+	lib.save(tmpdir + "/test_save_v2.taglib", fmt="TAGLIB2")
+	with open(tmpdir + "/test_save_v2.taglib", "rb") as fin:
+		data = fin.read()
+	
+	assert data.startswith(TAGLIB2_MAGIC)
+	assert len(data) % 8 == 0
+	
+	# The format is detected from the magic number.
+	new_lib = TagLibrary(tmpdir + "/test_save_v2.taglib")
+	
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	
+	assert new_lib.get("ballerina").weight == 5
+	assert new_lib.root.max_weight == 5
+	assert [name for name, tag in new_lib.complete("ba", k=1)] == ["ballerina"]
+	
+	new_lib.save(tmpdir + "/test_save_v2_again.taglib", fmt="TAGLIB2")
+	with open(tmpdir + "/test_save_v2_again.taglib", "rb") as fin:
+		assert fin.read() == data
+
+def test_save_v2_many_relations(tmpdir):
+	lib = TagLibrary(None)
+	
+	report = lib.create_many(f"tag {i}" for i in range(70000))
+	everything = lib.create("everything")
+	for tag in report.created:
+		everything.imply(tag)
+	
+	with pytest.raises(TagIntegrityError):
+		lib.save(tmpdir + "/test_save_v2_many_relations.taglib")
+	
+	lib.save(tmpdir + "/test_save_v2_many_relations.taglib", fmt="TAGLIB2")
+	new_lib = TagLibrary(tmpdir + "/test_save_v2_many_relations.taglib")
+	
+	assert len(new_lib.get("everything").consequents) == 70000
+	assert new_lib.get("tag 123").implicants == TagRelationSet.fromkeys([new_lib.get("everything")])
+
+def test_load_v2_truncated(tmpdir):
+	lib = TagLibrary(None)
+	
+	lib.create("ball")
+	lib.create("basket")
+	
+	lib.save(tmpdir + "/test_load_v2_truncated.taglib", fmt="TAGLIB2")
+	with open(tmpdir + "/test_load_v2_truncated.taglib", "rb") as fin:
+		data = fin.read()
+	
+	with open(tmpdir + "/test_load_v2_truncated.taglib", "wb") as fout:
+		fout.write(data[:-12])
+	
+	with pytest.raises(ValueError):
+		TagLibrary(tmpdir + "/test_load_v2_truncated.taglib")
+
+def test_load_lazy(tmpdir):
+	lib = TagLibrary(None)
+	
+	basketball = lib.create("basketball")
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	sports = lib.create("sports")
+	lib.create("ballerina")
+	lib.create("zebra")
+	
+	basketball.imply(ball)
+	ball.alias(sphere)
+	basketball.imply(sports)
+	lib.set_weight("ballerina", 5)
+	
+	lib.save(tmpdir + "/test_load_lazy.taglib", fmt="TAGLIB2")
+	new_lib = TagLibrary(tmpdir + "/test_load_lazy.taglib", lazy=True, name_index=True)
+	
+	# Only the subtree which is descended into is read, and relations are read on first access.
+	new_basketball = new_lib.get("basketball")
+	assert type(new_basketball) is LazyTagNode
+	assert ord("z") in new_lib.root.children.pending
+	assert ord("s") in new_lib.root.children.pending
+	
+	assert new_basketball.does_directly_imply(new_lib.get("sphere"))
+	assert type(new_basketball) is TagNode
+	assert ord("s") not in new_lib.root.children.pending
+	assert ord("z") in new_lib.root.children.pending
+	
+	assert [name for name, tag in new_lib.complete("ba", k=1)] == ["ballerina"]
+	assert new_lib.has("basket") is None
+	
+	# Modifying the library reads the rest of it.
+	new_lib.create("basket")
+	assert new_lib.lazy is None
+	assert new_lib.name_index["zebra"] is new_lib.get("zebra")
+	
+	new_lib.validate_integrity()
+	lib.create("basket")
+	TagLibrary.validate_identical(lib, new_lib)
+
+def test_load_lazy_random(tmpdir):
+	rng = random.Random(15)
+	
+	lib = TagLibrary(None)
+	tags = lib.create_many("".join(rng.choice("abcé ") for i in range(rng.randint(1, 6))) for j in range(300)).created
+	for i in range(300):
+		a, b = rng.sample(tags, 2)
+		
+		try:
+			if rng.random() < 0.2:
+				a.alias(b)
+			
+			else:
+				a.imply(b)
+		
+		except TagIntegrityError:
+			pass
+	
+	lib.save(tmpdir + "/test_load_lazy_random.taglib", fmt="TAGLIB2")
+	new_lib = TagLibrary(tmpdir + "/test_load_lazy_random.taglib", lazy=True)
+	
+	for tag in rng.sample(tags, 20):
+		name = next(name for name, other in lib.items() if other is tag)
+		new_tag = new_lib.get(name)
+		
+		assert {other.tag_id for other in new_tag.all_consequents()} == {other.tag_id for other in tag.all_consequents()}
+		assert {other.tag_id for other in new_tag.all_implicants()} == {other.tag_id for other in tag.all_implicants()}
+		assert new_tag.get_canon().tag_id == tag.get_canon().tag_id
+	
+	TagLibrary.validate_identical(lib, new_lib)
+	new_lib.validate_integrity()
+
+def test_load_lazy_requires_v2(tmpdir):
+	lib = TagLibrary(None)
+	lib.create("ball")
+	
+	lib.save(tmpdir + "/test_load_lazy_requires_v2.taglib")
+	
+	with pytest.raises(ValueError):
+		TagLibrary(tmpdir + "/test_load_lazy_requires_v2.taglib", lazy=True)
+	
+	with pytest.raises(RuntimeError):
+		TagLibrary(tmpdir + "/test_load_lazy_requires_v2.taglib", fmt="TAGLIB", lazy=True)
+
+def test_canonize():
+	lib = TagLibrary(None)
+	
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	orb = lib.create("orb")
+	basketball = lib.create("basketball")
+	shape = lib.create("shape")
+	
+	ball.alias(sphere)
+	orb.alias(sphere)
+	basketball.imply(ball)
+	sphere.imply(shape)
+	assert sphere.all_consequents() == frozenset([shape])
+	
+	ball.canonize()
+	lib.validate_integrity()
+	
+	for tag in (ball, sphere, orb):
+		assert tag.get_canon() is ball
+	
+	assert set(ball.antecedents) == {sphere, orb}
+	assert ball.consequents == TagRelationSet.fromkeys([shape])
+	assert ball.implicants == TagRelationSet.fromkeys([basketball])
+	assert len(sphere.consequents) == 0 and len(sphere.implicants) == 0
+	assert basketball.all_consequents() == frozenset([ball, shape])
+	
+	# Canonizing a canonical tag does nothing.
+	ball.canonize()
+	lib.validate_integrity()
+	assert ball.get_canon() is ball
+
+def make_journaled_changes(lib):
+	ball = lib.get("ball")
+	sphere = lib.create("sphere")
+	orb = lib.create("orb")
+	sports = lib.create("sports")
+	
+	ball.alias(sphere)
+	orb.alias(ball)
+	lib.get("basketball").imply(orb)
+	lib.get("basketball").imply(sports)
+	orb.canonize()
+	lib.set_weight("sports", 3)
+
+def test_journal(tmpdir):
+	fn = tmpdir + "/test_journal.taglib"
+	
+	lib = TagLibrary(None)
+	lib.create("basketball")
+	lib.create("ball")
+	lib.open_journal(fn, batch_size=4)
+	
+	assert os.path.exists(fn)
+	header_size = os.path.getsize(fn + ".journal")
+	
+	# Records are written in batches.
+	lib.create("round")
+	lib.get("round").imply(lib.get("ball"))
+	assert os.path.getsize(fn + ".journal") == header_size
+	
+	make_journaled_changes(lib)
+	assert os.path.getsize(fn + ".journal") > header_size
+	lib.flush()
+	
+	new_lib = TagLibrary(fn)
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	
+	assert new_lib.get("ball").get_canon() is new_lib.get("orb")
+	assert new_lib.get("sports").weight == 3
+	
+	# Changes are appended to an existing journal.
+	lib.close_journal()
+	new_lib.open_journal(fn)
+	new_lib.create("zebra")
+	new_lib.close_journal()
+	
+	newer_lib = TagLibrary(fn, lazy=True)
+	assert newer_lib.has("zebra") is not None
+	assert newer_lib.has("round") is not None
+
+def test_journal_torn_record(tmpdir):
+	fn = tmpdir + "/test_journal_torn_record.taglib"
+	
+	lib = TagLibrary(None)
+	lib.create("basketball")
+	lib.create("ball")
+	lib.open_journal(fn)
+	
+	make_journaled_changes(lib)
+	lib.close_journal()
+	
+	# A record cut short by a crash is ignored.
+	with open(fn + ".journal", "ab") as fout:
+		fout.write(b"\x01\x09\x00\x00\x00\x05\x00\x00\x00ze")
+	
+	new_lib = TagLibrary(fn)
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+
+def test_journal_append_after_torn_record(tmpdir):
+	fn = tmpdir + "/test_journal_append_after_torn_record.taglib"
+	
+	lib = TagLibrary(None)
+	lib.create("basketball")
+	lib.create("ball")
+	lib.open_journal(fn)
+	
+	make_journaled_changes(lib)
+	lib.close_journal()
+	
+	# Cut the last record, which sets the weight of "sports", in half.
+	with open(fn + ".journal", "r+b") as fout:
+		fout.truncate(os.path.getsize(fn + ".journal") - 5)
+	
+	lib = TagLibrary(fn, journal=True)
+	assert lib.get("sports").weight == 0
+	
+	# New records replace the partial one, rather than following it.
+	lib.create("zebra")
+	lib.set_weight("sports", 4)
+	lib.close_journal()
+	
+	new_lib = TagLibrary(fn)
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	
+	assert new_lib.get("zebra") is not None
+	assert new_lib.get("sports").weight == 4
+
+def test_journal_compact(tmpdir):
+	fn = tmpdir + "/test_journal_compact.taglib"
+	
+	lib = TagLibrary(None)
+	lib.create("basketball")
+	lib.create("ball")
+	lib.save(fn)
+	
+	lib = TagLibrary(fn, journal=True)
+	make_journaled_changes(lib)
+	lib.flush()
+	
+	with open(fn + ".journal", "rb") as fin:
+		old_journal = fin.read()
+	
+	lib.compact()
+	assert os.path.getsize(fn + ".journal") < len(old_journal)
+	
+	# Compaction keeps the snapshot's format.
+	with open(fn, "rb") as fin:
+		assert not fin.read().startswith(TAGLIB2_MAGIC)
+	
+	new_lib = TagLibrary(fn)
+	new_lib.validate_integrity()
+	TagLibrary.validate_identical(lib, new_lib)
+	
+	# Saving over the snapshot compacts, rather than leaving the journal behind.
+	lib.create("zebra")
+	lib.save(fn)
+	assert os.path.getsize(fn + ".journal") < len(old_journal)
+	TagLibrary.validate_identical(lib, TagLibrary(fn))
+	
+	# A journal left over from before compaction no longer applies to the snapshot, and is ignored.
+	with open(fn + ".journal", "wb") as fout:
+		fout.write(old_journal)
+	
+	new_lib = TagLibrary(fn)
+	TagLibrary.validate_identical(lib, new_lib)
+
+def test_journal_compact_weights(tmpdir):
+	fn = tmpdir + "/test_journal_compact_weights.taglib"
+	
+	lib = TagLibrary(None)
+	lib.create_many(["ball", "sphere", "orb"])
+	lib.save(fn)
+	
+	lib = TagLibrary(fn, journal=True)
+	lib.set_weight("ball", 5.0)
+	lib.set_weight("sphere", 2.5)
+	lib.set_weight("sphere", 0)
+	lib.compact()
+	
+	# TAGLIB snapshots don't store weights, so they are kept in the new journal instead.
+	with open(fn, "rb") as fin:
+		assert not fin.read().startswith(TAGLIB2_MAGIC)
+	
+	new_lib = TagLibrary(fn, journal=True)
+	assert [new_lib.get(name).weight for name in ("ball", "sphere", "orb")] == [5.0, 0, 0]
+	
+	new_lib.set_weight("orb", 1.5)
+	new_lib.compact()
+	new_lib.close_journal()
+	
+	new_lib = TagLibrary(fn)
+	assert [new_lib.get(name).weight for name in ("ball", "sphere", "orb")] == [5.0, 0, 1.5]
+	assert new_lib.complete("") == [("ball", new_lib.get("ball")), ("orb", new_lib.get("orb")), ("sphere", new_lib.get("sphere"))]
+
+#### Test expression caching ####
+
+def test_tagify_shares_parsed_tree():
+	lib = TagLibrary(None)
+	ball = lib.create("ball")
+	sports = lib.create("sports")
+	
+	expr = TagExpression("ball AND NOT sports")
+	parsed = expr.root
+	
+	lib.tagify(expr)
+	
+	assert expr.root is not parsed
+	assert expr.root.left is ball
+	assert expr.root.right.right is sports
+	assert parsed.left == "ball"
+	assert parsed.right.right == "sports"
+	
+	again = TagExpression("ball AND NOT sports")
+	assert again.root is parsed
+	
+	lib.tagify(again)
+	assert again.root is expr.root
+
+def test_tagify_cache_invalidation():
+	lib = TagLibrary(None)
+	ball = lib.create("ball")
+	
+	with pytest.raises(TagIdentificationError):
+		lib.tagify(TagExpression("ball OR sphere"))
+	
+	sphere = lib.create("sphere")
+	
+	expr = TagExpression("ball OR sphere")
+	lib.tagify(expr)
+	tagified = expr.root
+	assert tagified.right is sphere
+	
+	lib.create("round")
+	expr = TagExpression("ball OR sphere")
+	lib.tagify(expr)
+	assert expr.root is not tagified
+	tagified = expr.root
+	
+	ball.alias(sphere)
+	expr = TagExpression("ball OR sphere")
+	lib.tagify(expr)
+	assert expr.root is not tagified
+	tagified = expr.root
+	
+	ball.canonize()
+	expr = TagExpression("ball OR sphere")
+	lib.tagify(expr)
+	assert expr.root is not tagified
+
+def test_tagify_expand():
+	lib = TagLibrary(None)
+	animal = lib.create("animal")
+	dog = lib.create("dog")
+	puppy = lib.create("puppy")
+	hound = lib.create("hound")
+	lib.create("rock")
+	
+	dog.imply(animal)
+	puppy.imply(dog)
+	hound.alias(dog)
+	
+	expr = TagExpression("animal AND NOT rock")
+	lib.tagify(expr, expand=True)
+	
+	assert type(expr.root.left) is TagExpansion
+	assert expr.root.left.tag is animal
+	assert set(expr.root.left.tags()) == {animal, dog.get_canon(), puppy}
+	assert expr.root.left.tag_ids() == {animal.tag_id, dog.get_canon().tag_id, puppy.tag_id}
+	
+	# Expanded and unexpanded trees are cached separately.
+	plain = TagExpression("animal AND NOT rock")
+	lib.tagify(plain)
+	assert plain.root.left is animal
+	
+	again = TagExpression("animal AND NOT rock")
+	lib.tagify(again, expand=True)
+	assert again.root is expr.root
+	
+	# Closures are read on use, so cached trees see new implications.
+	kitten = lib.create("kitten")
+	expr = TagExpression("animal")
+	lib.tagify(expr, expand=True)
+	kitten.imply(animal)
+	assert kitten in set(expr.root.tags())
+	
+	# Already tagified leaves are expanded too.
+	expr = TagExpression("dog")
+	lib.tagify(expr)
+	lib.tagify(expr, expand=True)
+	assert expr.root.tag_ids() == {dog.get_canon().tag_id, puppy.tag_id}
+
+#### Test compile ####
+
+# Evaluates the passed tagified tree directly, given the set of canonical ids of an item's tags.
+def evaluate(node, tag_ids):
+	if type(node) is TagNegation:
+		return not evaluate(node.right, tag_ids)
+	
+	if type(node) is TagConjunction:
+		return evaluate(node.left, tag_ids) and evaluate(node.right, tag_ids)
+	
+	if type(node) is TagDisjunction:
+		return evaluate(node.left, tag_ids) or evaluate(node.right, tag_ids)
+	
+	return node.get_canon().tag_id in tag_ids
+
+def test_compile():
+	rng = random.Random(22)
+	
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(40)).created
+	tags[1].alias(tags[2])
+	tags[3].alias(tags[30])
+	
+	for i in range(200):
+		expr = TagExpression(random_expression(rng, rng.randint(1, 12), 40))
+		lib.tagify(expr)
+		
+		matches = expr.compile()
+		matches_bitmap = expr.compile(bitmap=True)
+		for j in range(20):
+			tag_ids = {tag.get_canon().tag_id for tag in rng.sample(tags, rng.randint(0, 12))}
+			
+			assert matches(tag_ids) is evaluate(expr.root, tag_ids)
+			assert matches(frozenset(tag_ids)) is evaluate(expr.root, tag_ids)
+			assert matches_bitmap(tag_id_bitmap(tag_ids)) is evaluate(expr.root, tag_ids)
+			assert matches_bitmap(bytes(tag_id_bitmap(tag_ids))) is evaluate(expr.root, tag_ids)
+
+def test_compile_canonical():
+	lib = TagLibrary(None)
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	lib.create("zebra")
+	ball.alias(sphere)
+	
+	expr = TagExpression("ball AND NOT zebra")
+	lib.tagify(expr)
+	matches = expr.compile()
+	
+	assert matches({ball.get_canon().tag_id})
+	assert not matches({ball.get_canon().tag_id, lib.get("zebra").tag_id})
+	assert not matches(set())
+
+def test_compile_deep():
+	lib = TagLibrary(None)
+	lib.create_many(["this", "that", "other"])
+	this, that = lib.get("this").tag_id, lib.get("that").tag_id
+	
+	expr = TagExpression("NOT " * 1001 + "this")
+	lib.tagify(expr)
+	assert expr.compile()({that})
+	assert not expr.compile()({this})
+	
+	expr = TagExpression("this AND (" * 500 + "that OR other" + ")" * 500)
+	lib.tagify(expr)
+	assert expr.compile()({this, that})
+	assert not expr.compile()({this})
+	assert expr.compile(bitmap=True)(tag_id_bitmap([this, that]))
+	
+	expr = TagExpression(" OR ".join(["this"] * 10000))
+	lib.tagify(expr)
+	assert expr.compile()({this})
+
+def test_compile_untagified():
+	with pytest.raises(TagExpressionValidationError):
+		TagExpression("this AND that").compile()
+
+def test_compile_expand():
+	rng = random.Random(24)
+	
+	lib = TagLibrary(None)
+	tags = lib.create_many(f"tag {i}" for i in range(41)).created
+	for i in range(1, 40):
+		tags[i].imply(tags[rng.randrange(i)])
+	
+	tags[40].alias(tags[5])
+	
+	# Evaluates the passed expanded tree directly, given the set of canonical ids of an item's tags.
+	def evaluate_expanded(node, tag_ids):
+		if type(node) is TagExpansion:
+			return any(tag.get_canon().tag_id in tag_ids for tag in lib if tag.get_canon() is node.tag.get_canon() or node.tag.get_canon() in tag.all_consequents())
+		
+		if type(node) is TagNegation:
+			return not evaluate_expanded(node.right, tag_ids)
+		
+		if type(node) is TagConjunction:
+			return evaluate_expanded(node.left, tag_ids) and evaluate_expanded(node.right, tag_ids)
+		
+		return evaluate_expanded(node.left, tag_ids) or evaluate_expanded(node.right, tag_ids)
+	
+	for i in range(100):
+		expr = TagExpression(random_expression(rng, rng.randint(1, 8), 41))
+		lib.tagify(expr, expand=True)
+		
+		matches = expr.compile()
+		matches_bitmap = expr.compile(bitmap=True)
+		for j in range(20):
+			tag_ids = {tag.get_canon().tag_id for tag in rng.sample(tags, rng.randint(0, 3))}
+			
+			assert matches(tag_ids) is evaluate_expanded(expr.root, tag_ids)
+			assert matches_bitmap(tag_id_bitmap(tag_ids)) is evaluate_expanded(expr.root, tag_ids)
\ No newline at end of file
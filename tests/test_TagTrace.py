@@ -0,0 +1,68 @@
+import logging
+import pytest
+
+from ..TagLibrary import TagLibrary, TagIdentificationError
+from ..TagExpression import *
+from ..TagTrace import set_tracer, trace_to_logger
+
+@pytest.fixture
+def events():
+	collected = []
+	set_tracer(lambda event, **fields: collected.append((event, fields)))
+	yield collected
+	set_tracer(None)
+
+def test_trace_parse(events):
+	TagExpression("ball AND NOT zebra")
+	
+	parses = [fields for event, fields in events if event == "parse"]
+	assert parses[-1]["operator"] is TagConjunction
+	assert parses[-1]["operator_i"] == 5
+	assert (parses[-1]["start"], parses[-1]["end"]) == (0, 18)
+	assert [fields["expr"][fields["start"] : fields["end"]] for fields in parses if fields["operator"] is None] == ["ball", "zebra"]
+	
+	parsed = [fields for event, fields in events if event == "parsed"]
+	assert len(parsed) == 1
+	assert parsed[0]["expr"] == "ball AND NOT zebra"
+	assert parsed[0]["seconds"] >= 0
+
+def test_trace_library(events):
+	lib = TagLibrary(None)
+	ball = lib.create("ball")
+	sphere = lib.create("sphere")
+	sports = lib.create("sports")
+	
+	ball.imply(sports)
+	ball.alias(sphere)
+	
+	with pytest.raises(TagIdentificationError):
+		lib.get("zebra")
+	
+	assert ("imply", {"tag": ball.tag_id, "other": sports.tag_id}) in events
+	assert any(event == "alias" for event, fields in events)
+	assert ("lookup_miss", {"name": "zebra"}) in events
+
+def test_trace_disabled(capsys):
+	set_tracer(None)
+	
+	lib = TagLibrary(None)
+	lib.create("ball").imply(lib.create("sports"))
+	lib.tagify(TagExpression("NOT NOT ball OR sports"))
+	
+	captured = capsys.readouterr()
+	assert captured.out == ""
+	assert captured.err == ""
+
+def test_trace_to_logger(caplog):
+	trace_to_logger(level=logging.INFO)
+	
+	try:
+		with caplog.at_level(logging.INFO, logger="TagLibrary"):
+			TagExpression("zebra")
+	
+	finally:
+		set_tracer(None)
+	
+	records = [record for record in caplog.records if record.tag_event == "parsed"]
+	assert len(records) == 1
+	assert records[0].tag_fields["expr"] == "zebra"
@@ -0,0 +1,43 @@
+import json
+
+from ..TagExpression import *
+from ..benchmarks.generators import generate_names, generate_library, generate_expressions
+from ..benchmarks.__main__ import run
+
+def test_generate_names():
+	names = generate_names(2000, seed=3)
+	
+	assert len(names) == 2000
+	assert len(set(names)) == 2000
+	assert names == generate_names(2000, seed=3)
+	assert names != generate_names(2000, seed=4)
+
+def test_generate_library():
+	names = generate_names(2000, seed=3)
+	lib = generate_library(names, seed=3, depth=16)
+	
+	lib.validate_integrity()
+	assert sorted(name for name, tag in lib.items()) == sorted(names)
+	
+	aliases = [tag for tag in lib if tag.canonical is not None]
+	assert 0 < len(aliases) < len(names) * 0.1
+	
+	# Chains reach the requested depth.
+	assert max(len(tag.all_consequents()) for tag in lib) >= 15
+
+def test_generate_expressions():
+	names = generate_names(500, seed=3)
+	lib = generate_library(names, seed=3)
+	
+	for expr_str in generate_expressions(names, 200, seed=3):
+		expr = TagExpression(expr_str)
+		lib.tagify(expr)
+		expr.to_conjunctive_normal_form()
+
+def test_run():
+	results = run([300], repeat=1, lookups=100, expressions=20)
+	
+	assert {result["benchmark"] for result in results} == {"create", "create_many", "generate_library", "get", "save_taglib", "load_taglib", "save_taglib2", "load_taglib2", "parse", "tagify", "cnf"}
+	assert all(result["size"] == 300 and result["seconds"] >= 0 for result in results)
+	
+	json.dumps(results)
@@ -78,4 +78,71 @@ def test_NNF_propogation():
 	assert type(expr.root.right.left) is TagNegation
 	assert type(expr.root.right.right) is TagNegation
 	assert      expr.root.right.left.right == "that"
-	assert      expr.root.right.right.right == "things"
\ No newline at end of file
+	assert      expr.root.right.right.right == "things"
+
+#### Conjunctive Normal Form ####
+
+# Evaluates the passed expression tree, given the set of tags which are present.
+def evaluate(node, present):
+	if type(node) is str:
+		return node in present
+	
+	if type(node) is TagNegation:
+		return not evaluate(node.right, present)
+	
+	if type(node) is TagConjunction:
+		return evaluate(node.left, present) and evaluate(node.right, present)
+	
+	if type(node) is TagDisjunction:
+		return evaluate(node.left, present) or evaluate(node.right, present)
+	
+	raise TypeError(node)
+
+# Throws unless no conjunction appears beneath a disjunction or negation.
+def validate_is_conjunctive_normal(node, below_disjunction=False):
+	if type(node) is TagConjunction:
+		assert not below_disjunction
+		validate_is_conjunctive_normal(node.left, below_disjunction)
+		validate_is_conjunctive_normal(node.right, below_disjunction)
+	
+	elif type(node) is TagDisjunction:
+		validate_is_conjunctive_normal(node.left, True)
+		validate_is_conjunctive_normal(node.right, True)
+	
+	elif type(node) is TagNegation:
+		assert type(node.right) is str
+
+def test_CNF_equivalence():
+	names = ["a", "b", "c", "d"]
+	for expr_str in [
+		"a",
+		"NOT a",
+		"a OR b AND c",
+		"(a AND b) OR (c AND d)",
+		"NOT (a OR b) OR c AND NOT d",
+		"(a OR b) AND NOT (c AND (d OR NOT a))",
+		"NOT (NOT (a AND b) OR NOT (c OR d AND a))",
+	]:
+		expr = TagExpression(expr_str)
+		cnf = TagExpression(expr_str)
+		cnf.to_conjunctive_normal_form()
+		validate_is_conjunctive_normal(cnf.root)
+		
+		for mask in range(1 << len(names)):
+			present = {name for name_i, name in enumerate(names) if mask & (1 << name_i)}
+			assert evaluate(cnf.root, present) == evaluate(expr.root, present)
+
+def test_normal_forms_do_not_modify_parsed_tree():
+	expr = TagExpression("NOT (this AND (that OR NOT NOT things))")
+	parsed = expr.root
+	
+	expr.to_conjunctive_normal_form()
+	expr.root.validate_is_negation_normal()
+	
+	assert type(parsed) is TagNegation
+	assert type(parsed.right) is TagConjunction
+	assert type(parsed.right.right) is TagDisjunction
+	assert type(parsed.right.right.right) is TagNegation
+	assert type(parsed.right.right.right.right) is TagNegation
+	
+	assert TagExpression("NOT (this AND (that OR NOT NOT things))").root is parsed